@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks of the per domain collection cost.
+
+The getters of `LibvirtConnection` and `main.get_instance_metrics` are run
+against libvirt's test driver, with generated domains that have nova metadata
+and any number of NICs and disks, so no hypervisor is needed. The results are
+written as JSON, to compare them across commits:
+
+    python benchmark.py --domains 100 --nics 8 --disks 8 --output new.json
+    python benchmark.py --compare old.json new.json
+"""
+
+import argparse
+import functools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import timeit
+import uuid
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2, allocations aren't measured.
+    tracemalloc = None
+
+import libvirt
+from errors import LibvirtConnectionError
+from libvirt_checks import LibvirtConnection
+import main
+
+NOVA_XMLNS = "http://openstack.org/xmlns/libvirt/nova/1.0"
+
+# Per domain figures compared by --compare.
+FIGURES = ("libvirt_calls", "seconds", "allocated_bytes")
+
+
+def domain_xml(index, nics, disks, domain_uuid=None, user_uuid=None,
+               project_uuid=None):
+    """Return the XML of a test driver domain with `nics` NICs, `disks` disks
+    and nova metadata. The uuids not given are random."""
+    devices = []
+    for disk in range(disks):
+        devices.append(
+            "<disk type='file' device='disk'>"
+            "<source file='/images/{0}-{1}.img'/>"
+            "<target dev='vd{2}' bus='virtio'/></disk>".format(
+                index, disk, chr(ord("a") + disk % 26) * (disk // 26 + 1)))
+    for nic in range(nics):
+        devices.append(
+            "<interface type='ethernet'>"
+            "<mac address='52:54:00:{0:02x}:{1:02x}:{2:02x}'/>"
+            "<target dev='tap{0}-{3}'/></interface>".format(
+                index // 256 % 256, index % 256, nic, nic))
+
+    return """<domain type='test'>
+  <name>instance-{index:08x}</name>
+  <uuid>{uuid}</uuid>
+  <memory>2097152</memory>
+  <currentMemory>2097152</currentMemory>
+  <vcpu>4</vcpu>
+  <os><type>hvm</type></os>
+  <metadata>
+    <nova:instance xmlns:nova="{xmlns}">
+      <nova:name>benchmark-{index}</nova:name>
+      <nova:owner>
+        <nova:user uuid="{user}">user-{index}</nova:user>
+        <nova:project uuid="{project}">project-{project_index}</nova:project>
+      </nova:owner>
+    </nova:instance>
+  </metadata>
+  <devices>{devices}</devices>
+</domain>""".format(index=index, uuid=domain_uuid or uuid.uuid4(),
+                    xmlns=NOVA_XMLNS, user=user_uuid or uuid.uuid4(),
+                    project=project_uuid or uuid.uuid4(),
+                    project_index=index % 10, devices="".join(devices))
+
+
+def write_node(path, domains, nics, disks):
+    """Write a test driver node definition with `domains` running domains"""
+    with open(path, "w") as node_file:
+        node_file.write("<node>\n")
+        for index in range(domains):
+            node_file.write(domain_xml(index, nics, disks))
+        node_file.write("</node>\n")
+
+
+class LibvirtCallCounter(object):
+    """Counts the calls made on libvirt connections and domains. With a
+    remote driver (qemu+ssh) most of them are one RPC each."""
+
+    CLASSES = (libvirt.virConnect, libvirt.virDomain)
+
+    def __init__(self):
+        self.count = 0
+        self._originals = []
+
+    def install(self):
+        """Start counting"""
+        for cls in self.CLASSES:
+            for name, attribute in list(vars(cls).items()):
+                if name.startswith("_") or not callable(attribute):
+                    continue
+                self._originals.append((cls, name, attribute))
+                setattr(cls, name, self._wrap(attribute))
+
+    def uninstall(self):
+        """Stop counting"""
+        for cls, name, attribute in self._originals:
+            setattr(cls, name, attribute)
+        self._originals = []
+
+    def _wrap(self, function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            self.count += 1
+            return function(*args, **kwargs)
+        return wrapper
+
+
+def get_cases():
+    """Return (name, function) pairs, in the order process_host uses them.
+    Every function takes the connection and the domains and returns how many
+    calls it made."""
+
+    def per_domain(getter):
+        def run_getter(connection, domains):
+            for domain in domains:
+                getter(connection, domain)
+            return len(domains)
+        return run_getter
+
+    def per_device(getter, discover, key):
+        def run_getter(connection, domains):
+            calls = 0
+            for domain in domains:
+                for device in discover(connection, domain):
+                    getter(connection, domain, device[key])
+                    calls += 1
+            return calls
+        return run_getter
+
+    def all_domain_stats(connection, domains):
+        connection.get_all_domain_stats()
+        return 1
+
+    def instance_metrics(connection, domains):
+        for domain in domains:
+            main.get_instance_metrics(domain, connection)
+        return len(domains)
+
+    def instance_metrics_bulk(connection, domains):
+        all_domain_stats = connection.get_all_domain_stats()
+        for domain in domains:
+            main.get_instance_metrics(
+                domain, connection, all_domain_stats.get(domain))
+        return len(domains)
+
+    cases = [(name, per_domain(getattr(LibvirtConnection, name)))
+             for name in ("get_misc_attributes", "discover_vnics",
+                          "discover_vdisks", "is_active", "get_cpu",
+                          "get_memory")]
+    cases.extend([
+        ("get_diskio", per_device(LibvirtConnection.get_diskio,
+                                  LibvirtConnection.discover_vdisks,
+                                  "{#VDISK}")),
+        ("get_ifaceio", per_device(LibvirtConnection.get_ifaceio,
+                                   LibvirtConnection.discover_vnics,
+                                   "{#VNIC}")),
+        ("get_all_domain_stats", all_domain_stats),
+        ("get_instance_metrics", instance_metrics),
+        ("get_instance_metrics[bulk]", instance_metrics_bulk)])
+    return cases
+
+
+def measure(connection, domains, function, counter, trace):
+    """Run `function` once and return what it cost"""
+    if trace:
+        tracemalloc.start()
+    count_before = counter.count
+    started = timeit.default_timer()
+    calls = function(connection, domains)
+    seconds = timeit.default_timer() - started
+    allocated = None
+    if trace:
+        allocated = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return calls, counter.count - count_before, seconds, allocated
+
+
+def run(uri, rounds):
+    """Run every case `rounds` times over all domains of `uri`.
+
+    Every round starts a new collection cycle with `discover_domains`, so
+    the first getter of a round pays for fetching and parsing the domain
+    XML, as it does in process_host."""
+    counter = LibvirtCallCounter()
+    connection = LibvirtConnection(uri)
+    cases = get_cases()
+    totals = dict((name, [0, 0, 0.0, 0]) for name, _ in cases)
+    totals["discover_domains"] = [0, 0, 0.0, 0]
+    errors = {}
+    domain_count = 0
+
+    counter.install()
+    try:
+        # The last round only measures allocations, tracing slows the others.
+        for round_number in range(rounds + (tracemalloc is not None)):
+            trace = round_number == rounds
+            domains = []
+
+            def discover(connection, _):
+                domains.extend(connection.discover_domains())
+                return 1
+            results = [("discover_domains",
+                        measure(connection, None, discover, counter, trace))]
+            domain_count = len(domains)
+
+            for name, function in cases:
+                if name in errors:
+                    continue
+                try:
+                    results.append((name, measure(
+                        connection, domains, function, counter, trace)))
+                except (libvirt.libvirtError, LibvirtConnectionError) as error:
+                    # The test driver doesn't implement every API.
+                    errors[name] = str(error)
+
+            for name, (calls, libvirt_calls, seconds, allocated) in results:
+                if trace:
+                    totals[name][3] = allocated
+                else:
+                    totals[name][0] += calls
+                    totals[name][1] += libvirt_calls
+                    totals[name][2] += seconds
+    finally:
+        counter.uninstall()
+        connection.close()
+
+    results = {}
+    for name, (calls, libvirt_calls, seconds, allocated) in totals.items():
+        if name in errors:
+            results[name] = {"error": errors[name]}
+            continue
+        per_domain = float(domain_count * rounds) or 1.0
+        results[name] = {
+            "calls": calls,
+            "libvirt_calls": libvirt_calls / per_domain,
+            "seconds": seconds / per_domain,
+            "allocated_bytes": allocated / float(domain_count or 1)
+                               if tracemalloc is not None else None}
+    return results
+
+
+def git_commit():
+    """Return the commit being benchmarked, if this is a git checkout"""
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old_path, new_path):
+    """Print how the per domain figures changed between two result files"""
+    with open(old_path) as old_file:
+        old = json.load(old_file)
+    with open(new_path) as new_file:
+        new = json.load(new_file)
+
+    print("{:<28} {:<16} {:>14} {:>14} {:>8}".format(
+        "case", "per domain", str(old["commit"]), str(new["commit"]),
+        "change"))
+    for name in sorted(set(old["results"]) & set(new["results"])):
+        for figure in FIGURES:
+            before = old["results"][name].get(figure)
+            after = new["results"][name].get(figure)
+            if before is None or after is None:
+                continue
+            change = (after - before) / before * 100 if before else 0.0
+            print("{:<28} {:<16} {:>14.6g} {:>14.6g} {:>+7.1f}%".format(
+                name, figure, before, after, change))
+
+
+def main_benchmark():
+    """Parse the arguments and run or compare the benchmarks"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--domains", type=int, default=100)
+    parser.add_argument("--nics", type=int, default=4)
+    parser.add_argument("--disks", type=int, default=4)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--output", help="write the results to this file")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+                        help="compare two result files instead")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    node = tempfile.NamedTemporaryFile(suffix=".xml", delete=False)
+    node.close()
+    try:
+        write_node(node.name, args.domains, args.nics, args.disks)
+        results = run("test://" + node.name, args.rounds)
+    finally:
+        os.remove(node.name)
+
+    report = {"commit": git_commit(),
+              "python": platform.python_version(),
+              "libvirt": libvirt.getVersion(),
+              "domains": args.domains, "nics": args.nics,
+              "disks": args.disks, "rounds": args.rounds,
+              "results": results}
+    output = json.dumps(report, indent=4, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    sys.exit(main_benchmark())
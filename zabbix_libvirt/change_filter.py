@@ -0,0 +1,90 @@
+"""
+This file holds a filter that drops rarely changing values (LLD discovery
+packets and static instance attributes) when they haven't changed since they
+were last sent.
+"""
+
+import hashlib
+import json
+import os
+import time
+
+
+def _digest(value):
+    """Return a digest of a metric value"""
+    if not isinstance(value, bytes):
+        value = value.encode("utf-8")
+    return hashlib.sha1(value).hexdigest()
+
+
+class ChangeFilter(object):
+    """Keeps a digest of the last value sent for `keys` of every host, and
+    drops values equal to it.
+
+    A value is sent again anyway once `refresh_interval` seconds passed since
+    it was last sent, so zabbix recovers if it lost a value.
+
+    Digests only become "sent" when `commit` is called, which should happen
+    after the values were accepted by zabbix.
+    """
+
+    def __init__(self, keys, refresh_interval, state=None):
+        self.keys = frozenset(keys)
+        self.refresh_interval = refresh_interval
+        # host -> key -> [digest, time sent]
+        self.state = state if state is not None else {}
+        self._pending = []
+
+    @classmethod
+    def load(cls, path, keys, refresh_interval):
+        """Load the digests from the state file at `path`, if it exists"""
+        try:
+            with open(path) as state_file:
+                state = json.load(state_file)
+        except (IOError, ValueError):
+            state = {}
+        return cls(keys, refresh_interval, state)
+
+    def save(self, path):
+        """Write the digests to the state file at `path`"""
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "w") as state_file:
+            json.dump(self.state, state_file)
+        os.rename(temporary_path, path)
+
+    def filter(self, metrics, now=None):
+        """Return `metrics` without the values that didn't change"""
+        if now is None:
+            now = time.time()
+
+        result = []
+        for metric in metrics:
+            if metric.key not in self.keys:
+                result.append(metric)
+                continue
+
+            digest = _digest(metric.value)
+            last = self.state.get(metric.host, {}).get(metric.key)
+            if last is not None and last[0] == digest and \
+                    now - last[1] < self.refresh_interval:
+                continue
+
+            result.append(metric)
+            self._pending.append((metric.host, metric.key, digest, now))
+        return result
+
+    def commit(self, exclude=()):
+        """Remember the values returned by `filter` as sent, except the ones
+        of the hosts in `exclude`, which are sent again"""
+        exclude = set(exclude)
+        for host, key, digest, now in self._pending:
+            if host not in exclude:
+                self.state.setdefault(host, {})[key] = [digest, now]
+        self._pending = []
+
+    def retain(self, hosts):
+        """Drop the digests of hosts not in `hosts`"""
+        hosts = set(hosts)
+        for host in list(self.state):
+            if host not in hosts:
+                del self.state[host]
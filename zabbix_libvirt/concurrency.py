@@ -0,0 +1,73 @@
+"""
+This file holds the worker pools hosts are processed with, and the limits on
+how many workers may use a shared resource at the same time.
+
+Two backends are supported:
+
+* process: a multiprocessing pool. Workers don't share memory, so objects
+  they use have to be set up before the pool is created (and are inherited
+  by fork) or set up once per worker by an initializer.
+* thread: a thread pool in the current process. Collection mostly waits on
+  libvirt RPCs and HTTP, which release the GIL, so one process can drive
+  hundreds of hypervisors without paying for one interpreter each.
+"""
+
+import multiprocessing
+import threading
+from multiprocessing.pool import ThreadPool
+
+BACKENDS = ("process", "thread")
+
+
+def make_pool(backend, size, initializer=None):
+    """Return a worker pool of `size` workers for `backend`.
+
+    `initializer` is called once in every worker process. It is called once
+    in the current process for the thread backend."""
+    if backend not in BACKENDS:
+        raise ValueError("Unknown backend: " + str(backend))
+
+    size = max(1, size)
+    if backend == "process":
+        return multiprocessing.Pool(size, initializer=initializer)
+
+    if initializer is not None:
+        initializer()
+    return ThreadPool(size)
+
+
+def map_concurrently(function, items, concurrency):
+    """Call `function` with every item of `items` in up to `concurrency`
+    threads, and yield what it returns as the calls finish.
+
+    With a `concurrency` of 1 everything runs in the calling thread, in
+    order, and only as the results are consumed."""
+    if concurrency <= 1 or len(items) <= 1:
+        for item in items:
+            yield function(item)
+        return
+
+    pool = ThreadPool(min(concurrency, len(items)))
+    try:
+        for result in pool.imap_unordered(function, items):
+            yield result
+    finally:
+        pool.terminate()
+
+
+class ResourceLimits(object):
+    """Bounded semaphores capping how many workers talk to libvirt hosts,
+    the zabbix API and the zabbix trapper at the same time.
+
+    For the process backend these are multiprocessing semaphores, they must
+    be created before the pool so the workers inherit them.
+    """
+
+    def __init__(self, backend, libvirt, zabbix_api, trapper):
+        if backend == "process":
+            semaphore = multiprocessing.BoundedSemaphore
+        else:
+            semaphore = threading.BoundedSemaphore
+        self.libvirt = semaphore(libvirt)
+        self.zabbix_api = semaphore(zabbix_api)
+        self.trapper = semaphore(trapper)
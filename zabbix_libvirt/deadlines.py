@@ -0,0 +1,77 @@
+"""
+This file holds the time budgets of a collection cycle: a `Deadline` per
+hypervisor, and running libvirt calls that may hang (a dead SSH connection,
+libvirtd stuck on a dying VM) in a thread that is abandoned if it takes too
+long.
+"""
+
+import threading
+import timeit
+
+from errors import DeadlineExceeded
+
+
+class Deadline(object):
+    """A point in time, `seconds` from now, work has to be done by. A
+    deadline of 0 or None seconds never expires."""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires = None
+        if seconds:
+            self.expires = timeit.default_timer() + seconds
+
+    def remaining(self):
+        """Return the seconds left, None if the deadline never expires"""
+        if self.expires is None:
+            return None
+        return max(0.0, self.expires - timeit.default_timer())
+
+    def expired(self):
+        """Return whether the deadline has passed"""
+        return self.expires is not None and \
+            timeit.default_timer() >= self.expires
+
+    def timeout(self, seconds=None):
+        """Return the shorter of `seconds` and the time left, None if neither
+        is limited"""
+        remaining = self.remaining()
+        if not seconds:
+            return remaining
+        if remaining is None:
+            return seconds
+        return min(seconds, remaining)
+
+    def run(self, function, *args, **kwargs):
+        """Call `function` and return what it returns, giving up once the
+        deadline passes, or after `timeout` seconds if that's shorter.
+
+        When it has to be waited for, `function` runs in a daemon thread,
+        which keeps running (and its result is dropped) if `DeadlineExceeded`
+        is raised. So it must not hold locks or change anything the caller
+        uses afterwards."""
+        timeout = self.timeout(kwargs.pop("timeout", None))
+        if timeout is None:
+            return function(*args, **kwargs)
+        if timeout <= 0:
+            raise DeadlineExceeded("No time left")
+
+        outcome = []
+
+        def target():
+            try:
+                outcome.append((True, function(*args, **kwargs)))
+            except BaseException as error:
+                outcome.append((False, error))
+
+        thread = threading.Thread(target=target, name="deadline")
+        thread.daemon = True
+        thread.start()
+        thread.join(timeout)
+        if not outcome:
+            raise DeadlineExceeded(
+                "Gave up after {:.1f} seconds".format(timeout))
+        succeeded, result = outcome[0]
+        if not succeeded:
+            raise result
+        return result
@@ -9,3 +9,8 @@ class LibvirtConnectionError(Exception):
 class DomainNotFoundError(Exception):
     """Error to indicate something went wrong with the LibvirtConnection class"""
     pass
+
+
+class DeadlineExceeded(Exception):
+    """Error to indicate that something took longer than its time budget"""
+    pass
@@ -0,0 +1,106 @@
+"""
+This file holds the dispatcher that turns libvirt domain lifecycle events
+from all hypervisors into batches of zabbix provisioning work.
+"""
+
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import libvirt
+
+# Events after which the domain should have an enabled host in zabbix.
+PROVISION_EVENTS = (libvirt.VIR_DOMAIN_EVENT_DEFINED,
+                    libvirt.VIR_DOMAIN_EVENT_STARTED)
+
+# How long (seconds) to remember that a domain was migrated away, so the
+# UNDEFINED event that follows on the source doesn't disable its host.
+MIGRATION_MEMORY = 300
+
+
+class LifecycleEventDispatcher(object):
+    """Queues lifecycle events (it's the callback registered on the libvirt
+    connections) and hands them to `handler` in batches from its own thread.
+
+    Events arriving within `batch_delay` seconds of each other are batched,
+    and coalesced per domain. `handler(to_provision, to_disable)` is called
+    with a dictionary of domain uuid to the `LibvirtConnection` the domain was
+    defined or started on, and a list of uuids of undefined domains.
+    """
+
+    def __init__(self, handler, batch_delay=2, logger=None):
+        self.handler = handler
+        self.batch_delay = batch_delay
+        self.logger = logger
+        self._queue = queue.Queue()
+        self._migrated = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __call__(self, connection, domain_uuid_string, event, detail):
+        self._queue.put((connection, domain_uuid_string, event, detail))
+
+    def start(self):
+        """Start handling events in a daemon thread"""
+        self._thread = threading.Thread(
+            target=self._run, name="lifecycle-events")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop after the current batch"""
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                events = [self._queue.get(timeout=1)]
+            except queue.Empty:
+                continue
+
+            # Wait a bit for related events (e.g. STOPPED then UNDEFINED).
+            time.sleep(self.batch_delay)
+            while True:
+                try:
+                    events.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                self.handler(*self.coalesce(events))
+            except Exception as error:
+                # Events are only a shortcut, the periodic full scan fixes
+                # whatever was missed here.
+                if self.logger is not None:
+                    self.logger.exception(error)
+
+    def coalesce(self, events, now=None):
+        """Reduce `events` to the domains to provision and to disable"""
+        if now is None:
+            now = time.time()
+        for domain_uuid_string, migrated_at in list(self._migrated.items()):
+            if now - migrated_at > MIGRATION_MEMORY:
+                del self._migrated[domain_uuid_string]
+
+        to_provision = {}
+        to_disable = set()
+        for connection, domain_uuid_string, event, detail in events:
+            if event in PROVISION_EVENTS:
+                to_provision[domain_uuid_string] = connection
+                to_disable.discard(domain_uuid_string)
+            elif event == libvirt.VIR_DOMAIN_EVENT_STOPPED and \
+                    detail == libvirt.VIR_DOMAIN_EVENT_STOPPED_MIGRATED:
+                self._migrated[domain_uuid_string] = now
+            elif event == libvirt.VIR_DOMAIN_EVENT_UNDEFINED:
+                # The domain may already be running on the migration target,
+                # in which case its host must stay enabled.
+                if domain_uuid_string in self._migrated:
+                    continue
+                to_provision.pop(domain_uuid_string, None)
+                to_disable.add(domain_uuid_string)
+
+        return to_provision, sorted(to_disable)
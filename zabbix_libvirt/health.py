@@ -0,0 +1,86 @@
+"""
+This file holds the health of the hypervisors across runs, with a circuit
+breaker per hypervisor: one that keeps failing is only probed every so often
+instead of holding a worker until its connection times out in every run.
+"""
+
+import json
+import os
+import time
+
+
+class HostHealth(object):
+    """Consecutive failures and last success of a hypervisor, kept in a
+    state file between runs.
+
+    After `threshold` consecutive failures the circuit opens: the hypervisor
+    is skipped until a backoff has passed, then probed once. The backoff
+    starts at `min_backoff` seconds and doubles with every failed probe, up
+    to `max_backoff`. A success closes the circuit.
+    """
+
+    def __init__(self, threshold, min_backoff, max_backoff, state=None):
+        self.threshold = threshold
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        # {"failures": .., "last_success": .., "last_failure": ..,
+        # "retry_at": ..}
+        self.state = state if state is not None else {}
+
+    @classmethod
+    def load(cls, path, threshold, min_backoff, max_backoff):
+        """Load the health from the state file at `path`, if it exists"""
+        try:
+            with open(path) as state_file:
+                state = json.load(state_file)
+        except (IOError, ValueError):
+            state = {}
+        return cls(threshold, min_backoff, max_backoff, state)
+
+    def save(self, path):
+        """Write the health to the state file at `path`"""
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "w") as state_file:
+            json.dump(self.state, state_file, separators=(",", ":"))
+        os.rename(temporary_path, path)
+
+    @property
+    def failures(self):
+        """The number of consecutive failures"""
+        return self.state.get("failures", 0)
+
+    def is_open(self, now=None):
+        """Return whether the hypervisor should be skipped at `now`"""
+        now = time.time() if now is None else now
+        return self.failures >= self.threshold and \
+            now < self.state.get("retry_at", 0)
+
+    def retry_in(self, now=None):
+        """Return the seconds until the next probe"""
+        now = time.time() if now is None else now
+        return max(0.0, self.state.get("retry_at", 0) - now)
+
+    def succeeded(self, now=None):
+        """Record a success, closing the circuit"""
+        now = time.time() if now is None else now
+        self.state["failures"] = 0
+        self.state["last_success"] = now
+        self.state.pop("retry_at", None)
+
+    def failed(self, now=None):
+        """Record a failure, opening the circuit (again) once there were
+        `threshold` in a row"""
+        now = time.time() if now is None else now
+        failures = self.failures + 1
+        self.state["failures"] = failures
+        self.state["last_failure"] = now
+        if failures >= self.threshold:
+            backoff = min(self.max_backoff, self.min_backoff *
+                          2 ** min(failures - self.threshold, 32))
+            self.state["retry_at"] = now + backoff
+
+    def summary(self, now=None):
+        """Return the state of the circuit, for the collector's metrics"""
+        return {"circuit_open": int(self.is_open(now)),
+                "failures": self.failures,
+                "last_success": int(self.state.get("last_success", 0))}
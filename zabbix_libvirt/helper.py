@@ -5,6 +5,8 @@ import configparser
 
 config = configparser.ConfigParser()
 
+CONFIG_FILE = "/etc/zabbix-libvirt/config.ini"
+
 
 def get_hosts(hosts_file):
     """Return the IPs/DNS names from a file"""
@@ -19,6 +21,9 @@ def setup_logging(name, logfile):
     formatter = logging.Formatter(fmt='%(asctime)s %(levelname)-8s %(message)s',
                                   datefmt='%Y-%m-%d %H:%M:%S')
     logger = logging.getLogger(name)
+    if logger.handlers:
+        # Already set up, e.g. by an earlier cycle in daemon mode.
+        return logger
     logger.setLevel(logging.DEBUG)
     handler = logging.handlers.RotatingFileHandler(
         logfile, mode="a", maxBytes=5 * 2**20)
@@ -27,7 +32,6 @@ def setup_logging(name, logfile):
     return logger
 
 
-def load_config():
+def load_config(config_file=CONFIG_FILE):
     """Load the config file and return the config object"""
-    config_file = "/etc/zabbix-libvirt/config.ini"
     config.read(config_file)
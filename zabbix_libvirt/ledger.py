@@ -0,0 +1,115 @@
+"""
+This file holds the last-seen ledger: when every domain was last found on a
+hypervisor, in a sqlite database, so the cleanup knows which hosts to disable
+or delete without reading their history back from zabbix.
+"""
+
+import sqlite3
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS seen ("
+    "domain TEXT PRIMARY KEY, node TEXT NOT NULL, clock REAL NOT NULL, "
+    "disabled INTEGER NOT NULL DEFAULT 0)",
+    "CREATE INDEX IF NOT EXISTS seen_clock ON seen (clock)",
+    "CREATE INDEX IF NOT EXISTS seen_disabled_clock ON seen (disabled, clock)",
+    "CREATE TABLE IF NOT EXISTS meta ("
+    "name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+
+class LastSeenLedger(object):
+    """When every domain was last seen, and by which node.
+
+    Domains not seen for a while are found with a range query on the clock,
+    and the ones whose hosts were disabled are marked, so every cleanup only
+    looks at what changed since the last one.
+    """
+
+    schema = SCHEMA
+
+    def __init__(self, path, timeout=60):
+        self.path = path
+        self.timeout = timeout
+
+        def create(connection):
+            columns = [row[1] for row in
+                       connection.execute("PRAGMA table_info(seen)")]
+            if columns and "disabled" not in columns:
+                # Written by a version without the ledger.
+                connection.execute("ALTER TABLE seen ADD COLUMN "
+                                   "disabled INTEGER NOT NULL DEFAULT 0")
+            for statement in self.schema:
+                connection.execute(statement)
+        self._transaction(create)
+
+    def _transaction(self, function):
+        """Call `function` with a connection in a transaction and return
+        what it returns.
+
+        The transaction takes the write lock right away, so nodes sharing
+        the database can't read something another is about to change."""
+        connection = sqlite3.connect(self.path, timeout=self.timeout,
+                                     isolation_level=None)
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                result = function(connection)
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+            return result
+        finally:
+            connection.close()
+
+    @staticmethod
+    def _record(connection, node, domains, clock):
+        connection.executemany(
+            "INSERT OR REPLACE INTO seen (domain, node, clock, disabled) "
+            "VALUES (?, ?, ?, 0)",
+            ((domain, node, clock) for domain in domains))
+
+    def record(self, node, domains, clock):
+        """Record that `node` saw `domains` at `clock` (unix time)"""
+        self._transaction(
+            lambda connection: self._record(connection, node, domains, clock))
+
+    def imported(self):
+        """Return whether `import_domains` was called"""
+        return self._transaction(lambda connection: connection.execute(
+            "SELECT 1 FROM meta WHERE name = 'imported'").fetchone()
+            is not None)
+
+    def import_domains(self, node, domains, clock):
+        """Record the domains of `domains` the ledger doesn't know as seen
+        at `clock`, e.g. the hosts zabbix had before the ledger existed, so
+        the cleanup gets to them"""
+        def add(connection):
+            connection.executemany(
+                "INSERT OR IGNORE INTO seen (domain, node, clock) "
+                "VALUES (?, ?, ?)",
+                ((domain, node, clock) for domain in domains))
+            connection.execute(
+                "INSERT OR REPLACE INTO meta (name, value) "
+                "VALUES ('imported', ?)", (str(clock),))
+        self._transaction(add)
+
+    def stale(self, disable_before, delete_before):
+        """Return a dictionary of domain to when it was last seen, of the
+        domains not seen since `disable_before` that aren't marked disabled
+        yet, and of all not seen since `delete_before`"""
+        return self._transaction(lambda connection: dict(connection.execute(
+            "SELECT domain, clock FROM seen "
+            "WHERE (disabled = 0 AND clock < ?) OR clock < ?",
+            (disable_before, delete_before))))
+
+    def mark_disabled(self, domains, before):
+        """Mark the domains of `domains` not seen since `before` as disabled,
+        until they are seen again"""
+        self._transaction(lambda connection: connection.executemany(
+            "UPDATE seen SET disabled = 1 WHERE domain = ? AND clock < ?",
+            ((domain, before) for domain in domains)))
+
+    def prune(self, before):
+        """Forget the domains last seen before `before` (unix time)"""
+        self._transaction(lambda connection: connection.execute(
+            "DELETE FROM seen WHERE clock < ?", (before,)))
@@ -3,11 +3,150 @@ This file holds the class that creates a connection to libvirt and provides
 various methods to get useful information
 """
 
+import functools
+import threading
 import time
 from xml.etree import ElementTree
 import libvirt
 from errors import LibvirtConnectionError, DomainNotFoundError
 
+# Groups of statistics requested from `getAllDomainStats` in bulk mode.
+BULK_STATS = (libvirt.VIR_DOMAIN_STATS_STATE |
+              libvirt.VIR_DOMAIN_STATS_CPU_TOTAL |
+              libvirt.VIR_DOMAIN_STATS_BALLOON |
+              libvirt.VIR_DOMAIN_STATS_VCPU |
+              libvirt.VIR_DOMAIN_STATS_INTERFACE |
+              libvirt.VIR_DOMAIN_STATS_BLOCK)
+
+# Maps the bulk block stats fields to the keys `blockStatsFlags` returns.
+BULK_BLOCK_FIELDS = {"rd.reqs": "rd_operations",
+                     "rd.bytes": "rd_bytes",
+                     "rd.times": "rd_total_times",
+                     "wr.reqs": "wr_operations",
+                     "wr.bytes": "wr_bytes",
+                     "wr.times": "wr_total_times",
+                     "fl.reqs": "flush_operations",
+                     "fl.times": "flush_total_times"}
+
+# Domain states `isActive` counts as active, i.e. the ones with a running
+# qemu process.
+ACTIVE_STATES = (libvirt.VIR_DOMAIN_RUNNING,
+                 libvirt.VIR_DOMAIN_BLOCKED,
+                 libvirt.VIR_DOMAIN_PAUSED)
+
+NOVA_NAMESPACE = "{http://openstack.org/xmlns/libvirt/nova/1.0}"
+NOVA_OWNER = ("domain", "metadata", NOVA_NAMESPACE + "instance",
+              NOVA_NAMESPACE + "owner")
+VNIC_TARGET = ("domain", "devices", "interface", "target")
+VDISK_TARGET = ("domain", "devices", "disk", "target")
+
+
+class _DomainXMLTarget(object):
+    """ElementTree parser target that only keeps the parts of a domain's XML
+    we use, instead of building the whole tree."""
+
+    def __init__(self):
+        self.path = []
+        self.vnics = []
+        self.vdisks = []
+        self.owner = None
+        self._text = None
+
+    def start(self, tag, attrib):
+        self.path.append(tag)
+        path = tuple(self.path)
+
+        if path == VNIC_TARGET:
+            self.vnics.append(attrib.get("dev"))
+        elif path == VDISK_TARGET:
+            self.vdisks.append(attrib.get("dev"))
+        elif path == NOVA_OWNER:
+            self.owner = {}
+        elif path[:-1] == NOVA_OWNER:
+            # <nova:user uuid="..">name</nova:user> and
+            # <nova:project uuid="..">name</nova:project>
+            kind = tag[len(NOVA_NAMESPACE):]
+            self.owner[kind + "_uuid"] = attrib.get("uuid")
+            self._text = []
+
+    def data(self, data):
+        if self._text is not None:
+            self._text.append(data)
+
+    def end(self, tag):
+        if self._text is not None:
+            kind = tag[len(NOVA_NAMESPACE):]
+            self.owner[kind + "_name"] = "".join(self._text)
+            self._text = None
+        self.path.pop()
+
+    def close(self):
+        return self
+
+
+class DomainXMLSnapshot(object):
+    """NICs, disks and nova owner metadata parsed out of a domain's XML.
+
+    `digest` identifies the XML it was parsed from, so the snapshot can be
+    reused until the domain's XML changes.
+    """
+
+    __slots__ = ("digest", "vnics", "vdisks", "owner")
+
+    def __init__(self, xml):
+        parser = ElementTree.XMLParser(target=_DomainXMLTarget())
+        parser.feed(xml)
+        target = parser.close()
+
+        self.digest = hash(xml)
+        self.vnics = target.vnics
+        self.vdisks = target.vdisks
+        self.owner = target.owner
+
+
+_EVENT_LOOP = None
+
+
+def start_event_loop():
+    """Register libvirt's default event implementation and run it in a daemon
+    thread. Keepalives (and domain events) need it.
+
+    It has to be called before the connections are opened, calling it again
+    does nothing."""
+    global _EVENT_LOOP
+    if _EVENT_LOOP is not None:
+        return
+
+    def run():
+        while True:
+            libvirt.virEventRunDefaultImpl()
+
+    libvirt.virEventRegisterDefaultImpl()
+    _EVENT_LOOP = threading.Thread(target=run, name="libvirt-event-loop")
+    _EVENT_LOOP.daemon = True
+    _EVENT_LOOP.start()
+
+
+def _domain_getter(method):
+    """Decorator for getters that take a domain uuid string or handle.
+
+    A handle can outlive its domain, in which case libvirt raises
+    VIR_ERR_NO_DOMAIN. That is turned into `DomainNotFoundError` (same as a
+    failed lookup by uuid) and the stale handle is forgotten.
+    """
+    @functools.wraps(method)
+    def wrapper(self, domain, *args):
+        try:
+            return method(self, domain, *args)
+        except libvirt.libvirtError as error:
+            if error.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN:
+                raise
+            domain_uuid_string = self._get_uuid(domain)
+            self._forget_domain(domain_uuid_string)
+            raise DomainNotFoundError(
+                "Failed to find domain: " + domain_uuid_string)
+    return wrapper
+
 
 class LibvirtConnection(object):
     """This class opens a connection to libvirt and provides with methods
@@ -19,8 +158,14 @@ class LibvirtConnection(object):
         """Error handler"""
         pass
 
-    def __init__(self, uri=None):
-        """Creates a read only connection to libvirt"""
+    def __init__(self, uri=None, keepalive=None):
+        """Creates a read only connection to libvirt
+
+        keepalive: (interval, count) tuple. If set, libvirt closes the
+        connection when `count` keepalive messages sent every `interval`
+        seconds go unanswered. Needs `start_event_loop`."""
+        self.uri = uri
+        self._event_callback_id = None
         try:
             self.conn = libvirt.openReadOnly(uri)
         except libvirt.libvirtError as error:
@@ -29,12 +174,62 @@ class LibvirtConnection(object):
             raise LibvirtConnectionError(
                 "Failed to open connection to the hypervisor: " + str(uri))
 
+        if keepalive is not None:
+            try:
+                self.conn.setKeepAlive(*keepalive)
+            except libvirt.libvirtError as error:
+                self.close()
+                raise LibvirtConnectionError(error)
+
+        # Domain handles keyed by uuid, filled by `discover_domains` so the
+        # getters don't have to look every domain up again.
+        self._domains = {}
+
+        # Parsed domain XML keyed by uuid, and the uuids whose XML was already
+        # fetched in this cycle. A cycle starts with `discover_domains`.
+        self._xml_snapshots = {}
+        self._fresh_snapshots = set()
+
         # We set this because when libvirt errors are raised, they are still
         # printed to console (stderr) even if you catch them.
         # This is a problem with libvirt API.
         # See https://stackoverflow.com/questions/45541725/avoiding-console-prints-by-libvirt-qemu-python-apis
         libvirt.registerErrorHandler(f=self.libvirt_callback, ctx=None)
 
+    def is_alive(self):
+        """Returns True if the connection is still usable"""
+        try:
+            return self.conn.isAlive() == 1
+        except libvirt.libvirtError:
+            return False
+
+    def close(self):
+        """Close the connection to libvirt"""
+        try:
+            if self._event_callback_id is not None:
+                self.conn.domainEventDeregisterAny(self._event_callback_id)
+                self._event_callback_id = None
+            self.conn.close()
+        except libvirt.libvirtError:
+            pass
+
+    def register_lifecycle_events(self, callback):
+        """Call `callback(connection, domain_uuid_string, event, detail)` for
+        every domain lifecycle event (defined, started, stopped, undefined...)
+        on this connection. `event` and `detail` are libvirt's
+        VIR_DOMAIN_EVENT_* constants.
+
+        The callback runs in the event loop thread (see `start_event_loop`),
+        so it should hand the event off rather than do slow work itself."""
+        def handler(conn, domain, event, detail, opaque):
+            callback(self, domain.UUIDString(), event, detail)
+
+        try:
+            self._event_callback_id = self.conn.domainEventRegisterAny(
+                None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, handler, None)
+        except libvirt.libvirtError as error:
+            raise LibvirtConnectionError(error)
+
     def _get_domain_by_uuid(self, domain_uuid_string):
         """Find the domain by uuid and return domain object"""
         try:
@@ -44,56 +239,97 @@ class LibvirtConnection(object):
                 "Failed to find domain: " + domain_uuid_string)
         return domain
 
+    @staticmethod
+    def _get_uuid(domain):
+        """Return the uuid string of a domain uuid string or handle"""
+        if isinstance(domain, libvirt.virDomain):
+            return domain.UUIDString()
+        return domain
+
+    def _get_domain(self, domain):
+        """Return the domain handle for a domain uuid string or handle.
+
+        Uses the handles kept from discovery and only looks the domain up by
+        uuid if it's not known yet."""
+        if isinstance(domain, libvirt.virDomain):
+            return domain
+
+        handle = self._domains.get(domain)
+        if handle is None:
+            handle = self._get_domain_by_uuid(domain)
+            self._domains[domain] = handle
+        return handle
+
+    def _forget_domain(self, domain_uuid_string):
+        """Drop the cached handle and XML of a domain that no longer exists"""
+        self._domains.pop(domain_uuid_string, None)
+        self._xml_snapshots.pop(domain_uuid_string, None)
+
     def discover_domains(self):
         """Return all domains"""
-        domains = self.conn.listAllDomains()
-        return [domain.UUIDString() for domain in domains]
+        self._domains = dict((domain.UUIDString(), domain)
+                             for domain in self.conn.listAllDomains())
 
-    def _get_domain_xmldump(self, domain_uuid_string):
-        """Return domain xml dump"""
-        domain = self._get_domain_by_uuid(domain_uuid_string)
-        return ElementTree.fromstring(domain.XMLDesc())
+        # Start a new cycle: XML is fetched again (and only re-parsed if it
+        # changed), and snapshots of domains that are gone are dropped.
+        self._fresh_snapshots = set()
+        for domain_uuid_string in set(self._xml_snapshots) - set(self._domains):
+            del self._xml_snapshots[domain_uuid_string]
 
-    def _get_instance_attributes(self, domain_uuid_string):
-        """Returns openstack specific instance attributes"""
-        tree = self._get_domain_xmldump(domain_uuid_string)
+        return list(self._domains)
+
+    def _get_domain_snapshot(self, domain):
+        """Return the `DomainXMLSnapshot` of a domain.
+
+        The XML is fetched at most once per cycle and only parsed again if it
+        changed since the last cycle."""
+        domain_uuid_string = self._get_uuid(domain)
+        snapshot = self._xml_snapshots.get(domain_uuid_string)
+        if snapshot is not None and \
+                domain_uuid_string in self._fresh_snapshots:
+            return snapshot
+
+        xml = self._get_domain(domain).XMLDesc()
+        if snapshot is None or snapshot.digest != hash(xml):
+            snapshot = DomainXMLSnapshot(xml)
+            self._xml_snapshots[domain_uuid_string] = snapshot
 
-        namespaces = {"nova": "http://openstack.org/xmlns/libvirt/nova/1.0"}
-        element = tree.find("metadata/nova:instance/nova:owner", namespaces)
+        self._fresh_snapshots.add(domain_uuid_string)
+        return snapshot
 
-        if element is None:
+    def _get_instance_attributes(self, domain):
+        """Returns openstack specific instance attributes"""
+        owner = self._get_domain_snapshot(domain).owner
+
+        if owner is None:
             return {"user_uuid": "non-openstack-instance",
                     "project_uuid": "non-openstack-instance",
                     "user_name": "non-openstack-instance",
                     "project_name": "non-openstack-instance"}
 
-        user_uuid = element.find("nova:user", namespaces).get("uuid")
-        project_uuid = element.find("nova:project", namespaces).get("uuid")
-        user_name = element.find("nova:user", namespaces).text
-        project_name = element.find("nova:project", namespaces).text
+        return {"user_uuid": owner.get("user_uuid"),
+                "project_uuid": owner.get("project_uuid"),
+                "user_name": owner.get("user_name"),
+                "project_name": owner.get("project_name")}
 
-        return {"user_uuid": user_uuid,
-                "project_uuid": project_uuid,
-                "user_name": user_name,
-                "project_name": project_name}
-
-    def discover_vnics(self, domain_uuid_string):
+    @_domain_getter
+    def discover_vnics(self, domain):
         """Discover all virtual NICs on a domain.
 
         Returns a list of dictionary with "{#VNIC}"s name and domain's uuid"""
-        tree = self._get_domain_xmldump(domain_uuid_string)
-        elements = tree.findall('devices/interface/target')
-        return [{"{#VNIC}": element.get('dev')} for element in elements]
+        snapshot = self._get_domain_snapshot(domain)
+        return [{"{#VNIC}": vnic} for vnic in snapshot.vnics]
 
-    def discover_vdisks(self, domain_uuid_string):
+    @_domain_getter
+    def discover_vdisks(self, domain):
         """Discover all virtual disk drives on a domain.
 
         Returns a list of dictionary with "{#VDISK}"s name and domain's uuid"""
-        tree = self._get_domain_xmldump(domain_uuid_string)
-        elements = tree.findall('devices/disk/target')
-        return [{"{#VDISK}": element.get('dev')} for element in elements]
+        snapshot = self._get_domain_snapshot(domain)
+        return [{"{#VDISK}": vdisk} for vdisk in snapshot.vdisks]
 
-    def get_memory(self, domain_uuid_string):
+    @_domain_getter
+    def get_memory(self, domain):
         """Get memorystats for domain.
 
         Here's a mapping of what the output from
@@ -106,7 +342,7 @@ class LibvirtConnection(object):
 
         The API returns the output in KiB, so we multiply by 1024 to return bytes for zabbix.
         """
-        domain = self._get_domain_by_uuid(domain_uuid_string)
+        domain = self._get_domain(domain)
 
         try:
             stats = domain.memoryStats()
@@ -122,20 +358,22 @@ class LibvirtConnection(object):
                 "available": stats.get("usable", 0) * 1024,
                 "current_allocation": stats.get("actual", 0) * 1024}
 
-    def get_misc_attributes(self, domain_uuid_string):
+    @_domain_getter
+    def get_misc_attributes(self, domain):
         """Get virtualization host's hostname and combine it with openstack
         specific instance attributes"""
 
-        domain = self._get_domain_by_uuid(domain_uuid_string)
-        instance_attributes = self._get_instance_attributes(domain_uuid_string)
+        domain = self._get_domain(domain)
+        instance_attributes = self._get_instance_attributes(domain)
 
         instance_attributes["virt_host"] = self.conn.getHostname()
         instance_attributes["name"] = domain.name()
-        instance_attributes["active"] = self.is_active(domain_uuid_string)
+        instance_attributes["active"] = domain.isActive()
 
         return instance_attributes
 
-    def get_cpu(self, domain_uuid_string):
+    @_domain_getter
+    def get_cpu(self, domain):
         """Get CPU statistics. Libvirt returns the stats in nanoseconds.
 
         Returns the cpu time in nanoseconds.
@@ -144,7 +382,7 @@ class LibvirtConnection(object):
         See the stack overflow article to understand what it means.
         https://stackoverflow.com/questions/40468370/what-does-cpu-time-represent-exactly-in-libvirt
         """
-        domain = self._get_domain_by_uuid(domain_uuid_string)
+        domain = self._get_domain(domain)
 
         info = domain.info()
         timestamp = time.time()
@@ -153,9 +391,10 @@ class LibvirtConnection(object):
                 "core_count": info[3],
                 "timestamp": timestamp}
 
-    def get_ifaceio(self, domain_uuid_string, iface):
+    @_domain_getter
+    def get_ifaceio(self, domain, iface):
         """Get Network I / O"""
-        domain = self._get_domain_by_uuid(domain_uuid_string)
+        domain = self._get_domain(domain)
 
         try:
             stats = domain.interfaceStats(iface)
@@ -163,13 +402,16 @@ class LibvirtConnection(object):
             if domain.isActive():
                 raise
             else:
-                return {"read": 0, "write": 0}
+                return {"read": 0, "write": 0,
+                        "read_packets": 0, "write_packets": 0}
 
-        return {"read": str(stats[0]), "write": str(stats[4])}
+        return {"read": str(stats[0]), "write": str(stats[4]),
+                "read_packets": str(stats[1]), "write_packets": str(stats[5])}
 
-    def get_diskio(self, domain_uuid_string, disk):
+    @_domain_getter
+    def get_diskio(self, domain, disk):
         """Get Disk I / O"""
-        domain = self._get_domain_by_uuid(domain_uuid_string)
+        domain = self._get_domain(domain)
 
         try:
             stats = domain.blockStatsFlags(disk)
@@ -184,11 +426,153 @@ class LibvirtConnection(object):
 
         return stats
 
-    def is_active(self, domain_uuid_string):
+    def get_all_domain_stats(self):
+        """Get cpu, memory, disk, nic and state stats for all domains with a
+        single `getAllDomainStats` call.
+
+        Returns a dictionary keyed by domain uuid. Every value is a dictionary
+        with "cpu", "memory", "disk", "nic" and "active" keys, where "cpu",
+        "memory" and the per device values of "disk" and "nic" are shaped like
+        the output of `get_cpu`, `get_memory`, `get_diskio` and `get_ifaceio`.
+        """
+        try:
+            records = self.conn.getAllDomainStats(BULK_STATS)
+        except libvirt.libvirtError as error:
+            raise LibvirtConnectionError(error)
+        timestamp = time.time()
+
+        snapshot = {}
+        for domain, stats in records:
+            domain_uuid_string = domain.UUIDString()
+            self._domains[domain_uuid_string] = domain
+            snapshot[domain_uuid_string] = self._parse_domain_stats(
+                stats, timestamp)
+        return snapshot
+
+    @staticmethod
+    def _parse_domain_stats(stats, timestamp):
+        """Convert the flat `getAllDomainStats` record of a domain into the
+        per getter dictionaries."""
+        active = int(stats.get("state.state") in ACTIVE_STATES)
+
+        # Inactive domains report their configured vcpus too, only their per
+        # vcpu stats are missing.
+        core_count = stats.get("vcpu.current") or stats.get("vcpu.maximum", 1)
+        cpu = {"cpu_time": int(stats.get("cpu.time", 0) / core_count),
+               "core_count": core_count,
+               "timestamp": timestamp}
+
+        if active:
+            memory = {"free": stats.get("balloon.unused", 0) * 1024,
+                      "available": stats.get("balloon.usable", 0) * 1024,
+                      "current_allocation": stats.get("balloon.current", 0) * 1024}
+        else:
+            memory = {"free": 0, "available": 0, "current_allocation": 0}
+
+        disks = {}
+        for index in range(stats.get("block.count", 0)):
+            prefix = "block.{}.".format(index)
+            name = stats.get(prefix + "name")
+            if name is None:
+                continue
+            disks[name] = dict(
+                (key, stats.get(prefix + field, 0))
+                for field, key in BULK_BLOCK_FIELDS.items())
+
+        nics = {}
+        for index in range(stats.get("net.count", 0)):
+            prefix = "net.{}.".format(index)
+            name = stats.get(prefix + "name")
+            if name is None:
+                continue
+            nics[name] = {
+                "read": str(stats.get(prefix + "rx.bytes", 0)),
+                "write": str(stats.get(prefix + "tx.bytes", 0)),
+                "read_packets": str(stats.get(prefix + "rx.pkts", 0)),
+                "write_packets": str(stats.get(prefix + "tx.pkts", 0))}
+
+        return {"cpu": cpu, "memory": memory, "disk": disks, "nic": nics,
+                "active": active}
+
+    @_domain_getter
+    def is_active(self, domain):
         """Returns 1 if domain is active, 0 otherwise."""
-        domain = self._get_domain_by_uuid(domain_uuid_string)
+        domain = self._get_domain(domain)
         return domain.isActive()
 
 
+class LibvirtConnectionCache(object):
+    """Keeps `LibvirtConnection`s open across collection cycles.
+
+    Dead connections (detected by libvirt keepalives) are reopened on the
+    next `get`. Failed attempts to connect are retried with exponential
+    backoff, between `min_backoff` and `max_backoff` seconds.
+
+    lifecycle_callback: registered for domain lifecycle events on every
+    connection opened, see `LibvirtConnection.register_lifecycle_events`.
+    """
+
+    def __init__(self, keepalive=(5, 3), min_backoff=5, max_backoff=300,
+                 lifecycle_callback=None):
+        start_event_loop()
+        self.keepalive = keepalive
+        self.lifecycle_callback = lifecycle_callback
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self._connections = {}
+        # uri -> (time of the next attempt, current backoff)
+        self._backoff = {}
+        self._lock = threading.Lock()
+
+    def get(self, uri):
+        """Return an open connection to `uri`, connecting if needed.
+
+        Raises `LibvirtConnectionError` if connecting fails or if the uri is
+        still backing off from an earlier failure."""
+        with self._lock:
+            connection = self._connections.pop(uri, None)
+            retry_at, backoff = self._backoff.get(uri, (0, 0))
+
+        if connection is not None:
+            if connection.is_alive():
+                with self._lock:
+                    self._connections[uri] = connection
+                return connection
+            connection.close()
+
+        if time.time() < retry_at:
+            raise LibvirtConnectionError(
+                "Not reconnecting to {} for another {:.0f} seconds".format(
+                    uri, retry_at - time.time()))
+
+        try:
+            connection = LibvirtConnection(uri, keepalive=self.keepalive)
+            if self.lifecycle_callback is not None:
+                try:
+                    connection.register_lifecycle_events(
+                        self.lifecycle_callback)
+                except LibvirtConnectionError:
+                    connection.close()
+                    raise
+        except LibvirtConnectionError:
+            backoff = min(max(backoff * 2, self.min_backoff), self.max_backoff)
+            with self._lock:
+                self._backoff[uri] = (time.time() + backoff, backoff)
+            raise
+
+        with self._lock:
+            self._backoff.pop(uri, None)
+            self._connections[uri] = connection
+        return connection
+
+    def close_all(self):
+        """Close all connections"""
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections = {}
+        for connection in connections:
+            connection.close()
+
+
 if __name__ == "__main__":
     print("Main called")
@@ -1,247 +1,1139 @@
 #!/usr/bin/env python2
 """The main module that orchestrates everything"""
 
+import argparse
+import collections
+import errno
+import fcntl
 import json
 import functools
 import time
-import sys
+import timeit
+import multiprocessing
+import signal
+import socket
 import os
-from multiprocessing import Pool
 
-from pyzabbix import ZabbixMetric, ZabbixSender
+import libvirt
 from pyzabbix.api import ZabbixAPIException
 from pyzabbix_socketwrapper import PyZabbixPSKSocketWrapper
-from errors import LibvirtConnectionError, DomainNotFoundError
-from helper import config, load_config, get_hosts, setup_logging
-from zabbix_methods import ZabbixConnection
-from libvirt_checks import LibvirtConnection
-from datetime import datetime
+from errors import LibvirtConnectionError, DomainNotFoundError, \
+    DeadlineExceeded
+from helper import config, load_config, get_hosts, setup_logging, CONFIG_FILE
+from zabbix_methods import ZabbixConnection, DISABLE_HOST
+from zabbix_session import ZabbixSession, TokenCache
+from libvirt_checks import LibvirtConnection, LibvirtConnectionCache
+from reconciler import ZabbixInventory, ZabbixReconciler, plan_cleanup
+from sender import BatchingZabbixSender, PipelinedZabbixSender
+from scheduler import IntervalScheduler
+from concurrency import make_pool, map_concurrently, ResourceLimits
+from change_filter import ChangeFilter
+from rates import RateCalculator, RATE_ITEMS, cpu_utilization
+from rollups import Rollups, ROLLUP_HOSTS
+from records import Metric, item_key
+from events import LifecycleEventDispatcher
+from spool import Spool
+from health import HostHealth
+from tiers import TierSchedule, TIERS, COUNTER_TIERS
+from timings import Timings, worker_profile, worker_profile_path
+from sharding import ShardStore, shard_hosts
+from ledger import LastSeenLedger
+from deadlines import Deadline
 VNICS_KEY = "libvirt.nic.discover"
 VDISKS_KEY = "libvirt.disk.discover"
 
-ENABLE_HOST = "0"
-DISABLE_HOST = "1"
-CHARACTER = "1"
+# Values that rarely change. With CHANGE_ONLY enabled they are only sent when
+# they change, or every CHANGE_REFRESH_INTERVAL seconds. libvirt.instance[name]
+# and libvirt.instance[active] are always sent, cleanup relies on the
+# first one being updated.
+CHANGE_ONLY_KEYS = (VNICS_KEY, VDISKS_KEY,
+                    "libvirt.instance[project_name]",
+                    "libvirt.instance[project_uuid]",
+                    "libvirt.instance[user_name]",
+                    "libvirt.instance[user_uuid]",
+                    "libvirt.instance[virt_host]")
 
+# NIC counters sent as they are, the packet counts are only used for rates.
+NIC_COUNTERS = ("read", "write")
 
-def get_instance_metrics(domain_uuid_string, libvirt_connection):
+# What `process_host` returns: the domains found (None if the host couldn't
+# be reached), the `Rollups` of their values (None if ROLLUPS isn't set) and
+# the `Timings` of the host.
+HostResult = collections.namedtuple(
+    "HostResult", ["domains", "rollups", "timings"])
+
+# Shared by all workers, see `setup_workers`.
+resource_limits = None
+zabbix_sender = None
+spool = None
+shard_store = None
+last_seen = None
+zabbix_session = None
+# Host -> `AsyncResult` of the hosts a run stopped waiting for, see `collect`.
+straggling = {}
+worker_zabbix_api = None
+worker_templateid = None
+worker_rollup_templateid = None
+
+
+def get_instance_metrics(domain_uuid_string, libvirt_connection,
+                         domain_stats=None, instance_attributes=None,
+                         rate_calculator=None, rollups=None, tiers=None,
+                         devices=None):
     """Gather instance attributes for domain with `domain_uuid_string` using
     `libvirt_connection` and then send the zabbix metrics using `zabbix_sender`
+
+    If `domain_stats` (the domain's entry from
+    `LibvirtConnection.get_all_domain_stats`) is given, cpu, memory, disk and
+    nic stats are taken from it instead of querying libvirt per metric.
+    Likewise `instance_attributes` saves the `get_misc_attributes` call, and
+    `devices` (vnics and vdisks) the discovery.
+
+    Only the values of `tiers` (see `tiers.TIERS`, all by default) are
+    returned. The counters of other tiers aren't queried, but those in
+    `domain_stats` still go into the rates and rollups. Of the instance
+    attributes, the name and active state are always returned, cleanup
+    relies on the name being updated.
+
+    With a `rate_calculator`, rates of the cpu, disk and nic counters are
+    sent too, and the counters themselves only if SEND_COUNTERS is set.
+
+    The instance's values are added to `rollups` if it's given.
     """
+    if tiers is None:
+        tiers = TIERS
+    # Counters are free with the bulk stats, so they are always collected.
+    collected = set(tiers)
+    if domain_stats is not None:
+        collected.update(COUNTER_TIERS)
+
     # 1. Discover nics and disks, and send the discovery packet
     metrics = []
-    vnics = libvirt_connection.discover_vnics(domain_uuid_string)
-    vdisks = libvirt_connection.discover_vdisks(domain_uuid_string)
+    if devices is None:
+        devices = (libvirt_connection.discover_vnics(domain_uuid_string),
+                   libvirt_connection.discover_vdisks(domain_uuid_string))
+    vnics, vdisks = devices
 
-    metrics.append(ZabbixMetric(domain_uuid_string, VNICS_KEY,
-                                json.dumps(vnics)))
-    metrics.append(ZabbixMetric(domain_uuid_string, VDISKS_KEY,
-                                json.dumps(vdisks)))
+    if "discovery" in tiers:
+        metrics.append(Metric(domain_uuid_string, VNICS_KEY,
+                              json.dumps(vnics)))
+        metrics.append(Metric(domain_uuid_string, VDISKS_KEY,
+                              json.dumps(vdisks)))
 
-    cpu_stats = libvirt_connection.get_cpu(domain_uuid_string)
-    timestamp = cpu_stats.pop("timestamp")
+    cpu_stats = {}
+    memory_stats = {}
+    disk_stats = {}
+    nic_stats = {}
+    if domain_stats is None:
+        if "cpu" in collected:
+            cpu_stats = libvirt_connection.get_cpu(domain_uuid_string)
+        if "memory" in collected:
+            memory_stats = libvirt_connection.get_memory(domain_uuid_string)
+    else:
+        cpu_stats = dict(domain_stats["cpu"])
+        memory_stats = domain_stats["memory"]
+        disk_stats = domain_stats["disk"]
+        nic_stats = domain_stats["nic"]
+    timestamp = cpu_stats.pop("timestamp", None) or time.time()
+    send_counters = rate_calculator is None or SEND_COUNTERS
+    # Counters of every rate group, which are the cpu, disk and nic tiers.
+    counters = {"cpu": {}, "disk": {}, "nic": {}}
+    if "cpu" in collected:
+        counters["cpu"]["cpu_time"] = cpu_stats["cpu_time"]
+    if not send_counters:
+        cpu_stats.pop("cpu_time", None)
 
     def _create_metric(stats, item_type, item_subtype=None):
         """Helper function to create and append to the metrics list"""
-        for stat, value in stats.iteritems():
+        for stat, value in stats.items():
+            metrics.append(Metric(
+                domain_uuid_string, item_key(item_type, stat, item_subtype),
+                value, timestamp))
 
-            if item_subtype is not None:
-                stat = "{},{}".format(item_subtype, stat)
+    if "cpu" in tiers:
+        _create_metric(cpu_stats, "cpu")
+    if "memory" in tiers:
+        _create_metric(memory_stats, "memory")
+    if instance_attributes is None:
+        instance_attributes = libvirt_connection.get_misc_attributes(
+            domain_uuid_string)
+    if "attributes" in tiers:
+        _create_metric(instance_attributes, "instance")
+    else:
+        _create_metric({"name": instance_attributes["name"],
+                        "active": instance_attributes["active"]}, "instance")
 
-            key = "libvirt.{}[{}]".format(item_type, stat)
-            metrics.append(ZabbixMetric(
-                domain_uuid_string, key, value, timestamp))
+    # 2. Gather metrics for all disks. Devices missing from the bulk stats
+    # (e.g. hotplugged after they were collected) are queried directly.
+    for vdisk in vdisks if "disk" in collected else ():
+        stats = disk_stats.get(vdisk["{#VDISK}"])
+        if stats is None:
+            stats = libvirt_connection.get_diskio(
+                domain_uuid_string, vdisk["{#VDISK}"])
+        for counter in RATE_ITEMS["disk"]:
+            counters["disk"]["disk,{},{}".format(vdisk["{#VDISK}"],
+                                                 counter)] = \
+                int(stats[counter])
+        if send_counters and "disk" in tiers:
+            _create_metric(stats, "disk", vdisk["{#VDISK}"])
 
-    _create_metric(cpu_stats, "cpu")
-    _create_metric(libvirt_connection.get_memory(domain_uuid_string), "memory")
-    _create_metric(libvirt_connection.get_misc_attributes(
-        domain_uuid_string), "instance")
+    # 3. Gather metrics for all nics
+    for vnic in vnics if "nic" in collected else ():
+        stats = nic_stats.get(vnic["{#VNIC}"])
+        if stats is None:
+            stats = libvirt_connection.get_ifaceio(
+                domain_uuid_string, vnic["{#VNIC}"])
+        for counter in RATE_ITEMS["nic"]:
+            counters["nic"]["nic,{},{}".format(vnic["{#VNIC}"], counter)] = \
+                int(stats[counter])
+        if send_counters and "nic" in tiers:
+            _create_metric(dict((key, stats[key]) for key in NIC_COUNTERS),
+                           "nic", vnic["{#VNIC}"])
 
-    for vdisk in vdisks:
-        stats = libvirt_connection.get_diskio(
-            domain_uuid_string, vdisk["{#VDISK}"])
-        _create_metric(stats, "disk", vdisk["{#VDISK}"])
+    # 4. Rates since the previous sample of the domain's counters
+    rates = {}
+    if rate_calculator is not None:
+        for group, group_counters in counters.items():
+            if group in collected:
+                rates.update(rate_calculator.update(
+                    domain_uuid_string, timestamp, group_counters, group))
+    rollup_values = {
+        "vms": 1,
+        "active_vms": int(instance_attributes["active"])}
+    if "cpu" in collected:
+        rollup_values["vcpus"] = cpu_stats["core_count"]
+        rollup_values["cpu_time"] = \
+            counters["cpu"]["cpu_time"] * cpu_stats["core_count"]
+    if "memory" in collected:
+        rollup_values["memory_allocated"] = \
+            memory_stats["current_allocation"]
 
-    # 3. Gather metrics for all nics
-    for vnic in vnics:
-        stats = libvirt_connection.get_ifaceio(
-            domain_uuid_string, vnic["{#VNIC}"])
-        _create_metric(stats, "nic", vnic["{#VNIC}"])
+    cpu_time_rate = rates.pop("cpu_time", None)
+    if cpu_time_rate is not None:
+        if "cpu" in tiers:
+            metrics.append(Metric(
+                domain_uuid_string, item_key("cpu", "utilization"),
+                round(cpu_utilization(cpu_time_rate), 2), timestamp))
+        rollup_values["cpus_used"] = \
+            cpu_time_rate * cpu_stats["core_count"] / 10 ** 9
+    for counter, rate in rates.items():
+        item_type, device, name = counter.split(",")
+        rate_item = RATE_ITEMS[item_type][name]
+        if item_type in tiers:
+            metrics.append(Metric(
+                domain_uuid_string, item_key(item_type, rate_item, device),
+                round(rate, 2), timestamp))
+        rollup_name = "{}_{}".format(item_type, rate_item)
+        rollup_values[rollup_name] = rollup_values.get(rollup_name, 0) + rate
+
+    if rollups is not None:
+        rollups.add(instance_attributes, rollup_values)
 
     return metrics
 
 
-def process_host(host, zabbix_sender):
-    """Takes in host, and then process the domains on that host"""
+def get_inventory(domain_uuid_string, libvirt_connection, tiers,
+                  instance_attributes=None, devices=None, domain_stats=None):
+    """Return the instance attributes and the devices (vnics and vdisks) of
+    the domain with `domain_uuid_string`.
+
+    They are fetched from libvirt if their tier ("attributes" and
+    "discovery") is in `tiers` or they aren't given, otherwise the given
+    ones are returned, with the active state taken from `domain_stats` (or
+    libvirt)."""
+    if instance_attributes is None or "attributes" in tiers:
+        instance_attributes = libvirt_connection.get_misc_attributes(
+            domain_uuid_string)
+    else:
+        instance_attributes = dict(instance_attributes)
+        if domain_stats is not None:
+            instance_attributes["active"] = domain_stats["active"]
+        else:
+            instance_attributes["active"] = \
+                libvirt_connection.is_active(domain_uuid_string)
+    if devices is None or "discovery" in tiers:
+        devices = [libvirt_connection.discover_vnics(domain_uuid_string),
+                   libvirt_connection.discover_vdisks(domain_uuid_string)]
+    return instance_attributes, devices
+
+
+def has_stale_devices(devices, domain_stats):
+    """Return whether the vnics and vdisks `devices` have one that's missing
+    from the bulk stats `domain_stats` of an active domain, i.e. one that was
+    detached since they were discovered"""
+    if domain_stats is None or not domain_stats["active"]:
+        return False
+    vnics, vdisks = devices
+    return any(vnic["{#VNIC}"] not in domain_stats["nic"]
+               for vnic in vnics) or \
+        any(vdisk["{#VDISK}"] not in domain_stats["disk"]
+            for vdisk in vdisks)
+
+
+def provision_hosts(zabbix_api, desired, templateid=None):
+    """Create, enable or regroup the zabbix hosts in `desired` (a dictionary
+    of host name to group names) in bulk and return the plan applied.
+
+    New hosts are linked to `templateid`, the instance template by default.
+    """
+    if templateid is None:
+        templateid = worker_templateid
+    group_names = set(name for names in desired.values() for name in names)
+    with resource_limits.zabbix_api:
+        inventory = ZabbixInventory.load(
+            zabbix_api, host_names=list(desired), group_names=group_names)
+        reconciler = ZabbixReconciler(
+            inventory, templateid, PSK_IDENTITY, PSK)
+        return reconciler.reconcile(zabbix_api, desired)
+
+
+def get_desired_groups(instance_attributes):
+    """Return the names of the groups a domain's host should be in"""
+    return [GROUP_NAME, instance_attributes["project_uuid"],
+            instance_attributes["project_name"]]
+
+
+def process_host(host, libvirt_connections=None, provision=True):
+    """Takes in host, and then process the domains on that host
+
+    libvirt_connections: `LibvirtConnectionCache` to reuse connections from.
+    A new connection is opened if it's None.
+    provision: Create, enable and regroup the hosts of the domains in zabbix.
+
+    Returns a `HostResult`. With PROFILE_DIR set, the worker's profile
+    (of all hosts it processed so far) is written there.
+
+    With CIRCUIT_BREAKER set, a host that couldn't be reached in the last
+    CIRCUIT_THRESHOLD runs is skipped until its backoff has passed.
+    """
     print("Processing Host: " + host)
     logger = setup_logging(__name__ + host, LOG_DIR + "/" + host)
+    timings = Timings()
+
+    health = None
+    if CIRCUIT_BREAKER:
+        health_path = os.path.join(STATE_DIR, host + ".health.json")
+        health = load_health(health_path)
+        if health.is_open():
+            logger.warning("Skipping host after %d failures, next probe in "
+                           "%.0fs", health.failures, health.retry_in())
+            timings.add_hypervisor(host, 0.0, 0, reachable=False,
+                                   health=health.summary())
+            print("Finished Processing: " + host)
+            return HostResult(None, None, timings)
+
+    profile = None
+    if PROFILE_DIR:
+        profile = worker_profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12 and newer only profile one thread at a time.
+            logger.warning("Another worker is being profiled, not profiling")
+            profile = None
+
+    started = timeit.default_timer()
+    health_started = time.time()
+    try:
+        domains, rollups = _process_host(
+            host, logger, timings, libvirt_connections, provision)
+    finally:
+        if profile is not None:
+            profile.disable()
+            profile.dump_stats(worker_profile_path(PROFILE_DIR))
+    seconds = timeit.default_timer() - started
+
+    summary = None
+    if health is not None:
+        summary = update_health(host, domains is not None, health_started)
+    timings.add_hypervisor(host, seconds, len(domains or ()),
+                           reachable=domains is not None, health=summary)
+    logger.info("Processed host in %.3fs: %s", seconds, timings.summary())
+    print("Finished Processing: " + host)
+    return HostResult(domains, rollups, timings)
+
+
+def load_health(path):
+    """Return the `HostHealth` in the state file at `path`"""
+    return HostHealth.load(path, CIRCUIT_THRESHOLD, CIRCUIT_MIN_BACKOFF,
+                           CIRCUIT_MAX_BACKOFF)
 
-    with ZabbixConnection(USER, "https://" + ZABBIX_SERVER, PASSWORD) as zabbix_api:
 
-        openstack_group_id = zabbix_api.get_group_id(GROUP_NAME)
-        templateid = zabbix_api.get_template_id(TEMPLATE_NAME)
+def update_health(host, succeeded, started=0):
+    """Record whether processing `host`, started at `started`, succeeded in
+    its health state file, and return the summary of its health.
 
-        logger.info("Starting to process host: %s", host)
-        uri = "qemu+ssh://root@" + host + "/system?keyfile=" + KEY_FILE
+    The run may abandon a host whose worker still finishes later, so both
+    update the file under a lock, and a success doesn't clear a failure
+    recorded since `started` (the abandonment)."""
+    health_path = os.path.join(STATE_DIR, host + ".health.json")
+    lock = lock_file(health_path + ".lock", wait=True)
+    try:
+        health = load_health(health_path)
+        if not succeeded:
+            health.failed()
+        elif health.state.get("last_failure", 0) < started:
+            health.succeeded()
+        health.save(health_path)
+    finally:
+        lock.close()
+    return health.summary()
 
+
+def _process_host(host, logger, timings, libvirt_connections, provision):
+    """Process the domains on `host` for `process_host`, timing every phase
+    with `timings`.
+
+    Returns the domains found and the `Rollups` of their values, both None
+    if the host couldn't be reached (or its domains not discovered within
+    HOST_TIMEOUT).
+
+    The libvirt calls can't be interrupted, so with HOST_TIMEOUT or
+    DOMAIN_TIMEOUT set they run in threads that are abandoned when they take
+    too long. A domain that times out is skipped, and once HOST_TIMEOUT has
+    passed the remaining domains are too; what was collected is still sent.
+
+    With TIERED set, every tier of a domain only runs (and only its values
+    are sent) once its interval in TIER_INTERVALS has passed.
+
+    Up to DOMAIN_CONCURRENCY domains are gathered at the same time, over the
+    host's one libvirt connection.
+    """
+    zabbix_api = worker_zabbix_api
+    # Every host batches its metrics on its own sender, hosts may be processed
+    # by threads sharing `zabbix_sender`.
+    host_sender = zabbix_sender.clone()
+    host_sender.timings = timings
+
+    logger.info("Starting to process host: %s", host)
+    uri = "qemu+ssh://root@" + host + "/system?keyfile=" + KEY_FILE
+    deadline = Deadline(HOST_TIMEOUT)
+    now = time.time()
+
+    schedule = None
+    if TIERED:
+        schedule_path = os.path.join(STATE_DIR, host + ".tiers.json")
+        schedule = TierSchedule.load(schedule_path, TIER_INTERVALS)
+
+    with resource_limits.libvirt:
         try:
-            libvirt_connection = LibvirtConnection(uri)
-        except LibvirtConnectionError as error:
+            with timings.phase("connect"):
+                if libvirt_connections is None:
+                    libvirt_connection = deadline.run(LibvirtConnection, uri)
+                else:
+                    libvirt_connection = deadline.run(
+                        libvirt_connections.get, uri)
+        except (LibvirtConnectionError, DeadlineExceeded) as error:
             # Log the failure to connect to a host, but continue processing
             # other hosts.
             print("Host %s errored out", host)
             logger.exception(error)
-            return None
+            return None, None
+
+        try:
+            with timings.phase("discover"):
+                domains = deadline.run(libvirt_connection.discover_domains)
+        except DeadlineExceeded as error:
+            # Without the domains the cleanup can't tell which are gone, so
+            # this counts as an unreachable host.
+            logger.error("Timed out discovering the domains of host: %s",
+                         host)
+            logger.exception(error)
+            return None, None
 
-        domains = libvirt_connection.discover_domains()
+        all_tiers = {}
         for domain in domains:
+            all_tiers[domain] = set(TIERS) if schedule is None \
+                else schedule.due(domain, now)
+
+        all_domain_stats = {}
+        if BULK_STATS and (ROLLUPS or any(
+                tiers.intersection(COUNTER_TIERS)
+                for tiers in all_tiers.values())):
             try:
-                instance_attributes = libvirt_connection.get_misc_attributes(
-                    domain)
-                project_uuid = instance_attributes["project_uuid"]
-                project_name = instance_attributes["project_name"]
-
-                project_uuid_group_id = zabbix_api.get_group_id(project_uuid)
-                project_name_group_id = zabbix_api.get_group_id(project_name)
-
-                if project_uuid_group_id is None:
-                    project_uuid_group_id = zabbix_api.create_hostgroup(
-                        project_uuid)
-
-                if project_name_group_id is None:
-                    project_name_group_id = zabbix_api.create_hostgroup(
-                        project_name)
-
-                groupids = [openstack_group_id,
-                            project_uuid_group_id, project_name_group_id]
-
-                if zabbix_api.get_host_id(domain) is None:
-                    logger.info("Creating new instance: %s", domain)
-                    zabbix_api.create_host(
-                        domain, groupids, templateid, PSK_IDENTITY, PSK)
-                elif zabbix_api.get_host_status(domain) == DISABLE_HOST:
-                    host_id = zabbix_api.get_host_id(domain)
-                    zabbix_api.set_hosts_status([host_id], ENABLE_HOST)
-
-                # Since we decided to update the host groups of all the VMs,
-                # I did this. Leaving it here for now in case we decide to do
-                # it again.
-                # zabbix_api.update_host_groups(domain, groupids)
-
-                metrics = get_instance_metrics(domain, libvirt_connection)
-                zabbix_sender.send(metrics)
-                logger.info("Domain %s is updated", domain)
+                with timings.phase("bulk_stats"):
+                    all_domain_stats = deadline.run(
+                        libvirt_connection.get_all_domain_stats)
+            except LibvirtConnectionError as error:
+                # Older libvirt versions may not support bulk stats, fall
+                # back to querying every domain on its own.
+                logger.warning("Bulk stats failed for host: %s", host)
+                logger.exception(error)
+            except DeadlineExceeded as error:
+                logger.error("Timed out getting the stats of host: %s", host)
+                logger.exception(error)
 
+        # 1. Gather the instance attributes, they decide the host groups,
+        # and the devices.
+        def inventory_task(domain):
+            """Return the domain, its attributes and devices (None if they
+            couldn't be gathered) and the `Timings` of doing so (None if the
+            host ran out of time)"""
+            if deadline.expired():
+                return domain, None, None
+            domain_timings = Timings()
+            cached_attributes = cached_devices = None
+            if schedule is not None:
+                cached_attributes = schedule.cached(domain, "attributes")
+                cached_devices = schedule.cached(domain, "devices")
+            if cached_devices is not None and has_stale_devices(
+                    cached_devices, all_domain_stats.get(domain)):
+                all_tiers[domain].add("discovery")
+            try:
+                with domain_timings.phase("attributes"):
+                    inventory = deadline.run(
+                        get_inventory, domain, libvirt_connection,
+                        all_tiers[domain], cached_attributes, cached_devices,
+                        all_domain_stats.get(domain), timeout=DOMAIN_TIMEOUT)
+                return domain, inventory, domain_timings
             except DomainNotFoundError as error:
                 # This may happen if a domain is deleted after we discover
                 # it. In that case we log the error and move on.
                 logger.error("Domain %s not found", domain)
                 logger.exception(error)
-            except ZabbixAPIException as error:
-                logger.error("Zabbix API error")
+            except DeadlineExceeded as error:
+                logger.error("Timed out getting the attributes of domain %s",
+                             domain)
                 logger.exception(error)
-    print("Finished Processing: " + host)
-    return domains
+            return domain, None, domain_timings
 
+        all_instance_attributes = {}
+        all_devices = {}
+        skipped = 0
+        for domain, inventory, domain_timings in map_concurrently(
+                inventory_task, domains, DOMAIN_CONCURRENCY):
+            if domain_timings is None:
+                skipped += 1
+                continue
+            timings.merge(domain_timings)
+            if inventory is not None:
+                all_instance_attributes[domain], all_devices[domain] = \
+                    inventory
+        if skipped:
+            _out_of_time(logger, timings, "attributes", skipped)
 
-def cleanup_host(host):
-    """
-    This function takes care of hosts that are in zabbix but no longer exist
-    in openstack.
-    If the host was not updated in a configurable amount of time, then we delete it.
+    # 2. Create, enable or regroup the hosts in zabbix in bulk.
+    desired = {}
+    if provision:
+        desired = dict(
+            (domain, get_desired_groups(attributes))
+            for domain, attributes in all_instance_attributes.items()
+            if "provision" in all_tiers[domain])
+    provisioned = False
+    created = set()
+    if desired:
+        try:
+            with timings.phase("provision"):
+                plan = provision_hosts(zabbix_api, desired)
+            created.update(plan.hosts_to_create)
+            for domain in plan.hosts_to_create:
+                logger.info("Created new instance: %s", domain)
+            logger.info("Enabled %d and regrouped %d instances",
+                        len(plan.hosts_to_enable), len(plan.hosts_to_regroup))
+            provisioned = True
+        except ZabbixAPIException as error:
+            logger.error("Zabbix API error")
+            logger.exception(error)
+    if not provisioned:
+        for tiers in all_tiers.values():
+            tiers.discard("provision")
+
+    change_filter = None
+    if CHANGE_ONLY:
+        change_filter_path = os.path.join(STATE_DIR, host + ".sent.json")
+        change_filter = ChangeFilter.load(
+            change_filter_path, CHANGE_ONLY_KEYS, CHANGE_REFRESH_INTERVAL)
+
+    rate_calculator = None
+    if RATES:
+        rate_calculator_path = os.path.join(STATE_DIR, host + ".rates.json")
+        rate_calculator = RateCalculator.load(
+            rate_calculator_path, RATE_MAX_INTERVAL)
+    rollups = Rollups() if ROLLUPS else None
+
+    # 3. Send the metrics.
+    rediscover = set()
+
+    def metrics_task(domain):
+        """Return the domain, its metrics (None if they couldn't be
+        gathered), rate state, rollups and the `Timings` of gathering them
+        (None if the host ran out of time).
+
+        A domain gets its own rate state and rollups, which are only kept if
+        it finishes: domains may be gathered at the same time, and one that
+        times out keeps running in its thread."""
+        if deadline.expired():
+            return domain, None, None, None, None
+        domain_timings = Timings()
+        domain_rates = None
+        if rate_calculator is not None:
+            domain_rates = rate_calculator.select(domain)
+        domain_rollups = Rollups() if rollups is not None else None
+        try:
+            with domain_timings.phase("metrics"):
+                metrics = deadline.run(
+                    get_instance_metrics, domain, libvirt_connection,
+                    all_domain_stats.get(domain),
+                    all_instance_attributes[domain], domain_rates,
+                    domain_rollups, all_tiers[domain], all_devices[domain],
+                    timeout=DOMAIN_TIMEOUT)
+            return domain, metrics, domain_rates, domain_rollups, \
+                domain_timings
+        except DomainNotFoundError as error:
+            logger.error("Domain %s not found", domain)
+            logger.exception(error)
+        except DeadlineExceeded as error:
+            logger.error("Timed out getting the metrics of domain %s",
+                         domain)
+            logger.exception(error)
+        except libvirt.libvirtError as error:
+            # Most likely a device detached since the devices were
+            # discovered, which the bulk stats didn't catch (see
+            # `has_stale_devices`), so they are discovered again.
+            logger.error("Failed to get the metrics of domain %s", domain)
+            logger.exception(error)
+            rediscover.add(domain)
+        return domain, None, None, None, domain_timings
+
+    gathered = []
+    with resource_limits.libvirt:
+        skipped = 0
+        for domain, metrics, domain_rates, domain_rollups, domain_timings \
+                in map_concurrently(metrics_task,
+                                    list(all_instance_attributes),
+                                    DOMAIN_CONCURRENCY):
+            if domain_timings is None:
+                skipped += 1
+                continue
+            timings.merge(domain_timings)
+            if metrics is None:
+                continue
+            gathered.append(domain)
+            if domain_rates is not None:
+                rate_calculator.merge(domain_rates)
+            if domain_rollups is not None:
+                rollups.merge(domain_rollups)
+            if change_filter is not None:
+                metrics = change_filter.filter(metrics)
+            host_sender.add(metrics)
+            logger.info("Domain %s is updated", domain)
+        if skipped:
+            _out_of_time(logger, timings, "metrics", skipped)
+
+    if rate_calculator is not None:
+        rate_calculator.retain(domains)
+        rate_calculator.save(rate_calculator_path)
+
+    # 4. Send what's left of the batched metrics.
+    results = host_sender.flush()
+    for result in results:
+        if result.error is not None:
+            logger.error("Failed to send %d values: %s",
+                         result.total, result.error)
+        else:
+            logger.info("Sent batch: processed %d, failed %d, total %d",
+                        result.processed, result.failed, result.total)
+
+    # Values in a failed batch may have been lost, and zabbix refuses the
+    # values of hosts that aren't in its configuration cache yet, like the
+    # ones just created. Only the hosts all of whose values were accepted
+    # are confirmed, new hosts the earliest in the next cycle.
+    unconfirmed = set(created)
+    for result in results:
+        if result.error is not None or result.failed:
+            unconfirmed.update(result.hosts)
+
+    if change_filter is not None:
+        change_filter.commit(exclude=unconfirmed)
+        change_filter.retain(domains)
+        change_filter.save(change_filter_path)
+
+    # Likewise the tiers of unconfirmed hosts run again in the next cycle,
+    # except for the provisioning, which doesn't depend on the values.
+    if schedule is not None:
+        for domain in rediscover:
+            schedule.forget(domain, "devices")
+        for domain in gathered:
+            tiers = all_tiers[domain]
+            if domain in unconfirmed:
+                tiers = tiers.intersection(["provision"])
+            schedule.ran(domain, tiers, now, all_instance_attributes[domain],
+                         all_devices[domain])
+        schedule.retain(domains)
+        schedule.save(schedule_path)
+    return domains, rollups
+
+
+def _out_of_time(logger, timings, phase, skipped):
+    """Log and count that HOST_TIMEOUT passed during `phase`, with
+    `skipped` domains left"""
+    logger.error("Host ran out of time, skipping %s of %d domains",
+                 phase, skipped)
+    timings.timeout(phase)
+
+
+def handle_lifecycle_events(to_provision, to_disable):
+    """Create or enable the hosts of defined or started domains, and disable
+    the hosts of undefined domains.
+
+    to_provision: dictionary of domain uuid to its `LibvirtConnection`
+    to_disable: list of domain uuids
     """
+    desired = {}
+    # A burst of events mustn't get past the cap on libvirt calls.
+    with resource_limits.libvirt:
+        for domain, libvirt_connection in to_provision.items():
+            try:
+                desired[domain] = get_desired_groups(
+                    libvirt_connection.get_misc_attributes(domain))
+            except DomainNotFoundError:
+                # Gone again already, the full scan will clean it up.
+                continue
 
-    # This can be any arbritary item that we know exists and is generally updated.
-    item_key = "libvirt.instance[name]"
-    retention_period = 90 * 24 * 60 * 60
-    print("Deciding what to do with: " + host)
+    if desired:
+        plan = provision_hosts(worker_zabbix_api, desired)
+        main_logger.info("Events: created %d and enabled %d instances",
+                         len(plan.hosts_to_create), len(plan.hosts_to_enable))
 
-    with ZabbixConnection(USER, "https://" + ZABBIX_SERVER, PASSWORD) as zabbix_api:
-        host_id = zabbix_api.get_host_id(host)
-        assert host_id is not None, "Host ID is none for: " + host
-        lastclock = zabbix_api.get_history(
-            host_id, item_key, item_type=CHARACTER, item_attribute="clock")
+    if to_disable:
+        with resource_limits.zabbix_api:
+            hostids = [host["hostid"]
+                       for host in worker_zabbix_api.get_hosts(to_disable)
+                       if host["status"] != DISABLE_HOST]
+            if hostids:
+                worker_zabbix_api.set_hosts_status(hostids, DISABLE_HOST)
+        main_logger.info("Events: disabled %d instances", len(hostids))
 
-    if lastclock is None:
-        main_logger.warning("Host '%s' has no lastclock", host)
-        return {"host_id": host_id, "action": "disable"}
 
-    if int(time.time()) - int(lastclock) > retention_period:
-        main_logger.info("Staging host  '%s' to be deleted", host)
-        return {"host_id": host_id, "action": "delete"}
-    elif int(time.time()) - int(lastclock) > 60 * 60:
-        # Disable instance if not detected for an hour
-        return {"host_id": host_id, "action": "disable"}
+def make_sender():
+    """Return the zabbix sender configured in the config file"""
+    custom_wrapper = None
+    if SENDER_TLS_PSK:
+        custom_wrapper = functools.partial(
+            PyZabbixPSKSocketWrapper, identity=PSK_IDENTITY, psk=bytes(bytearray.fromhex(PSK)))
+    settings = dict(
+        zabbix_server=ZABBIX_SERVER, zabbix_port=SENDER_PORT,
+        socket_wrapper=custom_wrapper, timeout=30,
+        batch_size=SENDER_BATCH_SIZE, max_batch_bytes=SENDER_MAX_BATCH_BYTES,
+        compress=SENDER_COMPRESSION, limit=resource_limits.trapper,
+        spool=spool)
+    if SENDER_WORKERS > 0:
+        return PipelinedZabbixSender(
+            workers=SENDER_WORKERS, queue_size=SENDER_QUEUE_SIZE, **settings)
+    return BatchingZabbixSender(**settings)
 
-    return {"host_id": host_id, "action": "disable"}
 
+def make_directory(path):
+    """Create the directory `path` and its parents, unless it exists. Runs
+    started at the same time may race to create it."""
+    try:
+        os.makedirs(path)
+    except OSError as error:
+        if error.errno != errno.EEXIST:
+            raise
 
-def main():
-    """main I guess"""
+
+def setup_workers(backend):
+    """Create the objects shared by all workers. This has to happen before
+    the pools are created, so process workers inherit them.
+
+    This includes the zabbix API session, so a run logs in at most once
+    (and not at all while the cached token is valid)."""
+    global resource_limits, zabbix_sender, zabbix_session, spool, shard_store
+    global last_seen
+    global worker_zabbix_api, worker_templateid, worker_rollup_templateid
+    resource_limits = ResourceLimits(
+        backend, LIBVIRT_CONCURRENCY, ZABBIX_API_CONCURRENCY,
+        TRAPPER_CONCURRENCY)
+    if SPOOL:
+        spool = Spool(SPOOL_DIR, SPOOL_MAX_BYTES, SPOOL_SEGMENT_BYTES,
+                      main_logger)
+    zabbix_sender = make_sender()
+    if PROFILE_DIR:
+        make_directory(PROFILE_DIR)
+    make_directory(STATE_DIR)
+    ledger_path = SHARD_STORE if SHARD_NODES else LEDGER
+    if os.path.dirname(ledger_path):
+        make_directory(os.path.dirname(ledger_path))
+    if SHARD_NODES:
+        shard_store = last_seen = ShardStore(SHARD_STORE)
+    else:
+        last_seen = LastSeenLedger(LEDGER)
+
+    token_cache = None
+    if TOKEN_CACHE:
+        token_cache = TokenCache(TOKEN_CACHE, TOKEN_TTL)
+    zabbix_session = ZabbixSession(
+        API_URL, USER, PASSWORD, token_cache=token_cache,
+        timeout=API_TIMEOUT)
+    worker_zabbix_api = ZabbixConnection(session=zabbix_session)
+    worker_templateid = worker_zabbix_api.get_template_id(TEMPLATE_NAME)
+    if ROLLUPS:
+        worker_rollup_templateid = worker_zabbix_api.get_template_id(
+            ROLLUP_TEMPLATE_NAME)
+
+
+def end_zabbix_session():
+    """Log out, unless the session is cached for the next run"""
+    if zabbix_session.token_cache is None:
+        zabbix_session.logout()
+    else:
+        zabbix_session.close()
+
+
+def get_shard_hosts():
+    """Return the hosts in HOSTS_FILE this node collects, all of them
+    unless shard mode is on"""
     host_list = get_hosts(HOSTS_FILE)
+    if SHARD_NODES:
+        host_list = shard_hosts(host_list, SHARD_NODE, SHARD_NODES)
+    return host_list
 
-    all_openstack_instances = []
-    p = Pool(min(MAX_PROCESSES, len(host_list)))
 
-    custom_wrapper = functools.partial(
-        PyZabbixPSKSocketWrapper, identity=PSK_IDENTITY, psk=bytes(bytearray.fromhex(PSK)))
-    zabbix_sender = ZabbixSender(
-        zabbix_server=ZABBIX_SERVER, socket_wrapper=custom_wrapper, timeout=30)
+def record_run(started, all_openstack_instances):
+    """Record the domains found by a run that started at `started` in the
+    last-seen ledger, and return whether the cleanup can run.
+
+    In shard mode it can't if some node hasn't finished a run in the last
+    SHARD_MAX_AGE seconds, the domains of its hosts would look gone."""
+    if shard_store is None:
+        last_seen.record(SHARD_NODE, all_openstack_instances, time.time())
+        return True
+
+    shard_store.record_run(SHARD_NODE, started, all_openstack_instances)
+    stale_nodes = shard_store.stale_nodes(SHARD_NODES, SHARD_MAX_AGE)
+    if stale_nodes:
+        main_logger.warning("No recent run of shards %s, not cleaning up",
+                            ", ".join(stale_nodes))
+        return False
+    return True
+
+
+def collect(pool, host_list, timings, libvirt_connections=None,
+            provision=True):
+    """Process all hosts in `host_list` with `pool`, and send the rollups
+    of all of them. The `Timings` of the hosts are merged into `timings`.
+
+    With CYCLE_TIMEOUT set, hosts that aren't done by then are abandoned
+    and counted as unreachable. A host still running from an earlier run
+    isn't processed again until it is done.
+
+    Returns the uuids of all domains found."""
+    all_openstack_instances = []
+    rollups = Rollups()
+    deadline = Deadline(CYCLE_TIMEOUT)
+    started = timeit.default_timer()
 
     custom_process_host = functools.partial(
-        process_host, zabbix_sender=zabbix_sender)
+        process_host, libvirt_connections=libvirt_connections,
+        provision=provision)
 
-    results = filter(None, p.map(custom_process_host, host_list))
+    for host, async_result in list(straggling.items()):
+        if async_result.ready():
+            del straggling[host]
+    pending = []
+    for host in host_list:
+        if host in straggling:
+            main_logger.error("Host %s is still being processed by an "
+                              "earlier run, skipping it", host)
+            _abandon_host(timings, host, 0.0)
+            continue
+        pending.append(
+            (host, pool.apply_async(custom_process_host, (host,))))
+
+    results = []
+    for host, async_result in pending:
+        try:
+            results.append(async_result.get(deadline.remaining()))
+        except multiprocessing.TimeoutError:
+            main_logger.error("Host %s took longer than %ss, abandoning it",
+                              host, CYCLE_TIMEOUT)
+            straggling[host] = async_result
+            _abandon_host(timings, host, timeit.default_timer() - started)
     print("Processed all host")
 
     for result in results:
-        all_openstack_instances.extend(result)
+        timings.merge(result.timings)
+        if result.domains is None:
+            continue
+        all_openstack_instances.extend(result.domains)
+        if result.rollups is not None:
+            rollups.merge(result.rollups)
+
+    if ROLLUPS:
+        if shard_store is not None:
+            rollups = merge_shard_rollups(rollups)
+        try:
+            send_rollups(rollups, provision)
+        except ZabbixAPIException as error:
+            main_logger.error("Zabbix API error while creating rollup hosts")
+            main_logger.exception(error)
+    if spool is not None:
+        replay_spool()
+    return all_openstack_instances
 
-    with ZabbixConnection(USER, "https://" + ZABBIX_SERVER, PASSWORD) as zapi:
-        openstack_group_id = zapi.get_group_id(GROUP_NAME)
-        all_zabbix_hosts = zapi.get_all_hosts([openstack_group_id])
 
-        hosts_not_in_openstack = list(
-            set(all_zabbix_hosts) - set(all_openstack_instances))
+def _abandon_host(timings, host, seconds):
+    """Count `host` as abandoned after `seconds` in `timings`, and as a
+    failure of its circuit breaker"""
+    summary = None
+    if CIRCUIT_BREAKER:
+        summary = update_health(host, False)
+    host_timings = Timings()
+    host_timings.timeout("host")
+    host_timings.add_hypervisor(host, seconds, 0, reachable=False,
+                                health=summary)
+    timings.merge(host_timings)
 
-        p = Pool(min(MAX_PROCESSES, len(hosts_not_in_openstack)))
 
-        lockfile = "/tmp/openstack-monitoring.lockfile"
+def send_timings(timings, seconds):
+    """Log the `Timings` of a run that took `seconds`, and send them to
+    COLLECTOR_HOST"""
+    main_logger.info("Run took %.3fs: %s", seconds, timings.summary())
+    if not COLLECTOR_HOST:
+        return
 
-        if os.path.exists(lockfile):
-            main_logger.info("lockfile exists, quitting")
-            sys.exit(0)
+    sender = zabbix_sender.clone()
+    sender.add(timings.metrics(COLLECTOR_HOST, seconds, int(time.time())))
+    for result in sender.flush():
+        if result.error is not None:
+            main_logger.error("Failed to send %d collector values: %s",
+                              result.total, result.error)
 
-        # only execute once/twice every hour.
-        if not (10 < datetime.now().minute < 17):
-            main_logger.info("not the right time to cleanup, quitting")
-            sys.exit(0)
 
-        open(lockfile, "w").close()
+def replay_spool():
+    """Send the values spooled while the trapper was unreachable, and report
+    the depth of the spool on COLLECTOR_HOST"""
+    sender = zabbix_sender.clone()
+    sender.spool = None
+    replayed = spool.replay(sender)
+    size, segments = spool.depth()
+    main_logger.info("Replayed %d spooled values, %d bytes in %d segments "
+                     "left", replayed, size, segments)
 
+    if COLLECTOR_HOST:
+        clock = int(time.time())
+        sender.send([
+            Metric(COLLECTOR_HOST, item_key("spool", "bytes"), size, clock),
+            Metric(COLLECTOR_HOST, item_key("spool", "segments"), segments,
+                   clock)])
+
+
+def merge_shard_rollups(rollups):
+    """Return `rollups` with the project totals of all shard nodes.
+
+    A node only has the instances of its own hypervisors, and a project's
+    may be on any, so the nodes share their project totals through the
+    shard store and every node sends the sum. While some node has no recent
+    totals the sum would be too low, then no project totals are sent."""
+    prefix = ROLLUP_HOSTS["project_uuid"]
+    projects = dict((host, values) for host, values in rollups.totals.items()
+                    if host.startswith(prefix))
+    merged = Rollups(dict((host, values)
+                          for host, values in rollups.totals.items()
+                          if not host.startswith(prefix)))
+    shard_store.record_rollups(SHARD_NODE, projects)
+    totals, stale_nodes = shard_store.rollups(SHARD_NODES, SHARD_MAX_AGE)
+    if stale_nodes:
+        main_logger.warning("No recent rollups of shards %s, not sending "
+                            "the project rollups", ", ".join(stale_nodes))
+        return merged
+    for node_totals in totals.values():
+        merged.merge(Rollups(node_totals))
+    return merged
+
+
+def send_rollups(rollups, provision=True):
+    """Send `rollups` in one batch, creating their hosts first if
+    `provision` is set"""
+    if provision:
+        desired = dict((host, [ROLLUP_GROUP_NAME]) for host in rollups.totals)
+        plan = provision_hosts(
+            worker_zabbix_api, desired, worker_rollup_templateid)
+        main_logger.info("Created %d rollup hosts", len(plan.hosts_to_create))
+
+    sender = zabbix_sender.clone()
+    sender.add(rollups.metrics(int(time.time())))
+    for result in sender.flush():
+        if result.error is not None:
+            main_logger.error("Failed to send %d rollup values: %s",
+                              result.total, result.error)
+
+
+def lock_file(path, wait=False):
+    """Return `path` opened and exclusively locked, or None if another process
+    holds the lock (with `wait`, wait for it instead). It's released when the
+    file is closed, or the process exits, so a crashed run doesn't leave it
+    behind."""
+    lock = open(path, "a")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX if wait else
+                    fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError) as e:
+        lock.close()
+        if e.errno in (errno.EACCES, errno.EAGAIN):
+            return None
+        raise
+    return lock
+
+
+def cleanup(timings):
+    """
+    This function takes care of hosts that are in zabbix but no longer exist
+    in openstack. It's timed as the "cleanup" phase of `timings`.
+
+    Hosts of domains not seen for DISABLE_AFTER seconds are disabled, and
+    deleted after RETENTION_PERIOD seconds. When the domains were last seen
+    is kept in the last-seen ledger, which marks the ones disabled, so every
+    run only looks up the hosts of the domains that went stale since the
+    last one.
+    """
+    # Runs overlapping on this node (e.g. cron starting the next one before
+    # this one is done) must not disable or delete the same hosts.
+    lock = lock_file(os.path.join(STATE_DIR, "cleanup.lock"))
+    if lock is None:
+        main_logger.info("another run cleans up, quitting")
+        return
+    try:
+        with timings.phase("cleanup"), \
+                ZabbixConnection(session=zabbix_session) as zapi:
+            # In shard mode only one node cleans up at a time.
+            if shard_store is not None and not shard_store.claim(
+                    "cleanup", SHARD_NODE, SHARD_CLEANUP_INTERVAL):
+                main_logger.info("another shard cleans up, quitting")
+                return
+            remove_stale_hosts(zapi)
+    finally:
+        lock.close()
+
+
+def remove_stale_hosts(zapi):
+    """Disable and delete the hosts of the stale domains of the last-seen
+    ledger, see `cleanup`"""
+    now = time.time()
+    openstack_group_id = zapi.get_group_id(GROUP_NAME)
+    if not last_seen.imported():
+        # Hosts created before the ledger existed are counted from now.
+        last_seen.import_domains(
+            SHARD_NODE, [host["host"] for host in
+                         zapi.get_hosts(groupids=[openstack_group_id])],
+            now)
+
+    disable_before = now - DISABLE_AFTER
+    delete_before = now - RETENTION_PERIOD
+    stale = last_seen.stale(disable_before, delete_before)
+    if not stale:
+        return
+
+    main_logger.info("Starting cleanup tasks")
+    hosts = zapi.get_hosts(groupids=[openstack_group_id],
+                           host_names=list(stale))
+    lastclocks = dict((host["hostid"], stale[host["host"]])
+                      for host in hosts)
+    plan = plan_cleanup(hosts, lastclocks, now, DISABLE_AFTER,
+                        RETENTION_PERIOD)
+    if plan.hosts_to_disable:
+        zapi.set_hosts_status(plan.hosts_to_disable, DISABLE_HOST)
+    if plan.hosts_to_delete:
+        zapi.delete_hosts(plan.hosts_to_delete)
+    last_seen.mark_disabled(stale, disable_before)
+    last_seen.prune(delete_before)
+    main_logger.info("Hosts not in openstack: %d", len(stale))
+    main_logger.info("Hosts disabled: %d", len(plan.hosts_to_disable))
+    main_logger.info("Hosts deleted: %d", len(plan.hosts_to_delete))
+
+
+def main():
+    """main I guess"""
+    started = timeit.default_timer()
+    run_started = time.time()
+    host_list = get_shard_hosts()
+
+    setup_workers(BACKEND)
+    p = make_pool(BACKEND, min(MAX_WORKERS, len(host_list)))
+    timings = Timings()
+    all_openstack_instances = collect(p, host_list, timings)
+    if straggling:
+        # Don't wait for the abandoned hosts on exit.
+        p.terminate()
+    else:
+        p.close()
+
+    try:
+        if record_run(run_started, all_openstack_instances):
+            cleanup(timings)
+    finally:
         try:
-            main_logger.info("Starting cleanup tasks")
-            results = filter(None, p.map(cleanup_host, hosts_not_in_openstack))
-            print("Clean up processes finished")
-            # FIXME: the list comprehensions are really slow, since we
-            # iterate over a lot of items.
-            hosts_to_be_deleted = [result["host_id"]
-                                   for result in results if result["action"] == "delete"]
-            hosts_to_be_disabled = [result["host_id"]
-                                    for result in results if result["action"] == "disable"]
-            if hosts_to_be_disabled != []:
-                zapi.set_hosts_status(hosts_to_be_disabled, DISABLE_HOST)
-            if hosts_to_be_deleted != []:
-                zapi.delete_hosts(hosts_to_be_deleted)
-            print("Hosts not in openstack:" + str(len(hosts_not_in_openstack)))
-            print("hosts_disabled:" + str(len(hosts_to_be_disabled)))
-            print("hosts_deleted:" + str(len(hosts_to_be_deleted)))
+            send_timings(timings, timeit.default_timer() - started)
         finally:
-            os.remove(lockfile)
+            end_zabbix_session()
+
+
+def run_daemon():
+    """Run `main` every DAEMON_INTERVAL seconds, keeping the libvirt
+    connections open in between."""
+    # libvirt connections can't be shared with other processes, so the hosts
+    # are always processed by threads of this process.
+    setup_workers("thread")
+    pool = make_pool("thread", MAX_WORKERS)
+
+    # With events, hosts are provisioned as domains come and go, and the full
+    # provisioning scan only runs every FULL_SCAN_INTERVAL seconds to catch
+    # anything missed.
+    dispatcher = None
+    if EVENTS:
+        dispatcher = LifecycleEventDispatcher(
+            handle_lifecycle_events, EVENTS_BATCH_DELAY, main_logger)
+        dispatcher.start()
+    last_full_scan = [0]
+
+    libvirt_connections = LibvirtConnectionCache(
+        keepalive=(KEEPALIVE_INTERVAL, KEEPALIVE_COUNT),
+        max_backoff=MAX_BACKOFF, lifecycle_callback=dispatcher)
+    scheduler = IntervalScheduler(DAEMON_INTERVAL, main_logger)
+    signal.signal(signal.SIGTERM, lambda signum, frame: scheduler.stop())
+
+    def run():
+        """Run one collection cycle"""
+        try:
+            started = time.time()
+            full_scan = dispatcher is None or \
+                started - last_full_scan[0] >= FULL_SCAN_INTERVAL
+            timings = Timings()
+            # The hosts file is read again every time, so hosts can be added
+            # without restarting.
+            host_list = get_shard_hosts()
+            all_openstack_instances = collect(
+                pool, host_list, timings, libvirt_connections,
+                provision=full_scan)
+            if full_scan:
+                last_full_scan[0] = started
+            if record_run(started, all_openstack_instances):
+                cleanup(timings)
+            send_timings(timings, time.time() - started)
+        except Exception as error:
+            # Keep the daemon running, the next cycle may succeed.
+            main_logger.exception(error)
+
+    try:
+        scheduler.run(run)
+    finally:
+        if dispatcher is not None:
+            dispatcher.stop()
+        pool.close()
+        libvirt_connections.close_all()
+        end_zabbix_session()
 
 
 if __name__ == "__main__":
-    load_config()
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--daemon", action="store_true",
+                        help="keep running and collect every INTERVAL seconds")
+    parser.add_argument("--config", default=CONFIG_FILE,
+                        help="config file (default: %(default)s)")
+    args = parser.parse_args()
+
+    load_config(args.config)
     USER = config['general']['API_USER']
     PASSWORD = config['general']['PASSWORD']
     ZABBIX_SERVER = config['general']['ZABBIX_SERVER']
@@ -250,8 +1142,94 @@ if __name__ == "__main__":
     PSK_IDENTITY = config['general']['PSK_IDENTITY']
     HOSTS_FILE = config['general']['HOSTS_FILE']
     KEY_FILE = config['general']['KEY_FILE']
+    COLLECTOR_HOST = config.get('general', 'HOST_IN_ZABBIX', fallback='')
+    BULK_STATS = config.getboolean('general', 'BULK_STATS', fallback=True)
+    API_URL = config.get(
+        'zabbix_api', 'URL', fallback="https://" + ZABBIX_SERVER)
+    TOKEN_CACHE = config.get('zabbix_api', 'TOKEN_CACHE', fallback='')
+    TOKEN_TTL = config.getint('zabbix_api', 'TOKEN_TTL', fallback=60 * 60)
+    API_TIMEOUT = config.getint('zabbix_api', 'TIMEOUT', fallback=30)
+    SENDER_PORT = config.getint('sender', 'PORT', fallback=10051)
+    SENDER_TLS_PSK = config.getboolean('sender', 'TLS_PSK', fallback=True)
+    SENDER_BATCH_SIZE = config.getint('sender', 'BATCH_SIZE', fallback=1000)
+    SENDER_MAX_BATCH_BYTES = config.getint(
+        'sender', 'MAX_BATCH_BYTES', fallback=2**20)
+    SENDER_COMPRESSION = config.getboolean(
+        'sender', 'COMPRESSION', fallback=True)
+    SENDER_WORKERS = config.getint('sender', 'WORKERS', fallback=0)
+    SENDER_QUEUE_SIZE = config.getint('sender', 'QUEUE_SIZE', fallback=4)
     GROUP_NAME = "openstack-instances"
     TEMPLATE_NAME = "moc_libvirt_single"
-    MAX_PROCESSES = 64
+    ROLLUP_GROUP_NAME = "openstack-rollups"
+    ROLLUP_TEMPLATE_NAME = "moc_libvirt_rollup"
+    STATE_DIR = config.get(
+        'general', 'STATE_DIR', fallback='/var/lib/zabbix-libvirt')
+    CHANGE_ONLY = config.getboolean('change_only', 'ENABLED', fallback=False)
+    CHANGE_REFRESH_INTERVAL = config.getint(
+        'change_only', 'REFRESH_INTERVAL', fallback=6 * 60 * 60)
+    BACKEND = config.get('workers', 'BACKEND', fallback='process')
+    MAX_WORKERS = config.getint('workers', 'MAX_WORKERS', fallback=64)
+    LIBVIRT_CONCURRENCY = config.getint(
+        'workers', 'LIBVIRT_CONCURRENCY', fallback=MAX_WORKERS)
+    ZABBIX_API_CONCURRENCY = config.getint(
+        'workers', 'ZABBIX_API_CONCURRENCY', fallback=8)
+    DOMAIN_CONCURRENCY = config.getint(
+        'workers', 'DOMAIN_CONCURRENCY', fallback=1)
+    TRAPPER_CONCURRENCY = config.getint(
+        'workers', 'TRAPPER_CONCURRENCY', fallback=4)
+    DAEMON_INTERVAL = config.getint('daemon', 'INTERVAL', fallback=60)
+    KEEPALIVE_INTERVAL = config.getint(
+        'daemon', 'KEEPALIVE_INTERVAL', fallback=5)
+    KEEPALIVE_COUNT = config.getint('daemon', 'KEEPALIVE_COUNT', fallback=3)
+    MAX_BACKOFF = config.getint('daemon', 'MAX_BACKOFF', fallback=300)
+    DISABLE_AFTER = config.getint('cleanup', 'DISABLE_AFTER', fallback=60 * 60)
+    RETENTION_PERIOD = config.getint(
+        'cleanup', 'RETENTION_PERIOD', fallback=90 * 24 * 60 * 60)
+    LEDGER = config.get(
+        'cleanup', 'LEDGER', fallback=os.path.join(STATE_DIR, 'ledger.sqlite'))
+    RATES = config.getboolean('rates', 'ENABLED', fallback=False)
+    SEND_COUNTERS = config.getboolean('rates', 'SEND_COUNTERS', fallback=True)
+    RATE_MAX_INTERVAL = config.getint('rates', 'MAX_INTERVAL', fallback=15 * 60)
+    ROLLUPS = config.getboolean('rollups', 'ENABLED', fallback=False)
+    SPOOL = config.getboolean('spool', 'ENABLED', fallback=False)
+    SPOOL_DIR = config.get(
+        'spool', 'DIRECTORY', fallback=os.path.join(STATE_DIR, 'spool'))
+    SPOOL_MAX_BYTES = config.getint('spool', 'MAX_BYTES', fallback=256 * 2**20)
+    SPOOL_SEGMENT_BYTES = config.getint(
+        'spool', 'SEGMENT_BYTES', fallback=2**20)
+    PROFILE_DIR = config.get('instrumentation', 'PROFILE_DIR', fallback='')
+    CIRCUIT_BREAKER = config.getboolean(
+        'circuit_breaker', 'ENABLED', fallback=False)
+    CIRCUIT_THRESHOLD = config.getint(
+        'circuit_breaker', 'THRESHOLD', fallback=2)
+    CIRCUIT_MIN_BACKOFF = config.getint(
+        'circuit_breaker', 'MIN_BACKOFF', fallback=5 * 60)
+    CIRCUIT_MAX_BACKOFF = config.getint(
+        'circuit_breaker', 'MAX_BACKOFF', fallback=60 * 60)
+    TIER_INTERVALS = dict(
+        (tier, config.getint('tiers', tier.upper(), fallback=0))
+        for tier in TIERS)
+    TIERED = any(TIER_INTERVALS.values())
+    HOST_TIMEOUT = config.getfloat('deadlines', 'HOST_TIMEOUT', fallback=0)
+    DOMAIN_TIMEOUT = config.getfloat('deadlines', 'DOMAIN_TIMEOUT', fallback=0)
+    CYCLE_TIMEOUT = config.getfloat('deadlines', 'CYCLE_TIMEOUT', fallback=0)
+    SHARD_NODES = [node.strip() for node in
+                   config.get('shard', 'NODES', fallback='').split(',')
+                   if node.strip()]
+    SHARD_NODE = config.get('shard', 'NODE', fallback=socket.gethostname())
+    SHARD_STORE = config.get(
+        'shard', 'STORE', fallback=os.path.join(STATE_DIR, 'shards.sqlite'))
+    SHARD_MAX_AGE = config.getint('shard', 'MAX_AGE', fallback=60 * 60)
+    SHARD_CLEANUP_INTERVAL = config.getint(
+        'shard', 'CLEANUP_INTERVAL', fallback=60)
+    if SHARD_NODES and SHARD_NODE not in SHARD_NODES:
+        parser.error("shard NODE {} is not one of NODES".format(SHARD_NODE))
+    EVENTS = config.getboolean('events', 'ENABLED', fallback=False)
+    EVENTS_BATCH_DELAY = config.getint('events', 'BATCH_DELAY', fallback=2)
+    FULL_SCAN_INTERVAL = config.getint(
+        'events', 'FULL_SCAN_INTERVAL', fallback=15 * 60)
     main_logger = setup_logging(__name__, LOG_DIR + "/main.log")
-    main()
+    if args.daemon:
+        run_daemon()
+    else:
+        main()
@@ -0,0 +1,112 @@
+"""
+This file holds the calculation of rates (cpu utilization, IOPS, bytes and
+packets per second) from the cumulative counters libvirt reports, so zabbix
+doesn't have to compute them with preprocessing.
+"""
+
+import json
+import os
+
+# Counter -> rate item, per item type. The counters are the keys returned by
+# `LibvirtConnection.get_diskio` and `LibvirtConnection.get_ifaceio`.
+RATE_ITEMS = {
+    "disk": {"rd_operations": "rd_iops",
+             "wr_operations": "wr_iops",
+             "rd_bytes": "rd_bytes_per_second",
+             "wr_bytes": "wr_bytes_per_second"},
+    "nic": {"read": "read_bytes_per_second",
+            "write": "write_bytes_per_second",
+            "read_packets": "read_packets_per_second",
+            "write_packets": "write_packets_per_second"},
+}
+
+
+class RateCalculator(object):
+    """Keeps the previous sample of the counters of every domain, and turns
+    new samples into per second rates.
+
+    A counter only gets a rate once it has a previous sample. Counters that
+    went down (the domain was restarted, or a device replaced) start over
+    from the new sample instead of giving a negative rate, and so do all
+    counters of a domain whose previous sample is more than `max_interval`
+    seconds old.
+
+    The counters of a domain are sampled in groups (e.g. the collection
+    tiers "cpu", "disk" and "nic"), which may be sampled at different times.
+    """
+
+    def __init__(self, max_interval=None, state=None):
+        self.max_interval = max_interval
+        # domain -> {group: [timestamp, {counter: value}]}
+        self.state = state if state is not None else {}
+
+    @classmethod
+    def load(cls, path, max_interval=None):
+        """Load the previous samples from the state file at `path`, if it
+        exists"""
+        try:
+            with open(path) as state_file:
+                state = json.load(state_file)
+        except (IOError, ValueError):
+            state = {}
+        # Samples saved before the counters were grouped start over.
+        state = dict((domain, groups) for domain, groups in state.items()
+                     if isinstance(groups, dict))
+        return cls(max_interval, state)
+
+    def save(self, path):
+        """Write the samples to the state file at `path`"""
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "w") as state_file:
+            json.dump(self.state, state_file, separators=(",", ":"))
+        os.rename(temporary_path, path)
+
+    def update(self, domain, timestamp, counters, group="all"):
+        """Record `counters` (a dictionary of counter to value) of `domain`
+        in `group` sampled at `timestamp`.
+
+        Returns a dictionary of counter to its rate per second since the
+        previous sample of the group."""
+        groups = self.state.setdefault(domain, {})
+        previous = groups.get(group)
+        groups[group] = [timestamp, counters]
+        if previous is None:
+            return {}
+
+        elapsed = timestamp - previous[0]
+        if elapsed <= 0 or \
+                (self.max_interval is not None and elapsed > self.max_interval):
+            return {}
+
+        rates = {}
+        for counter, value in counters.items():
+            last = previous[1].get(counter)
+            if last is None or value < last:
+                continue
+            rates[counter] = (value - last) / float(elapsed)
+        return rates
+
+    def select(self, domain):
+        """Return a `RateCalculator` with only the previous sample of
+        `domain`, to update it apart from the other domains (see `merge`)"""
+        state = {}
+        if domain in self.state:
+            state[domain] = dict(self.state[domain])
+        return RateCalculator(self.max_interval, state)
+
+    def merge(self, other):
+        """Take the samples of the `RateCalculator` `other`"""
+        self.state.update(other.state)
+
+    def retain(self, domains):
+        """Drop the samples of domains not in `domains`"""
+        domains = set(domains)
+        for domain in list(self.state):
+            if domain not in domains:
+                del self.state[domain]
+
+
+def cpu_utilization(cpu_time_rate):
+    """Return the cpu utilization in percent for the rate of the per core
+    cpu time (nanoseconds per second)"""
+    return min(100.0, max(0.0, cpu_time_rate / 10 ** 7))
@@ -0,0 +1,217 @@
+"""
+This file holds an in-memory snapshot of the hosts and host groups in zabbix,
+the reconciler that brings zabbix in line with the discovered domains using
+bulk API requests, and the cleanup planning for hosts whose domains are gone.
+"""
+
+import collections
+
+from pyzabbix.api import ZabbixAPIException
+
+from zabbix_methods import ENABLE_HOST, DISABLE_HOST
+
+ReconcilePlan = collections.namedtuple(
+    "ReconcilePlan",
+    ["groups_to_create", "hosts_to_create", "hosts_to_enable",
+     "hosts_to_regroup"])
+
+CleanupPlan = collections.namedtuple(
+    "CleanupPlan", ["hosts_to_delete", "hosts_to_disable", "hosts_to_keep"])
+
+
+class ZabbixInventory(object):
+    """Index of zabbix hosts (by name) and host groups (by name) loaded with a
+    few bulk requests."""
+
+    def __init__(self, hosts, groups):
+        """hosts: list of hosts as returned by `ZabbixConnection.get_hosts`
+        groups: dictionary of group name to group id"""
+        self.hosts = {}
+        self.add_hosts(hosts)
+        self.groups = dict(groups)
+
+    def add_hosts(self, hosts):
+        """Add or replace `hosts`, as returned by
+        `ZabbixConnection.get_hosts`"""
+        for host in hosts:
+            self.hosts[host["host"]] = {
+                "hostid": host["hostid"],
+                "status": host["status"],
+                "groupids": set(group["groupid"] for group in host["groups"])}
+
+    @classmethod
+    def load(cls, zabbix_api, host_names=None, group_names=None):
+        """Load the hosts and host groups from zabbix.
+
+        Only the given hosts and groups are loaded if `host_names` or
+        `group_names` are set, everything otherwise."""
+        return cls(zabbix_api.get_hosts(host_names),
+                   zabbix_api.get_hostgroups(group_names))
+
+
+class ZabbixReconciler(object):
+    """Works out what needs to change in zabbix for a set of discovered
+    domains and applies it with batched requests."""
+
+    def __init__(self, inventory, templateid, tls_psk_identity, tls_psk):
+        self.inventory = inventory
+        self.templateid = templateid
+        self.tls_psk_identity = tls_psk_identity
+        self.tls_psk = tls_psk
+
+    def plan(self, desired):
+        """Compare the inventory with the `desired` state.
+
+        desired: dictionary of host name to the names of the groups the host
+        should belong to.
+
+        Hosts are never removed from groups they already belong to; missing
+        groups are added to them.
+        """
+        groups_to_create = set()
+        hosts_to_create = {}
+        hosts_to_enable = []
+        hosts_to_regroup = {}
+
+        for host_name, group_names in desired.items():
+            group_names = set(group_names)
+            groups_to_create.update(
+                name for name in group_names
+                if name not in self.inventory.groups)
+
+            host = self.inventory.hosts.get(host_name)
+            if host is None:
+                hosts_to_create[host_name] = group_names
+                continue
+
+            if host["status"] == DISABLE_HOST:
+                hosts_to_enable.append(host["hostid"])
+
+            known_groupids = set(self.inventory.groups[name]
+                                 for name in group_names
+                                 if name in self.inventory.groups)
+            if not known_groupids <= host["groupids"] or \
+                    len(known_groupids) < len(group_names):
+                hosts_to_regroup[host["hostid"]] = group_names
+
+        return ReconcilePlan(groups_to_create, hosts_to_create,
+                             hosts_to_enable, hosts_to_regroup)
+
+    def apply(self, zabbix_api, plan):
+        """Apply `plan` and update the inventory to match.
+
+        Returns a dictionary of the created host names to their host ids."""
+        if plan.groups_to_create:
+            self.inventory.groups.update(
+                self._create_groups(zabbix_api, plan.groups_to_create))
+
+        created = {}
+        if plan.hosts_to_create:
+            hosts = dict((host_name, self._groupids(group_names))
+                         for host_name, group_names
+                         in plan.hosts_to_create.items())
+            created = self._create_hosts(zabbix_api, hosts)
+            for host_name, hostid in created.items():
+                self.inventory.hosts[host_name] = {
+                    "hostid": hostid, "status": ENABLE_HOST,
+                    "groupids": set(hosts[host_name])}
+
+        if plan.hosts_to_enable:
+            zabbix_api.set_hosts_status(plan.hosts_to_enable, ENABLE_HOST)
+
+        # host.massupdate replaces the groups of all hosts in a request, so
+        # hosts are batched by the exact set of groups they should end up in.
+        regroup = collections.defaultdict(list)
+        hosts_by_id = dict((host["hostid"], host)
+                           for host in self.inventory.hosts.values())
+        for hostid, group_names in plan.hosts_to_regroup.items():
+            host = hosts_by_id[hostid]
+            groupids = frozenset(host["groupids"] |
+                                 set(self._groupids(group_names)))
+            regroup[groupids].append(hostid)
+        for groupids, hostids in regroup.items():
+            zabbix_api.set_hosts_groups(hostids, sorted(groupids))
+            for hostid in hostids:
+                hosts_by_id[hostid]["groupids"] = set(groupids)
+
+        for hostid in plan.hosts_to_enable:
+            hosts_by_id[hostid]["status"] = ENABLE_HOST
+
+        return created
+
+    def reconcile(self, zabbix_api, desired):
+        """Plan and apply the changes for `desired`, see `plan`."""
+        plan = self.plan(desired)
+        self.apply(zabbix_api, plan)
+        return plan
+
+    @staticmethod
+    def _create_groups(zabbix_api, group_names):
+        """Create the host groups `group_names` and return a dictionary of
+        group name to group id.
+
+        Workers processing other hosts may create the same groups (a
+        project's instances are spread over many hypervisors) after the
+        inventory was loaded, then zabbix refuses to create them again, so
+        only the groups still missing are created."""
+        try:
+            return zabbix_api.create_hostgroups(group_names)
+        except ZabbixAPIException:
+            groups = zabbix_api.get_hostgroups(group_names)
+            missing = set(group_names) - set(groups)
+            if missing:
+                groups.update(zabbix_api.create_hostgroups(missing))
+            return groups
+
+    def _create_hosts(self, zabbix_api, hosts):
+        """Create `hosts` (dictionary of host name to group ids) and return
+        a dictionary of host name to host id.
+
+        Like groups, hosts may be created by someone else after the inventory
+        was loaded (the lifecycle events, or the old and the new hypervisor
+        of a migrated domain), then zabbix refuses the whole request. The
+        hosts that exist by then are added to the inventory as they are and
+        only the others are created."""
+        try:
+            return zabbix_api.create_hosts(
+                hosts, self.templateid, self.tls_psk_identity, self.tls_psk)
+        except ZabbixAPIException:
+            existing = zabbix_api.get_hosts(sorted(hosts))
+            if not existing:
+                raise
+            self.inventory.add_hosts(existing)
+            missing = dict((host_name, groupids)
+                           for host_name, groupids in hosts.items()
+                           if host_name not in self.inventory.hosts)
+            if not missing:
+                return {}
+            return zabbix_api.create_hosts(
+                missing, self.templateid, self.tls_psk_identity, self.tls_psk)
+
+    def _groupids(self, group_names):
+        return sorted(self.inventory.groups[name] for name in group_names)
+
+
+def plan_cleanup(hosts, lastclocks, now, disable_after, retention_period):
+    """Decide what to do with hosts whose domains were not found.
+
+    hosts: hosts as returned by `ZabbixConnection.get_hosts`
+    lastclocks: dictionary of host id to when the host's domain was last
+    seen, see `ledger.LastSeenLedger.stale`
+
+    Hosts not heard of for more than `retention_period` seconds are deleted,
+    and for more than `disable_after` seconds disabled. Hosts without a known
+    last clock are disabled. Hosts that are already disabled are left alone
+    unless they should be deleted.
+    """
+    plan = CleanupPlan([], [], [])
+    for host in hosts:
+        lastclock = lastclocks.get(host["hostid"], 0)
+        if lastclock and now - lastclock > retention_period:
+            plan.hosts_to_delete.append(host["hostid"])
+        elif (not lastclock or now - lastclock > disable_after) and \
+                host["status"] != DISABLE_HOST:
+            plan.hosts_to_disable.append(host["hostid"])
+        else:
+            plan.hosts_to_keep.append(host["hostid"])
+    return plan
@@ -0,0 +1,74 @@
+"""
+This file holds the compact representation of the values sent to zabbix:
+slotted records that encode straight to the trapper's JSON, with the item keys
+built (and JSON encoded) once per item and device instead of once per value.
+"""
+
+from json.encoder import encode_basestring
+
+# Cached item keys and JSON strings are dropped once there are this many, as
+# domains and devices come and go over the life of the daemon.
+MAX_CACHED = 2 ** 16
+
+# (item type, device, stat) -> item key
+_keys = {}
+# host or item key -> JSON string
+_encoded = {}
+
+
+def item_key(item_type, stat, device=None):
+    """Return the key of the item `stat` of `item_type`, of `device` if given,
+    e.g. "libvirt.disk[vda,rd_bytes]".
+
+    The same key object is returned every time, which `Metric` encodes
+    once."""
+    template = (item_type, device, stat)
+    key = _keys.get(template)
+    if key is None:
+        if len(_keys) >= MAX_CACHED:
+            _keys.clear()
+        if device is None:
+            key = "libvirt.{}[{}]".format(item_type, stat)
+        else:
+            key = "libvirt.{}[{},{}]".format(item_type, device, stat)
+        _keys[template] = key
+    return key
+
+
+def _encode(string):
+    """Return `string` as a JSON string, cached"""
+    encoded = _encoded.get(string)
+    if encoded is None:
+        if len(_encoded) >= MAX_CACHED:
+            _encoded.clear()
+        encoded = _encoded[string] = encode_basestring(string)
+    return encoded
+
+
+class Metric(object):
+    """A value for the zabbix trapper.
+
+    It has the attributes of `pyzabbix.ZabbixMetric`, so the change filter and
+    the senders take either, but no instance dictionary, and `str` encodes
+    it without building one. Hosts and keys are encoded once (see
+    `item_key`), only the value is encoded every time.
+    """
+
+    __slots__ = ("host", "key", "value", "clock")
+
+    def __init__(self, host, key, value, clock=None):
+        self.host = host
+        self.key = key
+        self.value = str(value)
+        self.clock = int(clock) if clock else None
+
+    def __str__(self):
+        if self.clock is None:
+            return '{{"host":{},"key":{},"value":{}}}'.format(
+                _encode(self.host), _encode(self.key),
+                encode_basestring(self.value))
+        return '{{"host":{},"key":{},"value":{},"clock":{}}}'.format(
+            _encode(self.host), _encode(self.key),
+            encode_basestring(self.value), self.clock)
+
+    __repr__ = __str__
@@ -0,0 +1,51 @@
+"""
+This file holds the rollups: totals of instance values per hypervisor and per
+project, computed by the collector and sent to one zabbix host per hypervisor
+and project, so zabbix doesn't have to aggregate over all instances.
+"""
+
+from records import Metric, item_key
+
+# Instance attribute the instances are grouped by -> name prefix of the
+# rollup hosts.
+ROLLUP_HOSTS = {"virt_host": "rollup-host-",
+                "project_uuid": "rollup-project-"}
+
+
+class Rollups(object):
+    """Totals of instance values per rollup host.
+
+    Every worker fills one for the hosts it processes, and they are merged
+    into one before sending. A project's instances are usually spread over
+    many hypervisors, so its totals are only complete after the merge.
+    """
+
+    def __init__(self, totals=None):
+        # rollup host -> value name -> total
+        self.totals = totals if totals is not None else {}
+
+    def add(self, instance_attributes, values):
+        """Add `values` (a dictionary of value name to number) of an instance
+        to the totals of its hypervisor and project"""
+        for attribute, prefix in ROLLUP_HOSTS.items():
+            name = instance_attributes.get(attribute)
+            if name:
+                self._add(prefix + name, values)
+
+    def merge(self, other):
+        """Add the totals of the `Rollups` `other`"""
+        for host, values in other.totals.items():
+            self._add(host, values)
+
+    def _add(self, host, values):
+        totals = self.totals.setdefault(host, {})
+        for name, value in values.items():
+            totals[name] = totals.get(name, 0) + value
+
+    def metrics(self, clock=None):
+        """Return the totals as zabbix metrics"""
+        return [Metric(host, item_key("rollup", name),
+                       round(value, 2) if isinstance(value, float) else value,
+                       clock)
+                for host, values in sorted(self.totals.items())
+                for name, value in sorted(values.items())]
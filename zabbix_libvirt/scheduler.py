@@ -0,0 +1,57 @@
+"""Fixed interval scheduler for running collection cycles in daemon mode"""
+
+import threading
+import time
+
+
+class IntervalScheduler(object):
+    """Runs a job every `interval` seconds.
+
+    Runs are scheduled on a fixed grid (start + n * interval) rather than
+    `interval` seconds after the previous run finished, so slow runs don't
+    push every later run back. If a run takes longer than the interval, the
+    ticks it overran are skipped instead of being run back to back.
+
+    After every run `drift` holds how late (in seconds) the run started
+    compared to its tick, and `skipped` the number of ticks skipped so far.
+    """
+
+    def __init__(self, interval, logger=None):
+        self.interval = interval
+        self.logger = logger
+        self.drift = 0.0
+        self.skipped = 0
+        self.runs = 0
+        self._stop = threading.Event()
+
+    def stop(self):
+        """Stop after the current run"""
+        self._stop.set()
+
+    def run(self, job):
+        """Call `job` every interval until `stop` is called"""
+        start = time.time()
+        tick = 0
+
+        while not self._stop.is_set():
+            scheduled = start + tick * self.interval
+            delay = scheduled - time.time()
+            if delay > 0 and self._stop.wait(delay):
+                break
+
+            self.drift = time.time() - scheduled
+            self.runs += 1
+            if self.logger is not None:
+                self.logger.info("Starting run %d, %.3f seconds late",
+                                 self.runs, self.drift)
+            job()
+
+            # Schedule the next tick that is still in the future.
+            elapsed_ticks = int((time.time() - start) // self.interval)
+            next_tick = max(tick + 1, elapsed_ticks + 1)
+            if next_tick > tick + 1:
+                self.skipped += next_tick - tick - 1
+                if self.logger is not None:
+                    self.logger.warning("Run %d overran, skipping %d runs",
+                                        self.runs, next_tick - tick - 1)
+            tick = next_tick
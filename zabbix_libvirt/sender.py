@@ -0,0 +1,289 @@
+"""
+This file holds a ZabbixSender that batches metrics across domains and sends
+them compressed, optionally from background threads.
+"""
+
+import collections
+import copy
+import json
+import socket
+import struct
+import threading
+import timeit
+import zlib
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from pyzabbix import ZabbixSender, ZabbixResponse
+
+# Zabbix protocol header flags, see
+# https://www.zabbix.com/documentation/4.2/manual/appendix/protocols/header_datalen
+ZBX_TCP_PROTOCOL = 0x01
+ZBX_TCP_COMPRESS = 0x02
+
+# hosts: the hosts of the values in the batch, if they were added with `add`
+BatchResult = collections.namedtuple(
+    "BatchResult",
+    ["processed", "failed", "total", "seconds", "error", "hosts"])
+BatchResult.__new__.__defaults__ = (frozenset(),)
+
+
+class BatchingZabbixSender(ZabbixSender):
+    """ZabbixSender that collects metrics with `add` and sends them in batches
+    capped by number of values and by size.
+
+    Every batch is sent over one connection, so with PSK there is one TLS
+    handshake per batch instead of one per domain. The trapper closes the
+    connection after answering a request and zabbix turns TLS session caching
+    off, so connections can't be kept open or resumed across batches.
+
+    compress: Use zlib compression (zabbix 4.0 and newer).
+    limit: Semaphore held while a batch is sent, to cap the number of
+    concurrent connections to the trapper.
+    spool: `spool.Spool` the messages of batches that failed are added to.
+    timings: `timings.Timings` the time every batch takes to send is added
+    to, as the "send" phase.
+    """
+
+    def __init__(self, zabbix_server="127.0.0.1", zabbix_port=10051,
+                 socket_wrapper=None, timeout=10, batch_size=1000,
+                 max_batch_bytes=2**20, compress=True, limit=None,
+                 spool=None, timings=None):
+        ZabbixSender.__init__(self, zabbix_server=zabbix_server,
+                              zabbix_port=zabbix_port, chunk_size=batch_size,
+                              socket_wrapper=socket_wrapper, timeout=timeout)
+        self.max_batch_bytes = max_batch_bytes
+        self.compress = compress
+        self.limit = limit
+        self.spool = spool
+        self.timings = timings
+        self._reset()
+
+    def _reset(self):
+        """Start with nothing queued"""
+        self._messages = []
+        self._hosts = set()
+        self._size = 0
+        self._results = []
+
+    def clone(self):
+        """Return a new sender with the same settings and nothing queued"""
+        clone = copy.copy(self)
+        clone._reset()
+        return clone
+
+    def add(self, metrics):
+        """Queue `metrics`, sending the full batches"""
+        for metric in metrics:
+            self._add(str(metric), metric.host)
+
+    def add_messages(self, messages):
+        """Queue metrics already encoded with `str`, see `add`"""
+        for message in messages:
+            self._add(message)
+
+    def _add(self, message, host=None):
+        """Queue `message` of `host`, sending the batch first if it's full"""
+        if self._messages and (
+                len(self._messages) >= self.chunk_size or
+                self._size + len(message) > self.max_batch_bytes):
+            self._send_batch()
+        self._messages.append(message)
+        self._size += len(message) + 1
+        if host is not None:
+            self._hosts.add(host)
+
+    def flush(self):
+        """Send what's left and return the `BatchResult`s of all batches sent
+        since the last flush."""
+        if self._messages:
+            self._send_batch()
+        results, self._results = self._results, []
+        return results
+
+    def send(self, metrics):
+        """Send `metrics` right away in batches, see `add`.
+
+        Returns the `BatchResult` of every batch."""
+        self.add(metrics)
+        return self.flush()
+
+    def _take_batch(self):
+        """Return the queued messages and their hosts, emptying the queue"""
+        batch = self._messages, frozenset(self._hosts)
+        self._messages, self._hosts, self._size = [], set(), 0
+        return batch
+
+    def _send_batch(self):
+        """Send the queued messages as one request"""
+        self._send_messages(*self._take_batch())
+
+    def _send_messages(self, messages, hosts=frozenset()):
+        """Send `messages` (of `hosts`) as one request and record its result.
+
+        A failed batch is recorded (with all of its values counted as failed)
+        instead of raised, so the batches that follow are still sent."""
+        packet = self._create_packet(self._create_request(messages))
+        started = timeit.default_timer()
+        try:
+            if self.limit is None:
+                response = self._send_packet(packet)
+            else:
+                with self.limit:
+                    response = self._send_packet(packet)
+        except (socket.error, ValueError) as error:
+            self._record_time(started, failed=True)
+            self._results.append(BatchResult(
+                0, len(messages), len(messages), 0.0, error, hosts))
+            if self.spool is not None:
+                self.spool.append(messages)
+            return
+        self._record_time(started)
+
+        result = ZabbixResponse()
+        result.parse(response)
+        self._results.append(BatchResult(
+            result.processed, result.failed, result.total, result.time, None,
+            hosts))
+
+    def _record_time(self, started, failed=False):
+        """Add the time since `started` to `timings`"""
+        if self.timings is not None:
+            self.timings.add("send", timeit.default_timer() - started)
+            if failed:
+                self.timings.error("send")
+
+    def _send_packet(self, packet):
+        """Send a packet to all zabbix servers and return the last response"""
+        response = None
+        for host_addr in self.zabbix_uri:
+            connection = socket.socket()
+            if self.socket_wrapper:
+                connection = self.socket_wrapper(connection)
+            connection.settimeout(self.timeout)
+
+            try:
+                connection.connect(host_addr)
+                connection.sendall(packet)
+                response = self._get_response(connection)
+            finally:
+                try:
+                    connection.close()
+                except socket.error:
+                    pass
+
+            if not response or response.get("response") != "success":
+                raise socket.error(response)
+        return response
+
+    def _create_packet(self, request):
+        """Prepend the zabbix header, compressing `request` if enabled"""
+        if not self.compress:
+            return struct.pack("<4sBII", b"ZBXD", ZBX_TCP_PROTOCOL,
+                               len(request), 0) + request
+
+        data = zlib.compress(request)
+        return struct.pack("<4sBII", b"ZBXD",
+                           ZBX_TCP_PROTOCOL | ZBX_TCP_COMPRESS,
+                           len(data), len(request)) + data
+
+    def _get_response(self, connection):
+        """Read a (possibly compressed) response"""
+        header = self._receive(connection, 13)
+        if len(header) != 13 or not header.startswith(b"ZBXD"):
+            return False
+
+        _, flags, length, _ = struct.unpack("<4sBII", header)
+        body = self._receive(connection, length)
+        if flags & ZBX_TCP_COMPRESS:
+            body = zlib.decompress(body)
+        return json.loads(body.decode("utf-8"))
+
+
+class PipelinedZabbixSender(BatchingZabbixSender):
+    """BatchingZabbixSender whose batches are encoded and sent by `workers`
+    background threads, so gathering the next values overlaps with sending
+    the previous ones.
+
+    Full batches wait in a queue of at most `queue_size` batches. `add`
+    blocks while it is full, which slows the collection down to the pace of
+    the trapper. With `timings`, the time `add` was blocked is recorded as
+    the "backpressure" phase, the time batches waited in the queue as the
+    "queue" phase, and the deepest the queue got as the "send_queue" peak.
+
+    The workers are started by the first full batch and stopped by `flush`.
+    """
+
+    def __init__(self, workers=1, queue_size=4, **kwargs):
+        self.workers = workers
+        self.queue_size = queue_size
+        BatchingZabbixSender.__init__(self, **kwargs)
+
+    def _reset(self):
+        BatchingZabbixSender._reset(self)
+        self._queue = None
+        self._threads = []
+        self._timings_lock = threading.Lock()
+
+    def flush(self):
+        """Send what's left, wait for all batches to be sent and return
+        their `BatchResult`s, see `BatchingZabbixSender.flush`"""
+        if self._messages:
+            self._send_batch()
+        if self._queue is not None:
+            for _ in self._threads:
+                self._queue.put(None)
+            for thread in self._threads:
+                thread.join()
+            self._queue = None
+            self._threads = []
+        results, self._results = self._results, []
+        return results
+
+    def _send_batch(self):
+        """Queue the queued messages for the workers as one batch"""
+        messages, hosts = self._take_batch()
+        if self._queue is None:
+            self._start()
+
+        started = timeit.default_timer()
+        self._queue.put((started, messages, hosts))
+        if self.timings is not None:
+            with self._timings_lock:
+                self.timings.add("backpressure",
+                                 timeit.default_timer() - started)
+                self.timings.peak("send_queue", self._queue.qsize())
+
+    def _start(self):
+        """Start the workers"""
+        self._queue = queue.Queue(max(1, self.queue_size))
+        for number in range(max(1, self.workers)):
+            thread = threading.Thread(target=self._work,
+                                      name="sender-{}".format(number))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        """Send the batches in the queue until told to stop with None"""
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                return
+            queued, messages, hosts = batch
+            if self.timings is not None:
+                with self._timings_lock:
+                    self.timings.add("queue", timeit.default_timer() - queued)
+            try:
+                self._send_messages(messages, hosts)
+            except Exception as error:
+                # Keep the worker alive, or flush would wait forever.
+                self._results.append(BatchResult(
+                    0, len(messages), len(messages), 0.0, error, hosts))
+
+    def _record_time(self, started, failed=False):
+        with self._timings_lock:
+            BatchingZabbixSender._record_time(self, started, failed)
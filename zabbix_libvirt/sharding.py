@@ -0,0 +1,114 @@
+"""
+This file holds the shard mode: the hypervisors are spread over several
+collector nodes with rendezvous hashing, and the nodes share what they found
+through a sqlite database on shared storage, so the cleanup knows the domains
+of all hypervisors and only one node runs it. The nodes share their rollups
+there too, as a project's instances may be on the hypervisors of any node.
+"""
+
+import hashlib
+import json
+import time
+
+from ledger import LastSeenLedger
+
+SCHEMA = LastSeenLedger.schema + (
+    "CREATE TABLE IF NOT EXISTS runs ("
+    "node TEXT PRIMARY KEY, started REAL NOT NULL, finished REAL NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS claims ("
+    "name TEXT PRIMARY KEY, node TEXT NOT NULL, expires REAL NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS rollups ("
+    "node TEXT PRIMARY KEY, clock REAL NOT NULL, totals TEXT NOT NULL)")
+
+
+def _score(node, host):
+    digest = hashlib.sha1("{}\n{}".format(node, host).encode("utf-8"))
+    return int(digest.hexdigest()[:16], 16)
+
+
+def shard_owner(host, nodes):
+    """Return the node of `nodes` that collects `host`.
+
+    Every host goes to the node with the highest hash of node and host
+    (rendezvous hashing), so adding or removing one of N nodes only moves
+    about 1/N of the hosts."""
+    return max(nodes, key=lambda node: (_score(node, host), node))
+
+
+def shard_hosts(hosts, node, nodes):
+    """Return the hosts of `hosts` that `node` collects"""
+    return [host for host in hosts if shard_owner(host, nodes) == node]
+
+
+class ShardStore(LastSeenLedger):
+    """What every node found in its last run, in a sqlite database shared
+    by all nodes. It is the `LastSeenLedger` of all of them.
+
+    The database has to be on storage with working locks (e.g. a local
+    disk, or NFSv4), sqlite relies on them.
+    """
+
+    schema = SCHEMA
+
+    def record_run(self, node, started, domains, finished=None):
+        """Record that `node` found `domains` in a run started at
+        `started` (unix time)"""
+        finished = time.time() if finished is None else finished
+
+        def record(connection):
+            self._record(connection, node, domains, finished)
+            connection.execute(
+                "INSERT OR REPLACE INTO runs (node, started, finished) "
+                "VALUES (?, ?, ?)", (node, started, finished))
+        self._transaction(record)
+
+    def stale_nodes(self, nodes, max_age, now=None):
+        """Return the nodes of `nodes` whose last run finished more than
+        `max_age` seconds ago (or never).
+
+        The ledger doesn't know what the hosts of such nodes have, so their
+        domains would look gone."""
+        now = time.time() if now is None else now
+        finished = self._transaction(lambda connection: dict(
+            connection.execute("SELECT node, finished FROM runs")))
+        return [node for node in nodes
+                if node not in finished or now - finished[node] > max_age]
+
+    def record_rollups(self, node, totals, clock=None):
+        """Record the rollup `totals` (see `rollups.Rollups.totals`) of
+        `node`'s hypervisors at `clock` (unix time)"""
+        clock = time.time() if clock is None else clock
+        self._transaction(lambda connection: connection.execute(
+            "INSERT OR REPLACE INTO rollups (node, clock, totals) "
+            "VALUES (?, ?, ?)", (node, clock, json.dumps(totals))))
+
+    def rollups(self, nodes, max_age, now=None):
+        """Return a dictionary of node to the last rollup totals of `nodes`,
+        and the list of nodes that recorded none in the last `max_age`
+        seconds"""
+        now = time.time() if now is None else now
+        rows = self._transaction(lambda connection: connection.execute(
+            "SELECT node, clock, totals FROM rollups").fetchall())
+        totals = dict((node, json.loads(node_totals))
+                      for node, clock, node_totals in rows
+                      if node in nodes and now - clock <= max_age)
+        return totals, [node for node in nodes if node not in totals]
+
+    def claim(self, name, node, interval, now=None):
+        """Claim `name` (e.g. "cleanup") for `node` for the next `interval`
+        seconds.
+
+        Returns whether it was claimed: only one node gets it, and only if
+        nobody got it in the last `interval` seconds."""
+        now = time.time() if now is None else now
+
+        def claim(connection):
+            row = connection.execute(
+                "SELECT expires FROM claims WHERE name = ?", (name,)).fetchone()
+            if row is not None and row[0] > now:
+                return False
+            connection.execute(
+                "INSERT OR REPLACE INTO claims (name, node, expires) "
+                "VALUES (?, ?, ?)", (name, node, now + interval))
+            return True
+        return self._transaction(claim)
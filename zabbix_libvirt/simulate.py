@@ -0,0 +1,735 @@
+#!/usr/bin/env python
+"""
+End-to-end load simulation of main.py on one machine, without network.
+
+main.py is run unchanged against simulated stand-ins: libvirt connections
+serving synthetic domains, a zabbix API (JSON-RPC over HTTP) keeping its
+hosts and groups in memory, and a zabbix trapper (PSK or plaintext). Every
+run reports its run time, API calls and trapper frames per domain, the peak
+RSS, and the timings main.py sent about itself:
+
+    python simulate.py --hypervisors 500 --domains 100 --runs 2
+    python simulate.py --set rates.ENABLED=true --set workers.BACKEND=thread
+
+The first run creates all hosts in zabbix, the later ones show a steady
+state. With --shards, every run runs main.py once per collector node, and
+the collector timings are those of the last node.
+"""
+
+import argparse
+import collections
+import json
+import os
+import platform
+import resource
+import runpy
+import shutil
+import ssl
+import struct
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import uuid
+import zlib
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn, TCPServer, BaseRequestHandler
+    from urllib.parse import urlsplit
+except ImportError:
+    # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn, TCPServer, BaseRequestHandler
+    from urlparse import urlsplit
+
+import configparser
+
+import libvirt
+from benchmark import domain_xml, git_commit
+from sender import ZBX_TCP_PROTOCOL, ZBX_TCP_COMPRESS
+
+MAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+
+TEMPLATES = {"moc_libvirt_single": "10001",
+             "moc_libvirt_rollup": "10002",
+             "moc_libvirt_collector": "10003"}
+
+# main.py's own host (HOST_IN_ZABBIX), it gets the collector's metrics.
+COLLECTOR_HOST = "zabbix-libvirt-simulate"
+
+PSK_IDENTITY = "simulate"
+PSK = "0123456789abcdef0123456789abcdef"
+
+# How long every call to a hanging hypervisor takes, see --hanging.
+HANG_SECONDS = 60 * 60
+
+# Stats fields of getAllDomainStats block records.
+BLOCK_FIELDS = ("rd.reqs", "rd.bytes", "rd.times", "wr.reqs", "wr.bytes",
+                "wr.times", "fl.reqs", "fl.times")
+
+
+class SimulatedDomain(libvirt.virDomain):
+    """`libvirt.virDomain` of a running domain whose counters grow at a
+    steady rate"""
+
+    def __init__(self, hypervisor, index):
+        # There's no libvirt object behind it, so the parent's __init__
+        # isn't called. virDomain.__del__ frees `_o` if it's set.
+        self._o = None
+        self.hypervisor = hypervisor
+        self.index = index
+        self.uuid = str(uuid.uuid5(uuid.NAMESPACE_URL,
+                                   "simulate/domain/{}".format(index)))
+        self.nics = ["tap{}-{}".format(index, nic)
+                     for nic in range(hypervisor.nics)]
+        self.disks = ["vd" + chr(ord("a") + disk % 26) * (disk // 26 + 1)
+                      for disk in range(hypervisor.disks)]
+
+    def _counter(self, per_second):
+        """Return the value of a counter going up by about `per_second`"""
+        return int((time.time() - self.hypervisor.booted) * per_second *
+                   (1 + self.index % 7))
+
+    def UUIDString(self):
+        return self.uuid
+
+    def name(self):
+        self.hypervisor.rpc()
+        return "instance-{:08x}".format(self.index)
+
+    def XMLDesc(self, flags=0):
+        self.hypervisor.rpc()
+        return domain_xml(
+            self.index, self.hypervisor.nics, self.hypervisor.disks,
+            domain_uuid=self.uuid,
+            user_uuid=uuid.uuid5(uuid.NAMESPACE_URL, "simulate/user/{}".format(
+                self.index)),
+            project_uuid=uuid.uuid5(uuid.NAMESPACE_URL,
+                                    "simulate/project/{}".format(
+                                        self.index % 10)))
+
+    def isActive(self):
+        self.hypervisor.rpc()
+        return 1
+
+    def info(self):
+        self.hypervisor.rpc()
+        return [libvirt.VIR_DOMAIN_RUNNING, 2097152, 2097152, 4,
+                self._counter(10 ** 8)]
+
+    def memoryStats(self):
+        self.hypervisor.rpc()
+        return {"actual": 2097152, "usable": 1048576, "unused": 524288}
+
+    def _interface_stats(self):
+        return (self._counter(10 ** 4), self._counter(10), 0, 0,
+                self._counter(2 * 10 ** 4), self._counter(20), 0, 0)
+
+    def interfaceStats(self, path):
+        self.hypervisor.rpc()
+        return self._interface_stats()
+
+    def blockStatsFlags(self, path, flags=0):
+        self.hypervisor.rpc()
+        return {"rd_operations": self._counter(5),
+                "rd_bytes": self._counter(5 * 4096),
+                "rd_total_times": self._counter(10 ** 5),
+                "wr_operations": self._counter(2),
+                "wr_bytes": self._counter(2 * 4096),
+                "wr_total_times": self._counter(10 ** 5),
+                "flush_operations": self._counter(1),
+                "flush_total_times": self._counter(10 ** 4)}
+
+    def stats(self):
+        """Return the domain's getAllDomainStats record"""
+        record = {"state.state": libvirt.VIR_DOMAIN_RUNNING,
+                  "cpu.time": self._counter(10 ** 8),
+                  "vcpu.current": 4,
+                  "balloon.current": 2097152,
+                  "balloon.usable": 1048576,
+                  "balloon.unused": 524288,
+                  "block.count": len(self.disks),
+                  "net.count": len(self.nics)}
+        for number, disk in enumerate(self.disks):
+            record["block.{}.name".format(number)] = disk
+            for field in BLOCK_FIELDS:
+                record["block.{}.{}".format(number, field)] = \
+                    self._counter(number + 1)
+        for number, nic in enumerate(self.nics):
+            prefix = "net.{}.".format(number)
+            stats = self._interface_stats()
+            record[prefix + "name"] = nic
+            record[prefix + "rx.bytes"] = stats[0]
+            record[prefix + "rx.pkts"] = stats[1]
+            record[prefix + "tx.bytes"] = stats[4]
+            record[prefix + "tx.pkts"] = stats[5]
+        return record
+
+
+class SimulatedHypervisor(object):
+    """Duck-typed `libvirt.virConnect` of a hypervisor with `domains`
+    domains, every call taking `latency` seconds like a remote RPC would"""
+
+    def __init__(self, hostname, number, domains, nics, disks, latency):
+        self.hostname = hostname
+        self.nics = nics
+        self.disks = disks
+        self.latency = latency
+        self.booted = time.time() - 24 * 60 * 60
+        self.domains = collections.OrderedDict()
+        for index in range(number * domains, (number + 1) * domains):
+            domain = SimulatedDomain(self, index)
+            self.domains[domain.uuid] = domain
+
+    def rpc(self):
+        """Wait as long as an RPC takes"""
+        if self.latency:
+            time.sleep(self.latency)
+
+    def listAllDomains(self, flags=0):
+        self.rpc()
+        return list(self.domains.values())
+
+    def lookupByUUIDString(self, uuid_string):
+        self.rpc()
+        domain = self.domains.get(uuid_string)
+        if domain is None:
+            raise libvirt.libvirtError("Domain not found: " + uuid_string)
+        return domain
+
+    def getAllDomainStats(self, stats, flags=0):
+        self.rpc()
+        return [(domain, domain.stats()) for domain in self.domains.values()]
+
+    def getHostname(self):
+        self.rpc()
+        return self.hostname
+
+    def setKeepAlive(self, interval, count):
+        return 0
+
+    def isAlive(self):
+        return 1
+
+    def domainEventRegisterAny(self, domain, event_id, callback, opaque):
+        return 1
+
+    def domainEventDeregisterAny(self, callback_id):
+        return 0
+
+    def close(self):
+        return 0
+
+
+class SimulatedLibvirt(object):
+    """Stands in for `libvirt.openReadOnly`. The hypervisor is taken from
+    the host of the URI, which has to be one of `hosts`; the first
+    `unreachable` of them can't be connected to, and every call to the last
+    `hanging` of them hangs (like libvirtd stuck on a dying VM)."""
+
+    def __init__(self, hosts, domains, nics, disks, latency=0.0,
+                 connect_latency=0.0, unreachable=0, hanging=0):
+        self.hosts = dict((host, number) for number, host in enumerate(hosts))
+        self.domains = domains
+        self.nics = nics
+        self.disks = disks
+        self.latency = latency
+        self.connect_latency = connect_latency
+        self.unreachable = unreachable
+        self.hanging = hanging
+
+    def open(self, uri=None):
+        """Return a `SimulatedHypervisor` for `uri`"""
+        if self.connect_latency:
+            time.sleep(self.connect_latency)
+        host = urlsplit(uri).hostname
+        number = self.hosts.get(host)
+        if number is None or number < self.unreachable:
+            raise libvirt.libvirtError(
+                "Cannot recv data: ssh: connect to host {}: "
+                "Connection refused".format(host))
+        latency = self.latency
+        if number >= len(self.hosts) - self.hanging:
+            latency = HANG_SECONDS
+        return SimulatedHypervisor(host, number, self.domains, self.nics,
+                                   self.disks, latency)
+
+    def install(self):
+        """Make libvirt connect to the simulated hypervisors"""
+        libvirt.openReadOnly = self.open
+
+
+class SimulatedZabbix(object):
+    """In-memory hosts and host groups of a zabbix server, and the API calls
+    and trapper frames it got. The API and the trapper share it, like they
+    share zabbix's database.
+
+    The last values of the collector's own items, sent to `collector_host`,
+    are kept in `collector_values`."""
+
+    def __init__(self, user, password, collector_host=None):
+        self.user = user
+        self.password = password
+        self.tokens = set()
+        self.hosts = {}
+        self.hosts_by_id = {}
+        self.groups = {}
+        self.calls = collections.Counter()
+        self.frames = 0
+        self.values = 0
+        self.failed_values = 0
+        self.collector_host = collector_host
+        self.collector_values = {}
+        self.lock = threading.Lock()
+        self._next_id = 100000
+        if collector_host is not None:
+            self._host_create({"host": collector_host, "groups": []})
+
+    def reset_counters(self):
+        """Start counting calls and frames from 0"""
+        with self.lock:
+            self.calls = collections.Counter()
+            self.frames = self.values = self.failed_values = 0
+            self.collector_values = {}
+
+    def _new_id(self):
+        self._next_id += 1
+        return str(self._next_id)
+
+    def call(self, method, params, auth):
+        """Handle an API request and return its result. Raises
+        `SimulatedAPIError` for requests zabbix would refuse."""
+        with self.lock:
+            self.calls[method] += 1
+            if method == "apiinfo.version":
+                return "4.4.0"
+            if method == "user.login":
+                if params.get("user") != self.user or \
+                        params.get("password") != self.password:
+                    raise SimulatedAPIError(
+                        -32602, "Login name or password is incorrect.")
+                token = uuid.uuid4().hex
+                self.tokens.add(token)
+                return token
+            if auth not in self.tokens:
+                raise SimulatedAPIError(
+                    -32602, "Session terminated, re-login, please.")
+            if method == "user.logout":
+                self.tokens.discard(auth)
+                return True
+
+            handler = getattr(self, "_" + method.replace(".", "_"), None)
+            if handler is None:
+                raise SimulatedAPIError(
+                    -32601, "Method not found: " + method)
+            return handler(params)
+
+    def _template_get(self, params):
+        names = params.get("filter", {}).get("name", list(TEMPLATES))
+        return [{"templateid": TEMPLATES[name], "name": name}
+                for name in names if name in TEMPLATES]
+
+    def _hostgroup_get(self, params):
+        names = params.get("filter", {}).get("name")
+        if names is None:
+            names = list(self.groups)
+        return [{"groupid": self.groups[name], "name": name}
+                for name in names if name in self.groups]
+
+    def _hostgroup_create(self, params):
+        params = params if isinstance(params, list) else [params]
+        # Zabbix creates all or nothing.
+        for group in params:
+            if group["name"] in self.groups:
+                raise SimulatedAPIError(
+                    -32602, "Host group \"{}\" already exists.".format(
+                        group["name"]))
+        groupids = []
+        for group in params:
+            self.groups[group["name"]] = self._new_id()
+            groupids.append(self.groups[group["name"]])
+        return {"groupids": groupids}
+
+    def _host_record(self, host):
+        return {"hostid": host["hostid"], "host": host["host"],
+                "name": host["host"], "status": host["status"],
+                "groups": [{"groupid": groupid}
+                           for groupid in sorted(host["groupids"])]}
+
+    def _host_get(self, params):
+        names = params.get("filter", {}).get("host")
+        if names is None:
+            hosts = list(self.hosts.values())
+        else:
+            hosts = [self.hosts[name] for name in names if name in self.hosts]
+        groupids = params.get("groupids")
+        if groupids is not None:
+            groupids = set(groupids)
+            hosts = [host for host in hosts if host["groupids"] & groupids]
+        return [self._host_record(host) for host in hosts]
+
+    def _host_create(self, params):
+        params = params if isinstance(params, list) else [params]
+        # Zabbix creates all or nothing.
+        for parameters in params:
+            if parameters["host"] in self.hosts:
+                raise SimulatedAPIError(
+                    -32602, "Host with the same name \"{}\" already "
+                    "exists.".format(parameters["host"]))
+        hostids = []
+        for parameters in params:
+            host = {"hostid": self._new_id(), "host": parameters["host"],
+                    "status": str(parameters.get("status", "0")),
+                    "groupids": set(group["groupid"]
+                                    for group in parameters["groups"])}
+            self.hosts[host["host"]] = host
+            self.hosts_by_id[host["hostid"]] = host
+            hostids.append(host["hostid"])
+        return {"hostids": hostids}
+
+    def _host_massupdate(self, params):
+        hostids = [host["hostid"] for host in params["hosts"]]
+        for hostid in hostids:
+            host = self.hosts_by_id[hostid]
+            if "status" in params:
+                host["status"] = str(params["status"])
+            if "groups" in params:
+                host["groupids"] = set(group["groupid"]
+                                       for group in params["groups"])
+        return {"hostids": hostids}
+
+    def _hostgroup_massadd(self, params):
+        hostids = [host["hostid"] for host in params["hosts"]]
+        for hostid in hostids:
+            self.hosts_by_id[hostid]["groupids"].update(
+                group["groupid"] for group in params["groups"])
+        return {"groupids": [group["groupid"] for group in params["groups"]]}
+
+    def _host_delete(self, params):
+        for hostid in params:
+            host = self.hosts_by_id.pop(hostid)
+            del self.hosts[host["host"]]
+        return {"hostids": list(params)}
+
+    def receive(self, data):
+        """Take the values of a trapper request, and return how many were
+        processed and how many failed (those of unknown or disabled
+        hosts)"""
+        processed = 0
+        with self.lock:
+            self.frames += 1
+            for value in data:
+                host = self.hosts.get(value.get("host"))
+                if host is None or host["status"] != "0":
+                    continue
+                processed += 1
+                if host["host"] == self.collector_host:
+                    self.collector_values[value["key"]] = value["value"]
+            self.values += len(data)
+            self.failed_values += len(data) - processed
+        return processed, len(data) - processed
+
+
+class SimulatedAPIError(Exception):
+    """A JSON-RPC error reply"""
+
+    def __init__(self, code, data):
+        Exception.__init__(self, data)
+        self.code = code
+        self.data = data
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _ThreadingTCPServer(ThreadingMixIn, TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def start_api(zabbix):
+    """Serve the zabbix API of `zabbix` on a local port in a thread.
+
+    Returns the server, its URL is http://127.0.0.1:<port>."""
+
+    class Handler(BaseHTTPRequestHandler):
+        # Keep-alive, like the frontend's web server.
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            length = int(self.headers["Content-Length"])
+            request = json.loads(self.rfile.read(length).decode("utf-8"))
+            try:
+                reply = {"jsonrpc": "2.0", "id": request.get("id"),
+                         "result": zabbix.call(request["method"],
+                                               request.get("params", {}),
+                                               request.get("auth"))}
+            except SimulatedAPIError as error:
+                reply = {"jsonrpc": "2.0", "id": request.get("id"),
+                         "error": {"code": error.code,
+                                   "message": "Invalid params.",
+                                   "data": error.data}}
+            body = json.dumps(reply).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = _ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    _serve(server)
+    return server
+
+
+def _receive(connection, size):
+    data = b""
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def start_trapper(zabbix, psk=None, psk_identity=None):
+    """Serve a zabbix trapper taking values into `zabbix` on a local port
+    in a thread. Connections have to use TLS with `psk` if it's set.
+
+    Returns the server, its port is in `server_address`."""
+
+    class Handler(BaseRequestHandler):
+
+        def handle(self):
+            connection = self.request
+            if psk is not None:
+                import sslpsk
+                connection = sslpsk.wrap_socket(
+                    connection, server_side=True,
+                    ssl_version=ssl.PROTOCOL_TLSv1_2,
+                    ciphers="PSK-AES128-CBC-SHA",
+                    psk=lambda identity: psk if identity ==
+                    psk_identity.encode("utf-8") else b"")
+            header = _receive(connection, 13)
+            if len(header) != 13 or not header.startswith(b"ZBXD"):
+                return
+            _, flags, length, _ = struct.unpack("<4sBII", header)
+            body = _receive(connection, length)
+            if flags & ZBX_TCP_COMPRESS:
+                body = zlib.decompress(body)
+            data = json.loads(body.decode("utf-8")).get("data", [])
+
+            started = timeit.default_timer()
+            processed, failed = zabbix.receive(data)
+            reply = json.dumps({
+                "response": "success",
+                "info": "processed: {}; failed: {}; total: {}; "
+                        "seconds spent: {:.6f}".format(
+                            processed, failed, len(data),
+                            timeit.default_timer() - started)}).encode("utf-8")
+            connection.sendall(struct.pack(
+                "<4sBII", b"ZBXD", ZBX_TCP_PROTOCOL, len(reply), 0) + reply)
+
+    server = _ThreadingTCPServer(("127.0.0.1", 0), Handler)
+    _serve(server)
+    return server
+
+
+def _serve(server):
+    thread = threading.Thread(target=server.serve_forever,
+                              name=type(server).__name__)
+    thread.daemon = True
+    thread.start()
+
+
+def write_config(directory, api_url, trapper_port, backend, workers, psk,
+                 settings, name="config.ini"):
+    """Write main.py's config file for the simulation to `directory` and
+    return its path. `settings` are (section, key, value) tuples overriding
+    the defaults."""
+    config = configparser.ConfigParser()
+    config.optionxform = str
+    config.read_dict({
+        "general": {"API_USER": "simulate", "PASSWORD": "simulate",
+                    "ZABBIX_SERVER": "127.0.0.1",
+                    "HOST_IN_ZABBIX": COLLECTOR_HOST,
+                    "LOG_DIR": os.path.join(directory, "log"),
+                    "PSK": PSK, "PSK_IDENTITY": PSK_IDENTITY,
+                    "HOSTS_FILE": os.path.join(directory, "hosts.txt"),
+                    "KEY_FILE": os.devnull,
+                    "STATE_DIR": os.path.join(directory, "state")},
+        "zabbix_api": {"URL": api_url},
+        "sender": {"PORT": str(trapper_port),
+                   "TLS_PSK": str(psk).lower()},
+        "workers": {"BACKEND": backend, "MAX_WORKERS": str(workers)}})
+    for section, key, value in settings:
+        if not config.has_section(section):
+            config.add_section(section)
+        config.set(section, key, value)
+
+    for option in ("LOG_DIR", "STATE_DIR"):
+        path = config.get("general", option)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+    path = os.path.join(directory, name)
+    with open(path, "w") as config_file:
+        config.write(config_file)
+    return path
+
+
+def run_main(config_path):
+    """Run main.py once with `config_path`, in this process so it uses the
+    simulated libvirt. Returns how long it took."""
+    argv = sys.argv
+    sys.argv = [MAIN, "--config", config_path]
+    started = timeit.default_timer()
+    try:
+        runpy.run_path(MAIN, run_name="__main__")
+    finally:
+        sys.argv = argv
+    return timeit.default_timer() - started
+
+
+def peak_rss():
+    """Return the peak RSS in bytes of this process, and of the largest of
+    its workers that exited"""
+    # ru_maxrss is in KiB on Linux.
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024)
+
+
+def parse_setting(setting):
+    """Parse a --set SECTION.KEY=VALUE argument"""
+    name, _, value = setting.partition("=")
+    section, _, key = name.partition(".")
+    if not section or not key or not _:
+        raise argparse.ArgumentTypeError(
+            "expected SECTION.KEY=VALUE: " + setting)
+    return section, key, value
+
+
+def main_simulate():
+    """Parse the arguments, run the simulation and print the report"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--hypervisors", type=int, default=500)
+    parser.add_argument("--domains", type=int, default=100,
+                        help="domains per hypervisor")
+    parser.add_argument("--nics", type=int, default=2)
+    parser.add_argument("--disks", type=int, default=2)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds every libvirt call takes")
+    parser.add_argument("--connect-latency", type=float, default=0.0,
+                        help="seconds connecting to a hypervisor takes")
+    parser.add_argument("--unreachable", type=int, default=0,
+                        help="hypervisors that can't be connected to")
+    parser.add_argument("--hanging", type=int, default=0,
+                        help="hypervisors whose calls hang")
+    parser.add_argument("--backend", choices=("process", "thread"),
+                        default="process")
+    parser.add_argument("--workers", type=int, default=64)
+    parser.add_argument("--plaintext", action="store_true",
+                        help="don't use PSK between sender and trapper")
+    parser.add_argument("--runs", type=int, default=2)
+    parser.add_argument("--shards", type=int, default=1,
+                        help="collector nodes in shard mode, run one after "
+                             "the other")
+    parser.add_argument("--set", type=parse_setting, action="append",
+                        default=[], metavar="SECTION.KEY=VALUE",
+                        help="override a setting of main.py's config")
+    parser.add_argument("--output", help="write the report to this file")
+    parser.add_argument("--keep", action="store_true",
+                        help="keep the logs and state of main.py")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="zabbix-libvirt-simulate-")
+    hosts = ["hv{:04d}.simulate".format(number)
+             for number in range(args.hypervisors)]
+    with open(os.path.join(directory, "hosts.txt"), "w") as hosts_file:
+        hosts_file.write("\n".join(hosts) + "\n")
+
+    SimulatedLibvirt(hosts, args.domains, args.nics, args.disks,
+                     args.latency, args.connect_latency,
+                     args.unreachable, args.hanging).install()
+    zabbix = SimulatedZabbix("simulate", "simulate", COLLECTOR_HOST)
+    api = start_api(zabbix)
+    if args.plaintext:
+        trapper = start_trapper(zabbix)
+    else:
+        trapper = start_trapper(zabbix, bytes(bytearray.fromhex(PSK)),
+                                PSK_IDENTITY)
+    api_url = "http://127.0.0.1:{}".format(api.server_address[1])
+    if args.shards > 1:
+        # Every node gets its own state, but they share the shard store.
+        nodes = ["collector-{}".format(node) for node in range(args.shards)]
+        config_paths = [write_config(
+            directory, api_url, trapper.server_address[1], args.backend,
+            args.workers, not args.plaintext, [
+                ("general", "STATE_DIR",
+                 os.path.join(directory, "state-" + node)),
+                ("shard", "NODES", ",".join(nodes)),
+                ("shard", "NODE", node),
+                ("shard", "STORE", os.path.join(directory, "shards.sqlite"))]
+            + args.set, node + ".ini") for node in nodes]
+    else:
+        config_paths = [write_config(
+            directory, api_url, trapper.server_address[1], args.backend,
+            args.workers, not args.plaintext, args.set)]
+
+    domains = float(max(1, (args.hypervisors - args.unreachable) *
+                        args.domains))
+    runs = []
+    try:
+        for _ in range(args.runs):
+            zabbix.reset_counters()
+            node_seconds = [run_main(path) for path in config_paths]
+            self_rss, workers_rss = peak_rss()
+            runs.append({
+                "seconds": round(sum(node_seconds), 3),
+                "node_seconds": [round(seconds, 3)
+                                 for seconds in node_seconds],
+                "api_calls_per_domain": sum(zabbix.calls.values()) / domains,
+                "api_calls": dict(zabbix.calls),
+                "trapper_frames_per_domain": zabbix.frames / domains,
+                "values_per_domain": zabbix.values / domains,
+                "failed_values": zabbix.failed_values,
+                "peak_rss_bytes": self_rss,
+                "peak_worker_rss_bytes": workers_rss,
+                "collector": dict(
+                    (key, value)
+                    for key, value in zabbix.collector_values.items()
+                    if key.startswith(("libvirt.collector[",
+                                       "libvirt.collector.phase["))
+                    and not key.endswith((",count]", ",errors]")))})
+    finally:
+        api.shutdown()
+        trapper.shutdown()
+        if args.keep:
+            print("Logs and state kept in " + directory)
+        else:
+            shutil.rmtree(directory)
+
+    report = {"commit": git_commit(),
+              "python": platform.python_version(),
+              "hypervisors": args.hypervisors, "domains": args.domains,
+              "nics": args.nics, "disks": args.disks,
+              "latency": args.latency, "hanging": args.hanging,
+              "backend": args.backend,
+              "workers": args.workers, "plaintext": args.plaintext,
+              "shards": args.shards,
+              "settings": ["{}.{}={}".format(*setting)
+                           for setting in args.set],
+              "runs": runs}
+    output = json.dumps(report, indent=4, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    sys.exit(main_simulate())
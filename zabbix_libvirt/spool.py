@@ -0,0 +1,109 @@
+"""
+This file holds a spool on disk for values the trapper didn't take, so they
+can be sent again later with their original timestamps.
+"""
+
+import contextlib
+import fcntl
+import json
+import os
+import threading
+
+SEGMENT_SUFFIX = ".spool"
+
+
+def _is_message(line):
+    """Return whether `line` is a complete message (the last line of a
+    segment may be cut short if the collector died while writing it)"""
+    try:
+        return isinstance(json.loads(line), dict)
+    except ValueError:
+        return False
+
+
+class Spool(object):
+    """Append-only spool of sender messages (JSON encoded metrics, one per
+    line) in segment files of about `segment_bytes` in `directory`.
+
+    When the spool grows over `max_bytes`, the oldest segments are dropped.
+    Threads and processes may use the same spool, they take turns with a
+    lock file.
+    """
+
+    def __init__(self, directory, max_bytes=256 * 2**20, segment_bytes=2**20,
+                 logger=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.logger = logger
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with self._lock:
+            with open(os.path.join(self.directory, "lock"), "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                yield
+
+    def _segments(self):
+        """Return the paths of the segments, oldest first"""
+        return [os.path.join(self.directory, name)
+                for name in sorted(os.listdir(self.directory))
+                if name.endswith(SEGMENT_SUFFIX)]
+
+    def append(self, messages):
+        """Add `messages` to the newest segment, starting a new one if it is
+        full, and drop the oldest segments if the spool is too big."""
+        data = "".join(message + "\n" for message in messages).encode("utf-8")
+        with self._locked():
+            segments = self._segments()
+            if not segments or \
+                    os.path.getsize(segments[-1]) >= self.segment_bytes:
+                number = 0
+                if segments:
+                    newest = os.path.basename(segments[-1])
+                    number = int(newest[:-len(SEGMENT_SUFFIX)]) + 1
+                segments.append(os.path.join(
+                    self.directory, "{:020d}{}".format(number, SEGMENT_SUFFIX)))
+            with open(segments[-1], "ab") as segment:
+                segment.write(data)
+
+            sizes = [os.path.getsize(path) for path in segments]
+            while sum(sizes) > self.max_bytes and len(segments) > 1:
+                os.remove(segments.pop(0))
+                sizes.pop(0)
+                if self.logger is not None:
+                    self.logger.warning("Spool is full, dropped a segment")
+
+    def replay(self, sender):
+        """Send the spooled messages with `sender`, oldest segment first.
+
+        Every segment is sent with one `flush`, and removed once it was sent.
+        Replaying stops at the first segment that fails, it is tried again
+        by the next replay (values in batches that did make it are sent
+        twice then). `sender` must not spool itself.
+
+        Returns the number of messages sent."""
+        sent = 0
+        with self._locked():
+            for path in self._segments():
+                with open(path, "rb") as segment:
+                    messages = [line for line in (
+                        raw.decode("utf-8").strip() for raw in segment)
+                        if _is_message(line)]
+                sender.add_messages(messages)
+                if any(result.error is not None for result in sender.flush()):
+                    break
+                os.remove(path)
+                sent += len(messages)
+        return sent
+
+    def depth(self):
+        """Return the size in bytes and the number of segments of the
+        spool"""
+        with self._locked():
+            segments = self._segments()
+            return sum(os.path.getsize(path) for path in segments), \
+                len(segments)
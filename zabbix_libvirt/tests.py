@@ -1,8 +1,31 @@
 """Some tests"""
 
+import json
 import subprocess
+import time
+import pytest
+import libvirt
+from pyzabbix import ZabbixMetric
+from pyzabbix.api import ZabbixAPIException
 from libvirt_checks import LibvirtConnection
-from zabbix_methods import ZabbixConnection
+from zabbix_methods import ZabbixConnection, DISABLE_HOST, ENABLE_HOST
+from reconciler import ZabbixInventory, ZabbixReconciler, plan_cleanup
+from change_filter import ChangeFilter
+from zabbix_session import TokenCache
+from rates import RateCalculator
+from rollups import Rollups
+from records import Metric, item_key
+from sender import BatchResult, PipelinedZabbixSender
+from spool import Spool
+from events import LifecycleEventDispatcher, MIGRATION_MEMORY
+from timings import Timings
+from tiers import TierSchedule, TIERS
+from health import HostHealth
+from sharding import ShardStore, shard_owner
+from ledger import LastSeenLedger
+from deadlines import Deadline
+from errors import DeadlineExceeded
+from simulate import SimulatedZabbix, SimulatedAPIError
 from helper import config, load_config
 
 CONFIG_FILE = "/etc/zabbix-libvirt/config.ini"
@@ -20,22 +43,112 @@ def test_libvirt_all():
     domains = conn.discover_domains()
 
     for domain in domains:
-        print domain
+        print(domain)
 
-        print conn.is_active(domain)
-        print conn.get_cpu(domain)
-        print conn.get_memory(domain)
-        print conn.get_misc_attributes(domain)
+        print(conn.is_active(domain))
+        print(conn.get_cpu(domain))
+        print(conn.get_memory(domain))
+        print(conn.get_misc_attributes(domain))
         vdisks = conn.discover_vdisks(domain)
         vnics = conn.discover_vnics(domain)
-        print vdisks
-        print vnics
+        print(vdisks)
+        print(vnics)
 
         for vdisk in vdisks:
-            print conn.get_diskio(domain, vdisk["{#VDISK}"])
+            print(conn.get_diskio(domain, vdisk["{#VDISK}"]))
 
         for vnic in vnics:
-            print conn.get_ifaceio(domain, vnic["{#VNIC}"])
+            print(conn.get_ifaceio(domain, vnic["{#VNIC}"]))
+
+
+def test_bulk_stats_mapping():
+    """Test that the bulk stats of an active and an inactive domain map to
+    what the per domain getters return"""
+
+    class Domain(object):
+        """A domain answering the per domain calls"""
+
+        def __init__(self, active):
+            self.active = active
+
+        def info(self):
+            return [1 if self.active else 5, 4096, 4096, 2, 8000]
+
+        def isActive(self):
+            return self.active
+
+        def memoryStats(self):
+            if not self.active:
+                raise libvirt.libvirtError("domain is not running")
+            return {"unused": 1, "usable": 2, "actual": 3}
+
+        def blockStatsFlags(self, disk):
+            if not self.active:
+                raise libvirt.libvirtError("domain is not running")
+            offset = {"vda": 0, "vdb": 100}[disk]
+            return {"rd_operations": offset + 1, "rd_bytes": offset + 2,
+                    "rd_total_times": offset + 3, "wr_operations": offset + 4,
+                    "wr_bytes": offset + 5, "wr_total_times": offset + 6,
+                    "flush_operations": offset + 7,
+                    "flush_total_times": offset + 8}
+
+        def interfaceStats(self, iface):
+            if not self.active:
+                raise libvirt.libvirtError("domain is not running")
+            offset = {"tap0": 0, "tap1": 100}[iface]
+            return (offset + 10, offset + 11, 0, 0, offset + 20,
+                    offset + 21, 0, 0)
+
+    def bulk_record(state, active):
+        record = {"state.state": state, "cpu.time": 8000, "vcpu.current": 2,
+                  "block.count": 2, "block.0.name": "vda",
+                  "block.1.name": "vdb",
+                  "net.count": 2, "net.0.name": "tap0",
+                  "net.1.name": "tap1"}
+        if not active:
+            # Inactive domains only report their vcpus and the names of their
+            # devices.
+            return record
+        record.update({"balloon.unused": 1, "balloon.usable": 2,
+                       "balloon.current": 3})
+        for index, offset in enumerate((0, 100)):
+            prefix = "block.{}.".format(index)
+            for number, field in enumerate(("rd.reqs", "rd.bytes", "rd.times",
+                                            "wr.reqs", "wr.bytes", "wr.times",
+                                            "fl.reqs", "fl.times")):
+                record[prefix + field] = offset + number + 1
+            prefix = "net.{}.".format(index)
+            record.update({prefix + "rx.bytes": offset + 10,
+                           prefix + "rx.pkts": offset + 11,
+                           prefix + "tx.bytes": offset + 20,
+                           prefix + "tx.pkts": offset + 21})
+        return record
+
+    # Only the getters are used, which don't need a connection.
+    conn = LibvirtConnection.__new__(LibvirtConnection)
+    # Only domains with a running qemu process are active, like isActive().
+    for state, active in ((libvirt.VIR_DOMAIN_RUNNING, 1),
+                          (libvirt.VIR_DOMAIN_PAUSED, 1),
+                          (libvirt.VIR_DOMAIN_SHUTOFF, 0),
+                          (libvirt.VIR_DOMAIN_CRASHED, 0)):
+        domain = Domain(active)
+        conn._domains = {"domain": domain}
+        stats = conn._parse_domain_stats(bulk_record(state, active), 42.0)
+
+        cpu = conn.get_cpu("domain")
+        cpu["timestamp"] = 42.0
+        assert stats["cpu"] == cpu
+        assert stats["memory"] == conn.get_memory("domain")
+        assert stats["active"] == active
+        assert sorted(stats["disk"]) == ["vda", "vdb"]
+        for disk, disk_stats in stats["disk"].items():
+            assert disk_stats == conn.get_diskio("domain", disk)
+        assert sorted(stats["nic"]) == ["tap0", "tap1"]
+        for nic, nic_stats in stats["nic"].items():
+            # The getter returns 0s (not "0"s) for inactive domains.
+            expected = conn.get_ifaceio("domain", nic)
+            assert nic_stats == dict((key, str(value))
+                                     for key, value in expected.items())
 
 
 def test_zabbix_connection_all():
@@ -81,3 +194,366 @@ def test_zabbix_connection_all():
         deleted_hosts = zapi.delete_hosts([zapi.get_host_id(test_host_name)])
         assert deleted_hosts == [host_id]
         assert test_host_name not in zapi.get_all_hosts()
+
+
+def test_reconciler_plan():
+    """Test that the reconciler only plans the changes that are needed"""
+    hosts = [{"hostid": "1", "host": "disabled-host", "status": DISABLE_HOST,
+              "groups": [{"groupid": "10"}]},
+             {"hostid": "2", "host": "up-to-date-host", "status": ENABLE_HOST,
+              "groups": [{"groupid": "10"}, {"groupid": "11"}]}]
+    groups = {"openstack-instances": "10", "project": "11"}
+    reconciler = ZabbixReconciler(
+        ZabbixInventory(hosts, groups), "10264", "identity", "psk")
+
+    plan = reconciler.plan({
+        "disabled-host": ["openstack-instances", "project"],
+        "up-to-date-host": ["openstack-instances", "project"],
+        "new-host": ["openstack-instances", "new-project"]})
+
+    assert plan.groups_to_create == set(["new-project"])
+    assert list(plan.hosts_to_create) == ["new-host"]
+    assert plan.hosts_to_enable == ["1"]
+    assert list(plan.hosts_to_regroup) == ["1"]
+
+
+def test_change_filter():
+    """Test that unchanged values are dropped until the refresh interval"""
+    change_filter = ChangeFilter(["libvirt.disk.discover"], 100)
+    metrics = [ZabbixMetric("host", "libvirt.disk.discover", "[]"),
+               ZabbixMetric("host", "libvirt.cpu[cpu_time]", "1")]
+
+    assert len(change_filter.filter(metrics, now=0)) == 2
+    # Nothing is remembered until the values are committed.
+    assert len(change_filter.filter(metrics, now=0)) == 2
+    change_filter.commit()
+
+    assert len(change_filter.filter(metrics, now=50)) == 1
+    assert len(change_filter.filter(metrics, now=150)) == 2
+    changed = [ZabbixMetric("host", "libvirt.disk.discover", "[{}]")]
+    assert len(change_filter.filter(changed, now=50)) == 1
+    # e.g. the trapper refused the values of the host
+    change_filter.commit(exclude=["host"])
+    assert len(change_filter.filter(metrics, now=50)) == 1
+
+
+def test_plan_cleanup():
+    """Test that stale hosts are kept, disabled or deleted by their age"""
+    hosts = [{"hostid": hostid, "status": ENABLE_HOST}
+             for hostid in ["recent", "stale", "ancient", "unknown"]]
+    hosts.append({"hostid": "disabled", "status": DISABLE_HOST})
+    lastclocks = {"recent": 9000, "stale": 5000, "ancient": 10, "disabled": 5000}
+
+    plan = plan_cleanup(hosts, lastclocks, now=10000, disable_after=3600,
+                        retention_period=9000)
+
+    assert plan.hosts_to_delete == ["ancient"]
+    assert plan.hosts_to_disable == ["stale", "unknown"]
+    assert plan.hosts_to_keep == ["recent", "disabled"]
+
+
+def test_token_cache(tmpdir):
+    """Test that cached tokens are only reused for the same login until
+    they expire"""
+    cache = TokenCache(str(tmpdir.join("token.json")), ttl=3600)
+    assert cache.load("https://zabbix", "user") is None
+
+    cache.save("https://zabbix", "user", "token")
+    assert cache.load("https://zabbix", "user") == "token"
+    assert cache.load("https://zabbix", "other-user") is None
+
+    cache.ttl = -1
+    assert cache.load("https://zabbix", "user") is None
+
+    cache.clear()
+    cache.ttl = 3600
+    assert cache.load("https://zabbix", "user") is None
+
+
+def test_rate_calculator():
+    """Test rates between samples, and that counter resets are skipped"""
+    calculator = RateCalculator(max_interval=600)
+    assert calculator.update("domain", 100, {"a": 10, "b": 500}) == {}
+
+    rates = calculator.update("domain", 110, {"a": 60, "b": 100, "c": 1})
+    assert rates == {"a": 5.0}
+
+    assert calculator.update("domain", 1000, {"a": 100}) == {}
+
+    calculator.retain([])
+    assert calculator.state == {}
+
+
+def test_rollups():
+    """Test that instance values add up per hypervisor and project"""
+    first = Rollups()
+    first.add({"virt_host": "compute1", "project_uuid": "p1"}, {"vms": 1})
+    first.add({"virt_host": "compute1", "project_uuid": "p2"}, {"vms": 1})
+    second = Rollups()
+    second.add({"virt_host": "compute2", "project_uuid": "p1"},
+               {"vms": 1, "cpus_used": 0.5})
+
+    first.merge(second)
+    assert first.totals == {
+        "rollup-host-compute1": {"vms": 2},
+        "rollup-host-compute2": {"vms": 1, "cpus_used": 0.5},
+        "rollup-project-p1": {"vms": 2, "cpus_used": 0.5},
+        "rollup-project-p2": {"vms": 1}}
+    assert len(first.metrics()) == 6
+
+
+def test_metric_records():
+    """Test that records encode like ZabbixMetric, with interned keys"""
+    key = item_key("disk", "rd_bytes", "vda")
+    assert key == "libvirt.disk[vda,rd_bytes]"
+    assert item_key("disk", "rd_bytes", "vda") is key
+    for metric, expected in (
+            (Metric("host", key, 1.5, 1600000000.5),
+             ZabbixMetric("host", key, 1.5, 1600000000.5)),
+            (Metric("host", item_key("instance", "name"), u'a "vm" \xe9'),
+             ZabbixMetric("host", item_key("instance", "name"),
+                          u'a "vm" \xe9'))):
+        assert json.loads(str(metric)) == json.loads(str(expected))
+
+
+def test_spool(tmpdir):
+    """Test that the spool drops its oldest segments and replays in order"""
+    spool = Spool(str(tmpdir), max_bytes=110, segment_bytes=40)
+    for number in range(5):
+        spool.append(['{{"number": {}, "padding": "....."}}'.format(number)])
+    assert spool.depth() == (102, 2)
+
+    class Sender(object):
+        """Records the messages it is asked to send"""
+        messages = []
+
+        def add_messages(self, messages):
+            self.messages.extend(messages)
+
+        def flush(self):
+            return [BatchResult(1, 0, 1, 0.0, None)]
+
+    sender = Sender()
+    assert spool.replay(sender) == 3
+    assert [json.loads(message)["number"] for message in sender.messages] \
+        == [2, 3, 4]
+    assert spool.depth() == (0, 0)
+
+
+def test_pipelined_sender():
+    """Test that the sender workers send every batch, with the collection
+    waiting for them once the queue is full"""
+    sent = []
+
+    class Sender(PipelinedZabbixSender):
+        """Records the batches instead of sending them"""
+
+        def _send_messages(self, messages, hosts=frozenset()):
+            time.sleep(0.01)
+            sent.append(messages)
+            self._results.append(BatchResult(
+                len(messages), 0, len(messages), 0.01, None))
+
+    timings = Timings()
+    sender = Sender(workers=2, queue_size=1, batch_size=10, timings=timings)
+    sender.add_messages(str(number) for number in range(95))
+    results = sender.flush()
+    assert sorted(int(message) for batch in sent for message in batch) \
+        == list(range(95))
+    assert sum(result.processed for result in results) == 95
+    assert len(timings.durations["backpressure"]) == 10
+    assert len(timings.durations["queue"]) == 10
+    assert timings.peaks["send_queue"] == 1
+    assert sender.flush() == []
+
+
+def test_lifecycle_event_coalescing():
+    """Test that the last of a domain's events in a batch wins, and that a
+    migrated domain isn't disabled when it's undefined on the source"""
+    source, target = object(), object()
+    defined = (libvirt.VIR_DOMAIN_EVENT_DEFINED, 0)
+    undefined = (libvirt.VIR_DOMAIN_EVENT_UNDEFINED, 0)
+    dispatcher = LifecycleEventDispatcher(handler=None)
+
+    assert dispatcher.coalesce([(source, "a") + defined,
+                                (source, "a") + undefined,
+                                (source, "b") + undefined,
+                                (target, "b") + defined], now=0) == \
+        ({"b": target}, ["a"])
+
+    migrated = [(target, "c", libvirt.VIR_DOMAIN_EVENT_STARTED,
+                 libvirt.VIR_DOMAIN_EVENT_STARTED_MIGRATED),
+                (source, "c", libvirt.VIR_DOMAIN_EVENT_STOPPED,
+                 libvirt.VIR_DOMAIN_EVENT_STOPPED_MIGRATED)]
+    assert dispatcher.coalesce(migrated, now=0) == ({"c": target}, [])
+    # The source undefines the domain after the migration, in a later batch.
+    assert dispatcher.coalesce([(source, "c") + undefined], now=10) == \
+        ({}, [])
+    assert dispatcher.coalesce([(source, "c") + undefined],
+                               now=MIGRATION_MEMORY + 10) == ({}, ["c"])
+
+
+def test_simulated_zabbix():
+    """Test provisioning against the simulated zabbix, with a group and a
+    host another worker created after the inventory was loaded"""
+    zabbix = SimulatedZabbix("user", "password")
+    auth = zabbix.call("user.login", {"user": "user", "password": "password"},
+                       None)
+
+    class Session(object):
+        """Sends the requests to the simulated zabbix"""
+
+        def do_request(self, method, params=None):
+            try:
+                return {"result": zabbix.call(method, params or {}, auth)}
+            except SimulatedAPIError as error:
+                raise ZabbixAPIException(
+                    {"code": error.code, "message": "", "data": error.data,
+                     "json": method})
+
+    zapi = ZabbixConnection(session=Session())
+    inventory = ZabbixInventory.load(zapi, ["a", "b", "c"], ["g1", "g2"])
+    groupid = zapi.create_hostgroup("g2")
+    zapi.create_hosts({"c": [groupid]}, "10001", "identity", "psk")
+    reconciler = ZabbixReconciler(inventory, "10001", "identity", "psk")
+    plan = reconciler.plan({"a": ["g1", "g2"], "b": ["g2"], "c": ["g2"]})
+    assert sorted(plan.hosts_to_create) == ["a", "b", "c"]
+    assert sorted(reconciler.apply(zapi, plan)) == ["a", "b"]
+
+    hosts = dict((host["host"], host)
+                 for host in zapi.get_hosts(["a", "b", "c"]))
+    groups = zapi.get_hostgroups()
+    assert [group["groupid"] for group in hosts["b"]["groups"]] == \
+        [groups["g2"]]
+    assert inventory.hosts["c"]["hostid"] == hosts["c"]["hostid"]
+    assert zabbix.receive([{"host": "a", "key": "libvirt.instance[name]"},
+                           {"host": "unknown",
+                            "key": "libvirt.instance[name]"}]) == (1, 1)
+
+
+def test_timings():
+    """Test that timings are merged and reported with their percentiles"""
+    first = Timings()
+    for seconds in range(1, 101):
+        first.add("metrics", seconds / 100.0)
+    first.add_hypervisor("hv1", 2.0, 100)
+    second = Timings()
+    try:
+        with second.phase("connect"):
+            raise ValueError("unreachable")
+    except ValueError:
+        pass
+    second.add_hypervisor("hv2", 1.0, 0, reachable=False)
+
+    first.merge(second)
+    values = dict((metric.key, metric.value)
+                  for metric in first.metrics("collector", 4.0))
+    assert values["libvirt.collector[domains_per_second]"] == "25.0"
+    assert values["libvirt.collector[unreachable_hypervisors]"] == "1"
+    assert values["libvirt.collector.phase[metrics,p50]"] == "0.5"
+    assert values["libvirt.collector.phase[metrics,p99]"] == "0.99"
+    assert values["libvirt.collector.phase[connect,errors]"] == "1"
+    assert values["libvirt.collector.hypervisor[hv2,errors]"] == "1"
+
+
+def test_sharding(tmpdir):
+    """Test that a new node only takes hosts from the others, and that the
+    cleanup waits for every node's run"""
+    hosts = ["host-{}".format(number) for number in range(1000)]
+    before = dict((host, shard_owner(host, ["a", "b", "c"])) for host in hosts)
+    after = dict((host, shard_owner(host, ["a", "b", "c", "d"]))
+                 for host in hosts)
+    moved = [host for host in hosts if before[host] != after[host]]
+    assert all(after[host] == "d" for host in moved)
+    assert 150 < len(moved) < 350
+
+    store = ShardStore(str(tmpdir.join("shards.sqlite")))
+    store.record_run("a", 100, ["domain-1", "domain-2"], finished=110)
+    assert store.stale_nodes(["a", "b"], 60, now=120) == ["b"]
+    store.record_run("b", 105, ["domain-3"], finished=115)
+    assert store.stale_nodes(["a", "b"], 60, now=120) == []
+    assert store.stale_nodes(["a", "b"], 60, now=172) == ["a"]
+    store.record_rollups("a", {"rollup-project-p1": {"vms": 1}}, clock=110)
+    assert store.rollups(["a", "b"], 60, now=120) == \
+        ({"a": {"rollup-project-p1": {"vms": 1}}}, ["b"])
+    assert store.claim("cleanup", "a", 60, now=120)
+    assert not store.claim("cleanup", "b", 60, now=130)
+    assert store.claim("cleanup", "b", 60, now=181)
+
+
+def test_deadline():
+    """Test that a call taking too long is given up on, and that a deadline
+    of 0 never expires"""
+    deadline = Deadline(5)
+    assert deadline.run(lambda value: value, 42, timeout=1) == 42
+    with pytest.raises(DeadlineExceeded):
+        deadline.run(time.sleep, 1, timeout=0.05)
+    with pytest.raises(ZeroDivisionError):
+        deadline.run(lambda: 1 / 0)
+    assert not Deadline(0).expired()
+    assert Deadline(0).remaining() is None
+
+
+def test_tier_schedule():
+    """Test that new domains get every tier, and that slow tiers wait for
+    their interval and what they found"""
+    schedule = TierSchedule({"cpu": 0, "attributes": 600, "discovery": 600})
+    assert schedule.due("domain", 1000) == set(TIERS)
+
+    schedule.ran("domain", TIERS, 1000, {"name": "instance"}, [[], []])
+    assert schedule.cached("domain", "attributes") == {"name": "instance"}
+    due = schedule.due("domain", 1060)
+    assert "cpu" in due and "attributes" not in due
+    assert "attributes" in schedule.due("domain", 1600)
+
+    schedule.ran("other", ["cpu"], 1000)
+    assert "attributes" in schedule.due("other", 1060)
+    # e.g. zabbix refused the values of a new host
+    schedule.ran("new", ["provision"], 1000, {"name": "new"}, [[], []])
+    assert "discovery" in schedule.due("new", 1060)
+    schedule.forget("domain", "devices")
+    assert "discovery" in schedule.due("domain", 1060)
+    schedule.retain(["other"])
+    assert list(schedule.state) == ["other"]
+
+
+def test_host_health(tmpdir):
+    """Test that the circuit opens after the threshold, backs off
+    exponentially and closes on success"""
+    path = str(tmpdir.join("host.health.json"))
+    health = HostHealth(2, 60, 200)
+    health.failed(now=0)
+    assert not health.is_open(now=1)
+    health.failed(now=10)
+    assert health.is_open(now=69) and not health.is_open(now=70)
+    health.failed(now=70)
+    assert health.retry_in(now=70) == 120
+    health.failed(now=200)
+    assert health.retry_in(now=200) == 200
+    health.save(path)
+
+    health = HostHealth.load(path, 2, 60, 200)
+    assert health.summary(now=201) == {"circuit_open": 1, "failures": 4,
+                                       "last_success": 0}
+    health.succeeded(now=500)
+    assert not health.is_open(now=501) and health.failures == 0
+
+
+def test_last_seen_ledger(tmpdir):
+    """Test that stale domains are found once until they are seen again,
+    and forgotten after the retention period"""
+    ledger = LastSeenLedger(str(tmpdir.join("ledger.sqlite")))
+    assert not ledger.imported()
+    ledger.import_domains("a", ["domain-1", "domain-2"], 100)
+    assert ledger.imported()
+    ledger.record("a", ["domain-2", "domain-3"], 200)
+
+    assert ledger.stale(150, 50) == {"domain-1": 100}
+    ledger.mark_disabled(["domain-1"], 150)
+    assert ledger.stale(150, 50) == {}
+    assert ledger.stale(250, 150) == {"domain-1": 100, "domain-2": 200,
+                                      "domain-3": 200}
+
+    ledger.record("a", ["domain-1"], 300)
+    ledger.prune(250)
+    assert ledger.stale(400, 0) == {"domain-1": 300}
@@ -0,0 +1,102 @@
+"""
+This file holds the collection tiers: every group of values is collected at
+its own interval, so the cheap counters can be sampled every cycle while the
+inventory (domain XML, nova metadata, device discovery, zabbix provisioning)
+is only refreshed every so often.
+"""
+
+import json
+import os
+import zlib
+
+# Tiers, in the order `process_host` collects them.
+TIERS = ("cpu", "memory", "disk", "nic", "attributes", "discovery",
+         "provision")
+# Tiers whose values are in the bulk stats.
+COUNTER_TIERS = ("cpu", "memory", "disk", "nic")
+
+
+class TierSchedule(object):
+    """When every tier of every domain of a hypervisor last ran, with the
+    instance attributes and devices found when the slow tiers last ran.
+
+    A tier is due once its interval (in seconds, 0 means every cycle) has
+    passed since it last ran. New domains get every tier. The first time a
+    tier of a domain ran, its next run is moved forward by a part of its
+    interval that depends on the domain, so the slow tiers of all domains
+    don't come due in the same cycle.
+    """
+
+    def __init__(self, intervals, state=None):
+        # tier -> interval in seconds
+        self.intervals = intervals
+        # domain -> {"ran": {tier: time}, "attributes": {..},
+        # "devices": [vnics, vdisks]}
+        self.state = state if state is not None else {}
+
+    @classmethod
+    def load(cls, path, intervals):
+        """Load when the tiers last ran from the state file at `path`, if it
+        exists"""
+        try:
+            with open(path) as state_file:
+                state = json.load(state_file)
+        except (IOError, ValueError):
+            state = {}
+        return cls(intervals, state)
+
+    def save(self, path):
+        """Write when the tiers last ran to the state file at `path`"""
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "w") as state_file:
+            json.dump(self.state, state_file, separators=(",", ":"))
+        os.rename(temporary_path, path)
+
+    def due(self, domain, now):
+        """Return the set of tiers of `domain` due at `now` (unix time)"""
+        entry = self.state.get(domain)
+        if entry is None:
+            return set(TIERS)
+        due = set(tier for tier in TIERS
+                  if now - entry["ran"].get(tier, 0) >=
+                  self.intervals.get(tier, 0))
+        # Without them the other tiers can't run.
+        if "attributes" not in entry:
+            due.add("attributes")
+        if "devices" not in entry:
+            due.add("discovery")
+        return due
+
+    def ran(self, domain, tiers, now, instance_attributes=None,
+            devices=None):
+        """Record that `tiers` of `domain` ran at `now`, and keep the
+        `instance_attributes` and `devices` they found"""
+        entry = self.state.setdefault(domain, {"ran": {}})
+        for tier in tiers:
+            ran = now
+            interval = self.intervals.get(tier, 0)
+            if interval and tier not in entry["ran"]:
+                ran -= zlib.crc32(
+                    "{},{}".format(domain, tier).encode("utf-8")) % interval
+            entry["ran"][tier] = ran
+        if instance_attributes is not None:
+            entry["attributes"] = instance_attributes
+        if devices is not None:
+            entry["devices"] = devices
+
+    def cached(self, domain, name):
+        """Return the "attributes" or "devices" of `domain` found when their
+        tier last ran, None if it never did"""
+        return self.state.get(domain, {}).get(name)
+
+    def forget(self, domain, name):
+        """Drop the "attributes" or "devices" of `domain`, so their tier
+        runs in the next cycle"""
+        self.state.get(domain, {}).pop(name, None)
+
+    def retain(self, domains):
+        """Forget the domains not in `domains`"""
+        domains = set(domains)
+        for domain in list(self.state):
+            if domain not in domains:
+                del self.state[domain]
@@ -0,0 +1,201 @@
+"""
+This file holds the collector's own instrumentation: how long every phase of
+a run takes and how often it fails, per hypervisor and in total, and the
+metrics reporting it on the collector's host in zabbix.
+"""
+
+import cProfile
+import contextlib
+import json
+import math
+import os
+import threading
+import timeit
+
+from errors import DeadlineExceeded
+from records import Metric, item_key
+
+# Phases of a run, in the order they happen for a hypervisor. "attributes"
+# and "metrics" are timed per domain, "send" per batch sent to the trapper.
+# With sender workers, "backpressure" is how long the collection waited for
+# room in the send queue and "queue" how long batches waited in it.
+# Timeouts are counted per phase too, and as "host" for hypervisors the run
+# stopped waiting for.
+PHASES = ("connect", "discover", "bulk_stats", "attributes", "provision",
+          "metrics", "backpressure", "queue", "send", "cleanup")
+PERCENTILES = (50, 95, 99)
+
+HYPERVISOR_DISCOVERY_KEY = "libvirt.collector.hypervisor.discover"
+
+
+def percentile(values, percent):
+    """Return the `percent` percentile (nearest rank) of the sorted list
+    `values`, 0 if it's empty"""
+    if not values:
+        return 0.0
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[max(0, rank - 1)]
+
+
+class Timings(object):
+    """Durations and error counts per phase, and a summary per hypervisor.
+
+    Every hypervisor is timed with its own `Timings`, which is returned by
+    the worker and merged into the one of the run.
+    """
+
+    def __init__(self):
+        # phase -> list of durations in seconds
+        self.durations = {}
+        # phase -> number of errors
+        self.errors = {}
+        # phase -> number of timeouts (which are counted as errors too)
+        self.timeouts = {}
+        # gauge -> highest value seen, e.g. "send_queue"
+        self.peaks = {}
+        # hypervisor -> {"seconds": .., "domains": .., "errors": ..,
+        # "timeouts": .., "reachable": ..}, and the `HostHealth.summary` if
+        # the circuit breaker is on
+
+        self.hypervisors = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time the block as phase `name`, counting an error (or a timeout,
+        for `DeadlineExceeded`) if it raises"""
+        started = timeit.default_timer()
+        try:
+            yield
+        except DeadlineExceeded:
+            self.timeout(name)
+            raise
+        except Exception:
+            self.error(name)
+            raise
+        finally:
+            self.add(name, timeit.default_timer() - started)
+
+    def add(self, name, seconds):
+        """Record that phase `name` took `seconds` once"""
+        self.durations.setdefault(name, []).append(seconds)
+
+    def error(self, name, count=1):
+        """Count `count` errors in phase `name`"""
+        self.errors[name] = self.errors.get(name, 0) + count
+
+    def timeout(self, name):
+        """Count a timeout (and an error) in phase `name`"""
+        self.timeouts[name] = self.timeouts.get(name, 0) + 1
+        self.error(name)
+
+    def peak(self, name, value):
+        """Record `value` of gauge `name`, keeping the highest"""
+        self.peaks[name] = max(self.peaks.get(name, 0), value)
+
+    def error_count(self):
+        """Return the number of errors in all phases"""
+        return sum(self.errors.values())
+
+    def add_hypervisor(self, host, seconds, domains, reachable=True,
+                       health=None):
+        """Record how long `host` took and how many domains it had, with the
+        errors counted so far and its `health` summary"""
+        self.hypervisors[host] = {"seconds": seconds, "domains": domains,
+                                  "errors": self.error_count(),
+                                  "timeouts": sum(self.timeouts.values()),
+                                  "reachable": int(reachable)}
+        if health is not None:
+            self.hypervisors[host].update(health)
+
+    def merge(self, other):
+        """Add the durations, errors, peaks and hypervisors of `other`"""
+        for name, durations in other.durations.items():
+            self.durations.setdefault(name, []).extend(durations)
+        for name, count in other.errors.items():
+            self.error(name, count)
+        for name, count in other.timeouts.items():
+            self.timeouts[name] = self.timeouts.get(name, 0) + count
+        for name, value in other.peaks.items():
+            self.peak(name, value)
+        self.hypervisors.update(other.hypervisors)
+
+    def summary(self):
+        """Return the total time and errors of every phase, for the logs"""
+        return ", ".join(
+            "{} {:.3f}s{}".format(
+                name, sum(self.durations.get(name, ())),
+                " ({} errors, {} timeouts)".format(
+                    self.errors[name], self.timeouts.get(name, 0))
+                if self.errors.get(name) else "")
+            for name in PHASES
+            if name in self.durations or name in self.errors)
+
+    def metrics(self, host, seconds, clock=None):
+        """Return the metrics of a run that took `seconds` for the
+        collector's zabbix host `host`"""
+        domains = sum(hypervisor["domains"]
+                      for hypervisor in self.hypervisors.values())
+        values = [
+            (item_key("collector", "seconds"), round(seconds, 3)),
+            (item_key("collector", "hypervisors"), len(self.hypervisors)),
+            (item_key("collector", "unreachable_hypervisors"),
+             sum(1 for hypervisor in self.hypervisors.values()
+                 if not hypervisor["reachable"])),
+            (item_key("collector", "domains"), domains),
+            (item_key("collector", "domains_per_second"),
+             round(domains / seconds, 2) if seconds > 0 else 0.0),
+            (item_key("collector", "errors"), self.error_count()),
+            (item_key("collector", "timeouts"), sum(self.timeouts.values())),
+            (item_key("collector", "abandoned_hypervisors"),
+             self.timeouts.get("host", 0)),
+            (item_key("collector", "open_circuits"),
+             sum(hypervisor.get("circuit_open", 0)
+                 for hypervisor in self.hypervisors.values())),
+            (item_key("collector", "send_queue_peak"),
+             self.peaks.get("send_queue", 0))]
+
+        for name in PHASES:
+            durations = sorted(self.durations.get(name, ()))
+            values.append((item_key("collector.phase", "count", name),
+                           len(durations)))
+            values.append((item_key("collector.phase", "seconds", name),
+                           round(sum(durations), 3)))
+            values.append((item_key("collector.phase", "errors", name),
+                           self.errors.get(name, 0)))
+            values.append((item_key("collector.phase", "timeouts", name),
+                           self.timeouts.get(name, 0)))
+            for percent in PERCENTILES:
+                values.append((item_key("collector.phase",
+                                        "p{}".format(percent), name),
+                               round(percentile(durations, percent), 6)))
+
+        values.append((HYPERVISOR_DISCOVERY_KEY, json.dumps(
+            [{"{#HYPERVISOR}": hypervisor}
+             for hypervisor in sorted(self.hypervisors)])))
+        for hypervisor, summary in sorted(self.hypervisors.items()):
+            for name, value in sorted(summary.items()):
+                if isinstance(value, float):
+                    value = round(value, 3)
+                values.append((item_key("collector.hypervisor", name,
+                                        hypervisor), value))
+
+        return [Metric(host, key, value, clock) for key, value in values]
+
+
+_worker = threading.local()
+
+
+def worker_profile():
+    """Return the `cProfile.Profile` of the calling worker (thread or
+    process), so all hosts a worker processes end up in one profile"""
+    if getattr(_worker, "pid", None) != os.getpid():
+        # A new worker, or a process forked from one.
+        _worker.pid = os.getpid()
+        _worker.profile = cProfile.Profile()
+    return _worker.profile
+
+
+def worker_profile_path(directory):
+    """Return where the profile of the calling worker is written"""
+    return os.path.join(directory, "worker-{}-{}.prof".format(
+        os.getpid(), threading.current_thread().name))
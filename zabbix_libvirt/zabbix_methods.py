@@ -2,29 +2,53 @@
 
 import pyzabbix
 
+# It's weird, but status "0" represents that host is monitored(enabled),
+# while "1" represents that host is not montitored (disabled)
+ENABLE_HOST = "0"
+DISABLE_HOST = "1"
+
+# Maximum number of objects sent in a single bulk API request.
+BATCH_SIZE = 500
+
+
+def chunks(items, size=BATCH_SIZE):
+    """Split `items` into lists of at most `size` items"""
+    items = list(items)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
 
 class ZabbixConnection(object):
     """This class will provide an object that lets you create, update, delete,
     and get information about hosts.
     """
 
-    def __init__(self, user, server, password):
-        """Login so we have a session"""
-        self.session = self.login(user, server, password)
+    def __init__(self, user=None, server=None, password=None, session=None):
+        """Login so we have a session, or use the shared `session` (a
+        `zabbix_session.ZabbixSession`) if it's given."""
+        self.owns_session = session is None
+        if session is None:
+            session = self.login(user, server, password)
+        self.session = session
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self.session.user.logout()
+        self.logout()
+
+    def logout(self):
+        """End the session. A shared session is left to its owner."""
+        if self.owns_session:
+            self.session.user.logout()
 
     @staticmethod
     def login(user, server, password):
         """Login to zabbix server"""
         return pyzabbix.ZabbixAPI(user=user, url=server, password=password)
 
-    def create_host(self, host_name, groupids, templateid, tls_psk_identity, tls_psk):
-        """Create a host in zabbix"""
+    @staticmethod
+    def _host_parameters(host_name, groupids, templateid, tls_psk_identity, tls_psk):
+        """Return the host.create parameters for a host"""
 
         # The interfaces are arbritary here since we will only use zabbix trapper
         # items to communicate.
@@ -33,17 +57,36 @@ class ZabbixConnection(object):
         groups = [{"groupid": i} for i in groupids]
         templates = [{"templateid": templateid}]
 
-        results = self.session.do_request("host.create", {
-            "host": host_name,
-            "tls_connect": 2,
-            "tls_accept": 2,
-            "tls_psk_identity": tls_psk_identity,
-            "tls_psk": tls_psk,
-            "interfaces": interfaces,
-            "groups": groups,
-            "templates": templates})["result"]
+        return {"host": host_name,
+                "tls_connect": 2,
+                "tls_accept": 2,
+                "tls_psk_identity": tls_psk_identity,
+                "tls_psk": tls_psk,
+                "interfaces": interfaces,
+                "groups": groups,
+                "templates": templates}
+
+    def create_host(self, host_name, groupids, templateid, tls_psk_identity, tls_psk):
+        """Create a host in zabbix"""
+        results = self.session.do_request("host.create", self._host_parameters(
+            host_name, groupids, templateid, tls_psk_identity, tls_psk))["result"]
         return results["hostids"][0]
 
+    def create_hosts(self, hosts, templateid, tls_psk_identity, tls_psk):
+        """Create many hosts with batched host.create requests.
+
+        hosts: dictionary of host name to the list of its group ids.
+        Returns a dictionary of host name to host id."""
+        hostids = {}
+        for batch in chunks(sorted(hosts)):
+            parameters = [self._host_parameters(
+                host_name, hosts[host_name], templateid, tls_psk_identity,
+                tls_psk) for host_name in batch]
+            results = self.session.do_request(
+                "host.create", parameters)["result"]
+            hostids.update(zip(batch, results["hostids"]))
+        return hostids
+
     def update_host_groups(self, host_name, groupids):
         """Update the host groups of a host"""
         groups = [{"groupid": i} for i in groupids]
@@ -66,6 +109,41 @@ class ZabbixConnection(object):
             "host.get", parameters)["result"]
         return [result["name"] for result in results]
 
+    def get_hosts(self, host_names=None, groupids=None):
+        """
+        Return the id, name, status and group ids of hosts.
+
+        host_names: Return only the hosts with these names. All hosts are
+        returned if it's None.
+        groupids: Return only hosts that belong to either of these groups.
+        """
+        parameters = {"output": ["hostid", "host", "status"],
+                      "selectGroups": ["groupid"]}
+        if groupids is not None:
+            parameters["groupids"] = groupids
+        if host_names is None:
+            return self.session.do_request("host.get", parameters)["result"]
+
+        results = []
+        for batch in chunks(host_names):
+            parameters["filter"] = {"host": batch}
+            results.extend(self.session.do_request(
+                "host.get", parameters)["result"])
+        return results
+
+    def get_hostgroups(self, group_names=None):
+        """Return a dictionary of host group name to group id.
+
+        group_names: Return only the groups with these names. All groups are
+        returned if it's None.
+        """
+        parameters = {"output": ["groupid", "name"]}
+        if group_names is not None:
+            parameters["filter"] = {"name": list(group_names)}
+        results = self.session.do_request(
+            "hostgroup.get", parameters)["result"]
+        return dict((result["name"], result["groupid"]) for result in results)
+
     def get_group_id(self, group_name):
         """Find the group id of a group"""
         results = self.session.do_request(
@@ -92,8 +170,7 @@ class ZabbixConnection(object):
 
     def get_host_status(self, host_name):
         """Return the montoring status for a host.
-        It's weird, but status "0" represents that host is monitored(enabled),
-        while "1" represents that host is not montitored (disabled)"""
+        See `ENABLE_HOST` and `DISABLE_HOST`"""
         results = self.session.do_request(
             "host.get", {"filter": {"host": [host_name]},
                          "output": ["status", "name"]})["result"]
@@ -103,9 +180,18 @@ class ZabbixConnection(object):
 
     def set_hosts_status(self, hostids, status):
         """Set monitoring statuses of mulitple hosts"""
-        hosts = [{"hostid": hostid} for hostid in hostids]
-        self.session.do_request(
-            "host.massupdate", {"hosts": hosts, "status": status})
+        for batch in chunks(hostids):
+            hosts = [{"hostid": hostid} for hostid in batch]
+            self.session.do_request(
+                "host.massupdate", {"hosts": hosts, "status": status})
+
+    def set_hosts_groups(self, hostids, groupids):
+        """Replace the host groups of mulitple hosts"""
+        groups = [{"groupid": i} for i in groupids]
+        for batch in chunks(hostids):
+            hosts = [{"hostid": hostid} for hostid in batch]
+            self.session.do_request(
+                "host.massupdate", {"hosts": hosts, "groups": groups})
 
     def get_item(self, host_id, item_key, item_attribute="lastvalue"):
         """Get the value of an item with item_key on host with host_id.
@@ -137,8 +223,11 @@ class ZabbixConnection(object):
 
     def delete_hosts(self, host_ids):
         """Delete a host in zabbix"""
-        result = self.session.do_request("host.delete", host_ids)["result"]
-        return sorted(result["hostids"])
+        deleted = []
+        for batch in chunks(host_ids):
+            result = self.session.do_request("host.delete", batch)["result"]
+            deleted.extend(result["hostids"])
+        return sorted(deleted)
 
     def create_hostgroup(self, hostgroup):
         """Create a host group and return the group id"""
@@ -146,6 +235,17 @@ class ZabbixConnection(object):
             "hostgroup.create", {"name": hostgroup})["result"]
         return result["groupids"][0]
 
+    def create_hostgroups(self, hostgroups):
+        """Create many host groups with batched hostgroup.create requests.
+
+        Returns a dictionary of group name to group id."""
+        groupids = {}
+        for batch in chunks(sorted(hostgroups)):
+            result = self.session.do_request(
+                "hostgroup.create", [{"name": name} for name in batch])["result"]
+            groupids.update(zip(batch, result["groupids"]))
+        return groupids
+
 
 def main():
     """Main things happen here"""
@@ -0,0 +1,255 @@
+"""
+This file holds a zabbix API client that is logged in once and shared by all
+workers, instead of every worker creating (and ending) its own session.
+"""
+
+import errno
+import json
+import os
+import threading
+import time
+
+try:
+    import http.client as httplib
+except ImportError:
+    import httplib
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+import pyzabbix
+from pyzabbix.api import ZabbixAPIException
+
+# Methods zabbix accepts without a session token.
+NO_AUTH_METHODS = ("apiinfo.version", "user.login")
+
+# Errors a request fails with when the server closed an idle keep-alive
+# connection before the request was sent.
+STALE_CONNECTION_ERRNOS = (errno.EPIPE, errno.ECONNRESET, errno.ECONNABORTED)
+
+HEADERS = {"Content-Type": "application/json-rpc"}
+
+
+def session_expired(error):
+    """Return whether a `ZabbixAPIException` means the session token is no
+    longer valid (it expired, or was logged out)."""
+    data = str(getattr(error, "data", "")).lower()
+    return getattr(error, "code", None) == -32602 and \
+        ("re-login" in data or "not authori" in data)
+
+
+class TokenCache(object):
+    """Keeps a session token in a file, so later runs and other processes
+    reuse it instead of logging in again.
+
+    Tokens older than `ttl` seconds are not reused.
+    """
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+
+    def load(self, url, user):
+        """Return the cached token for `user` on `url`, or None"""
+        try:
+            with open(self.path) as cache_file:
+                cached = json.load(cache_file)
+        except (IOError, ValueError):
+            return None
+        if cached.get("url") != url or cached.get("user") != user:
+            return None
+        if time.time() - cached.get("created", 0) > self.ttl:
+            return None
+        return cached.get("auth")
+
+    def save(self, url, user, auth):
+        """Cache `auth` as the token of `user` on `url`"""
+        # The token is as good as the password, only the owner may read it.
+        temporary_path = "{}.{}.tmp".format(self.path, os.getpid())
+        cache_file = os.fdopen(os.open(
+            temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w")
+        with cache_file:
+            json.dump({"url": url, "user": user, "auth": auth,
+                       "created": time.time()}, cache_file)
+        os.rename(temporary_path, self.path)
+
+    def clear(self):
+        """Forget the cached token"""
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class _ConnectionPool(object):
+    """Idle keep-alive HTTP(S) connections to one server, shared by threads.
+
+    A connection is created whenever none is idle, so there are at most as
+    many as requests made at the same time. Connections inherited from the
+    parent process after a fork are dropped, they would share its sockets.
+    """
+
+    def __init__(self, url, timeout):
+        parts = urlsplit(url)
+        self.https = parts.scheme == "https"
+        self.netloc = parts.netloc
+        self.timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def get(self):
+        """Return an idle connection, or a new one"""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._idle = []
+                self._pid = os.getpid()
+            if self._idle:
+                return self._idle.pop()
+        if self.https:
+            return httplib.HTTPSConnection(self.netloc, timeout=self.timeout)
+        return httplib.HTTPConnection(self.netloc, timeout=self.timeout)
+
+    def put(self, connection):
+        """Give back a connection returned by `get`"""
+        with self._lock:
+            if self._pid == os.getpid():
+                self._idle.append(connection)
+
+    def close(self):
+        """Close all idle connections"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+
+class ZabbixSession(pyzabbix.ZabbixAPI):
+    """A `pyzabbix.ZabbixAPI` meant to be shared by all workers of a run.
+
+    * Requests go over keep-alive connections, so workers don't pay for a TCP
+      and TLS handshake per request. It's safe to use from many threads, and
+      from processes forked after it was created.
+    * With a `token_cache`, a cached token is used instead of logging in, and
+      new tokens are cached for later runs and other processes.
+    * When zabbix says the session expired, it logs in again and retries the
+      request once.
+    """
+
+    def __init__(self, url, user, password, token_cache=None, timeout=30):
+        # pyzabbix.ZabbixAPI.__init__ logs in right away with urlopen, which
+        # opens a new connection per request, so it isn't called.
+        self.use_authenticate = False
+        self.use_basic_auth = False
+        self.base64_cred = None
+        self.url = url + "/api_jsonrpc.php"
+        self.token_cache = token_cache
+        self._user = user
+        self._password = password
+        self._path = urlsplit(self.url).path
+        self._connections = _ConnectionPool(self.url, timeout)
+        self._login_lock = threading.Lock()
+
+        self.auth = None
+        if token_cache is not None:
+            self.auth = token_cache.load(self.url, user)
+        if self.auth is None:
+            self._login(user, password)
+
+    def _login(self, user="", password=""):
+        """Login and cache the new token"""
+        self.auth = None
+        self.auth = self.do_request(
+            "user.login", {"user": user, "password": password})["result"]
+        if self.token_cache is not None:
+            self.token_cache.save(self.url, user, self.auth)
+
+    def logout(self):
+        """End the session, it can't be used (or reused by later runs)
+        afterwards."""
+        if self.auth:
+            self.do_request("user.logout")
+            self.auth = None
+        if self.token_cache is not None:
+            self.token_cache.clear()
+        self._connections.close()
+
+    def close(self):
+        """Close the connections but keep the session, e.g. for later runs
+        that find it in the token cache."""
+        self._connections.close()
+
+    def do_request(self, method, params=None):
+        """Make a request, logging in again if the session expired"""
+        auth = self.auth
+        try:
+            return self._request(method, params, auth)
+        except ZabbixAPIException as error:
+            if method in NO_AUTH_METHODS or not session_expired(error):
+                raise
+        self._relogin(auth)
+        return self._request(method, params, self.auth)
+
+    def _relogin(self, expired_auth):
+        with self._login_lock:
+            if self.auth != expired_auth:
+                # Another thread logged in already.
+                return
+            if self.token_cache is not None:
+                # Or another process, which cached its token.
+                auth = self.token_cache.load(self.url, self._user)
+                if auth is not None and auth != expired_auth:
+                    self.auth = auth
+                    return
+            self._login(self._user, self._password)
+
+    def _request(self, method, params, auth):
+        request_json = {"jsonrpc": "2.0", "method": method,
+                        "params": params or {}, "id": "1"}
+        if auth and method not in NO_AUTH_METHODS:
+            request_json["auth"] = auth
+
+        status, reason, body = self._post(
+            json.dumps(request_json).encode("utf-8"))
+        if status != 200:
+            raise ZabbixAPIException(
+                "HTTP error {}: {}".format(status, reason))
+        try:
+            res_json = json.loads(body.decode("utf-8"))
+        except ValueError as error:
+            raise ZabbixAPIException(
+                "Unable to parse json: " + str(error))
+
+        if "error" in res_json:
+            error = res_json["error"].copy()
+            error.setdefault("data", "")
+            # Don't put the password in logs.
+            error["json"] = method if method == "user.login" \
+                else str(request_json)
+            raise ZabbixAPIException(error)
+        return res_json
+
+    def _post(self, body):
+        """POST `body` and return the status, reason and body of the reply"""
+        connection = self._connections.get()
+        try:
+            while True:
+                reused = connection.sock is not None
+                try:
+                    connection.request("POST", self._path, body, HEADERS)
+                    response = connection.getresponse()
+                    return response.status, response.reason, response.read()
+                except Exception as error:
+                    # A closed connection reconnects on its next request.
+                    connection.close()
+                    # The server closes idle keep-alive connections. The
+                    # request never got to it then, so it's safe to retry
+                    # once on a new connection.
+                    stale = isinstance(error, httplib.BadStatusLine) or \
+                        getattr(error, "errno", None) in STALE_CONNECTION_ERRNOS
+                    if not (reused and stale):
+                        raise
+        finally:
+            self._connections.put(connection)